@@ -0,0 +1,711 @@
+import asyncio, zlib
+from collections import OrderedDict
+
+import redis.asyncio as aioredis
+
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
+
+try:
+    from .cache import LRUCache, manifest_key
+    from .helper import load_settings, write_log
+    from .packed import IMAGE_SLOTS, PLAY_SLOTS, image_counts, play_counts
+    from .queries import (
+        IN_CHUNK, METRIC_GROUPS, PLAYABLE_SQL, READ_CHUNK, category_result,
+        chunks, image_category_result, image_fields, image_key, image_reply,
+        image_reply_total, image_result, image_total_result,
+        legacy_youtube_snapshots, media_files_query, packed_reads,
+        playcount_reply, playcount_result, playcount_total_result, range_dates,
+        range_fields, subcategories_query, top_result, watched_entry,
+        youtube_result, youtube_score_range, youtube_snapshot)
+    from .storage import ROLLUPS_BUILT, open_local_storage
+    from .top import TOP_METRICS, board_key, board_periods, rank, ranked
+except ImportError:
+    from cache import LRUCache, manifest_key
+    from helper import load_settings, write_log
+    from packed import IMAGE_SLOTS, PLAY_SLOTS, image_counts, play_counts
+    from queries import (
+        IN_CHUNK, METRIC_GROUPS, PLAYABLE_SQL, READ_CHUNK, category_result,
+        chunks, image_category_result, image_fields, image_key, image_reply,
+        image_reply_total, image_result, image_total_result,
+        legacy_youtube_snapshots, media_files_query, packed_reads,
+        playcount_reply, playcount_result, playcount_total_result, range_dates,
+        range_fields, subcategories_query, top_result, watched_entry,
+        youtube_result, youtube_score_range, youtube_snapshot)
+    from storage import ROLLUPS_BUILT, open_local_storage
+    from top import TOP_METRICS, board_key, board_periods, rank, ranked
+
+# Asynchronous counterpart of GetData for servers answering many requests at
+# once. Results are identical; the difference is that nothing blocks the event
+# loop, and that independent reads (the categories of one level of the tree,
+# the READ_CHUNK blocks of a manifest) are issued concurrently rather than one
+# after the other.
+#
+#     data = AsyncGetData()
+#     result = await data.category_playcount('Videos of cats', depth=2)
+#     await data.close()
+#
+# The Redis, SSDB and Commons clients can be passed in, e.g. fakeredis's
+# FakeRedis from fakeredis.aioredis, or any object with an async
+# `fetch(query, params)` method in place of the Commons replica.
+
+
+class AsyncSSDB:
+    """
+    Minimal asyncio client for the SSDB protocol, with a pool of up to `size`
+    connections. Replies are returned as lists of bytes blocks, in the shape
+    pyssdb gives them for multi_hget and hgetall.
+    """
+
+    def __init__(self, host, port, size=8):
+        self.host = host
+        self.port = port
+        self.idle = []
+        self.slots = asyncio.BoundedSemaphore(size)
+
+    async def _read_block(self, reader):
+        size = await reader.readline()
+        if size == b'':
+            raise ConnectionError('SSDB closed the connection')
+        if size in (b'\n', b'\r\n'):
+            return None
+        data = await reader.readexactly(int(size))
+        await reader.readline()
+        return data
+
+    async def _read_reply(self, reader):
+        blocks = []
+        while True:
+            block = await self._read_block(reader)
+            if block is None:
+                break
+            blocks.append(block)
+
+        status = blocks[0].decode('utf-8')
+        if status == 'not_found':
+            return []
+        if status != 'ok':
+            raise RuntimeError('SSDB error: ' + b' '.join(blocks).decode(
+                'utf-8', 'replace'))
+        return blocks[1:]
+
+    def _encode(self, command):
+        request = bytearray()
+        for arg in command:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            request += str(len(arg)).encode('ascii') + b'\n' + arg + b'\n'
+        return request + b'\n'
+
+    async def batch(self, commands):
+        """
+        Like Helper.ssdb_batch: writes every command on one connection before
+        reading the replies back in order.
+        """
+
+        async with self.slots:
+            if len(self.idle) > 0:
+                reader, writer = self.idle.pop()
+            else:
+                reader, writer = await asyncio.open_connection(
+                    self.host, self.port)
+
+            try:
+                writer.write(b''.join(self._encode(x) for x in commands))
+                await writer.drain()
+                replies = []
+                for command in commands:
+                    replies.append(await self._read_reply(reader))
+            except BaseException:
+                writer.close()
+                raise
+
+            self.idle.append((reader, writer))
+            return replies
+
+    async def execute(self, *command):
+        return (await self.batch([command]))[0]
+
+    async def close(self):
+        idle, self.idle = self.idle, []
+        for reader, writer in idle:
+            writer.close()
+
+
+class AsyncCommons:
+    """
+    Pool of aiomysql connections to the Commons replica, sized and recycled
+    like the synchronous CommonsPool. Requires aiomysql.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.pool = None
+        self.lock = asyncio.Lock()
+
+    async def _pool(self):
+        async with self.lock:
+            if self.pool is None:
+                if aiomysql is None:
+                    raise RuntimeError(
+                        'aiomysql is needed for asynchronous Commons queries')
+                self.pool = await aiomysql.create_pool(
+                    host=self.settings['commons_host'],
+                    port=self.settings['commons_port'],
+                    db=self.settings['commons_db'],
+                    user=self.settings['sql_user'],
+                    password=self.settings['sql_pass'],
+                    charset='utf8',
+                    autocommit=True,
+                    maxsize=self.settings['commons_pool_size'],
+                    pool_recycle=self.settings['commons_idle_timeout'])
+            return self.pool
+
+    async def fetch(self, query, params):
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, params)
+                return await cur.fetchall()
+
+    async def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            await self.pool.wait_closed()
+            self.pool = None
+
+
+class AsyncGetData:
+    def __init__(self, redis=None, ssdb=None, commons=None, settings=None):
+        if settings is None:
+            settings = load_settings()
+        self.settings = settings
+
+        if redis is None:
+            redis = aioredis.Redis(
+                host=settings['redis_host'], port=settings['redis_port'])
+        if ssdb is None:
+            ssdb = AsyncSSDB(settings['ssdb_host'], settings['ssdb_port'])
+        if commons is None:
+            commons = AsyncCommons(settings)
+        self.redis = redis
+        self.ssdb = ssdb
+        self.commons = commons
+
+        # Backends on local disk are read through the storage module in a
+        # worker thread
+        self.local = open_local_storage(settings)
+        self.packed = settings['storage_backend'] == 'packed'
+
+        self.manifests = LRUCache(settings['manifest_cache_size'])
+        self.building = {}  # manifest key: task building it
+
+    def error_log(self, message):
+        write_log(self.settings['error_log'], message, flush=True)
+
+    async def close(self):
+        await self.redis.aclose()
+        await self.ssdb.close()
+        await self.commons.close()
+        if self.local is not None:
+            self.local.close()
+
+    async def _find_subcategories(self, category, depth=9):
+        """
+        Same walk as GetData's, but the IN_CHUNK queries of each level run
+        concurrently.
+        """
+
+        if depth == 0:
+            return [category]
+
+        root = category.replace(' ', '_')
+        visited = set([root])
+        frontier = [root]
+
+        for level in range(depth):
+            results = await asyncio.gather(*[
+                self.commons.fetch(subcategories_query(len(chunk)), chunk)
+                for chunk in chunks(frontier, IN_CHUNK)
+            ])
+            children = set(row[0].decode('utf-8')
+                           for rows in results for row in rows)
+
+            frontier = sorted(children - visited)
+            if len(frontier) == 0:
+                break
+            visited.update(frontier)
+
+        visited.discard(root)
+        return sorted(visited)
+
+    async def _find_media_files_bulk(self, categories, mode='playable'):
+        categories = sorted(set(x.replace(' ', '_') for x in categories))
+        results = await asyncio.gather(*[
+            self.commons.fetch(
+                media_files_query(len(chunk), mode), chunk + [PLAYABLE_SQL])
+            for chunk in chunks(categories, IN_CHUNK)
+        ])
+        return set(row[0].decode('utf-8') for rows in results for row in rows)
+
+    async def _build_manifest(self, category, depth, mode):
+        categories = [category] + await self._find_subcategories(
+            category, depth=depth)
+        manifest = sorted(await self._find_media_files_bulk(
+            categories, mode=mode))
+
+        ttl = self.settings['manifest_ttl']
+        key = manifest_key(category, depth, mode)
+        if ttl > 0 and self.settings['manifest_cache'] == 'redis':
+            await self.redis.setex(
+                key, ttl, zlib.compress('\n'.join(manifest).encode('utf-8')))
+        elif ttl > 0:
+            self.manifests.set(key, manifest, ttl)
+        return manifest
+
+    async def manifest(self, category, depth=9, mode='playable'):
+        """
+        Returns a category's manifest from the same cache as GetData uses.
+        Concurrent requests for a manifest that is not cached share a single
+        build.
+        """
+
+        key = manifest_key(category, depth, mode)
+        if self.settings['manifest_ttl'] > 0:
+            if self.settings['manifest_cache'] == 'redis':
+                cached = await self.redis.get(key)
+                if cached is not None:
+                    cached = zlib.decompress(cached).decode('utf-8')
+                    return cached.split('\n') if cached != '' else []
+            else:
+                cached = self.manifests.get(key)
+                if cached is not None:
+                    return cached
+
+        if key not in self.building:
+            self.building[key] = asyncio.ensure_future(
+                self._build_manifest(category, depth, mode))
+            self.building[key].add_done_callback(
+                lambda task: self.building.pop(key, None))
+        return await asyncio.shield(self.building[key])
+
+    async def _gather_chunks(self, filenames, run):
+        """
+        Runs `run(chunk)` for every READ_CHUNK files at once and merges the
+        dicts they return.
+        """
+
+        results = {}
+        for result in await asyncio.gather(
+                *[run(chunk) for chunk in chunks(filenames, READ_CHUNK)]):
+            results.update(result)
+        return results
+
+    async def _redis_chunks(self, filenames, command):
+        """
+        Runs `command(pipe, filename)` for every file, one pipeline per
+        READ_CHUNK files, all pipelines at once. Returns {filename: reply}.
+        """
+
+        async def run(chunk):
+            pipe = self.redis.pipeline(transaction=False)
+            for filename in chunk:
+                command(pipe, filename)
+            return dict(zip(chunk, await pipe.execute()))
+
+        return await self._gather_chunks(filenames, run)
+
+    async def _ssdb_chunks(self, filenames, command):
+        """
+        Same as `_redis_chunks` for SSDB: `command(key)` gives the command
+        tuple for a file's image key.
+        """
+
+        async def run(chunk):
+            results = await self.ssdb.batch(
+                [command(image_key(filename)) for filename in chunk])
+            return dict(zip(chunk, results))
+
+        return await self._gather_chunks(filenames, run)
+
+    async def _playcounts(self, filenames, date_strings):
+        if self.local is not None:
+            return await asyncio.to_thread(self.local.playcounts, filenames,
+                                           date_strings)
+
+        if self.packed:
+            async def run(chunk):
+                reads = [packed_reads('mpc:' + x, date_strings, PLAY_SLOTS)
+                         for x in chunk]
+                pipe = self.redis.pipeline(transaction=False)
+                for file_reads in reads:
+                    for year, first, key, start, length in file_reads:
+                        pipe.getrange(key, start, start + length - 1)
+                replies = iter(await pipe.execute())
+                return {
+                    filename: play_counts([(x[0], x[1], next(replies))
+                                           for x in file_reads], date_strings)
+                    for filename, file_reads in zip(chunk, reads)
+                }
+
+            return await self._gather_chunks(filenames, run)
+
+        if date_strings is None:
+            command = lambda pipe, filename: pipe.hgetall('mpc:' + filename)
+        else:
+            command = lambda pipe, filename: pipe.hmget(
+                'mpc:' + filename, date_strings)
+
+        replies = await self._redis_chunks(filenames, command)
+        return {
+            filename: playcount_reply(result, date_strings)
+            for filename, result in replies.items()
+        }
+
+    async def _rollups_built(self):
+        # See `Storage.rollups_built`
+        return (self.settings['rollups'] and
+                await self.redis.exists(ROLLUPS_BUILT) > 0)
+
+    async def _playcount_totals(self, filenames, date_strings):
+        if self.local is not None:
+            return await asyncio.to_thread(self.local.playcount_totals,
+                                           filenames, date_strings)
+
+        if self.packed or not await self._rollups_built():
+            return {
+                filename: sum(count for date_string, count in counts)
+                for filename, counts in (await self._playcounts(
+                    filenames, date_strings)).items()
+            }
+
+        fields = range_fields(date_strings)
+        replies = await self._redis_chunks(
+            filenames, lambda pipe, filename: pipe.hmget('mpc:' + filename,
+                                                         fields))
+        return {
+            filename: sum(int(x) for x in result if x is not None)
+            for filename, result in replies.items()
+        }
+
+    async def _image_counts(self, filenames, date_strings):
+        if self.local is not None:
+            return await asyncio.to_thread(self.local.image_counts, filenames,
+                                           date_strings)
+
+        if self.packed:
+            async def run(chunk):
+                reads = [
+                    packed_reads(image_key(x), date_strings, IMAGE_SLOTS)
+                    for x in chunk
+                ]
+                replies = iter(await self.ssdb.batch([
+                    ('substr', key, start, length) for file_reads in reads
+                    for year, first, key, start, length in file_reads
+                ]))
+                return {
+                    filename: image_counts(
+                        [(x[0], x[1], b''.join(next(replies)))
+                         for x in file_reads], date_strings)
+                    for filename, file_reads in zip(chunk, reads)
+                }
+
+            return await self._gather_chunks(filenames, run)
+
+        if date_strings is None:
+            command = lambda key: ('hgetall', key)
+        else:
+            fields = image_fields(date_strings)
+            command = lambda key: ('multi_hget', key) + fields
+
+        replies = await self._ssdb_chunks(filenames, command)
+        return {
+            filename: image_reply(result, date_strings)
+            for filename, result in replies.items()
+        }
+
+    async def _image_totals(self, filenames, date_strings):
+        if self.local is not None:
+            return await asyncio.to_thread(self.local.image_totals, filenames,
+                                           date_strings)
+
+        if self.packed or not await self._rollups_built():
+            totals = {}
+            for filename, dates in (await self._image_counts(
+                    filenames, date_strings)).items():
+                totals[filename] = [
+                    sum(counts[group_num] for counts in dates.values())
+                    for group_num in range(len(METRIC_GROUPS))
+                ]
+            return totals
+
+        fields = image_fields(range_fields(date_strings))
+        replies = await self._ssdb_chunks(
+            filenames, lambda key: ('multi_hget', key) + fields)
+        return {
+            filename: image_reply_total(result)
+            for filename, result in replies.items()
+        }
+
+    async def _watched_total(self, category, depth, mode, date_strings):
+        if date_strings is None:
+            return None
+
+        entry = watched_entry(category, depth, mode)
+        if not await self.redis.sismember('watched', entry):
+            return None
+
+        if mode == 'playable':
+            values = await self.redis.hmget('cattotal:' + entry, date_strings)
+            if None in values:
+                return None
+            return sum(int(x) for x in values)
+
+        fields = image_fields(date_strings)
+        values = await self.redis.hmget('cattotal:' + entry, fields)
+        if None in values:
+            return None
+        total = [0, 0, 0, 0]
+        for field, value in zip(fields, values):
+            total[int(field[-1:])] += int(value)
+        return total
+
+    async def file_playcount(self,
+                             filename,
+                             start_date=None,
+                             end_date=None,
+                             last=None,
+                             details=True):
+        filename = filename.replace(' ', '_')
+        date_strings = range_dates(start_date, end_date, last)
+
+        if not details:
+            totals = await self._playcount_totals([filename], date_strings)
+            return playcount_total_result(filename, totals[filename])
+
+        counts = await self._playcounts([filename], date_strings)
+        return playcount_result(filename, counts[filename])
+
+    async def category_playcount(self,
+                                 category,
+                                 depth=9,
+                                 start_date=None,
+                                 end_date=None,
+                                 last=None,
+                                 details=True,
+                                 per_file=True):
+        date_strings = range_dates(start_date, end_date, last)
+
+        if not details and not per_file:
+            total = await self._watched_total(category, depth, 'playable',
+                                              date_strings)
+            if total is None:
+                manifest = await self.manifest(category, depth)
+                total = sum((await self._playcount_totals(
+                    manifest, date_strings)).values())
+            return OrderedDict([('category', category), ('depth', depth),
+                                ('total', total)])
+
+        manifest = await self.manifest(category, depth)
+
+        data = []
+        total = 0
+        if details:
+            counts = await self._playcounts(manifest, date_strings)
+            for file in sorted(manifest):
+                block = playcount_result(file, counts[file])
+                total += block['total']
+                data.append(block)
+        else:
+            totals = await self._playcount_totals(manifest, date_strings)
+            for file in sorted(manifest):
+                total += totals[file]
+                data.append(playcount_total_result(file, totals[file]))
+
+        return category_result(category, depth, data, total)
+
+    async def _youtube_snapshots(self, filenames, date_strings):
+        """
+        Same lookups as GetData's: the YouTube IDs of all the files, then
+        their latest counts and snapshots in range, each with one round of
+        concurrent pipelines.
+        """
+
+        ids = await self._redis_chunks(
+            filenames, lambda pipe, filename: pipe.get('com2yt:' + filename))
+        ids = {x: y.decode('utf-8') for x, y in ids.items() if y is not None}
+        paired = sorted(ids)
+
+        reads = [
+            self._redis_chunks(
+                paired, lambda pipe, filename: pipe.hget(
+                    'ytlatest', ids[filename]))
+        ]
+        if date_strings is not None:
+            low, high = youtube_score_range(date_strings)
+            reads.append(
+                self._redis_chunks(
+                    paired, lambda pipe, filename: pipe.zrangebyscore(
+                        'ytts:' + ids[filename], low, high)))
+        replies = await asyncio.gather(*reads)
+
+        latest = {}
+        snapshots = {}
+        legacy = []
+        for filename in paired:
+            member = replies[0][filename]
+            if member is None:
+                legacy.append(filename)
+                continue
+            latest[filename] = youtube_snapshot(member)
+            snapshots[filename] = []
+            if date_strings is not None:
+                snapshots[filename] = [
+                    youtube_snapshot(x) for x in replies[1][filename]
+                ]
+
+        play_counts = await self._redis_chunks(
+            legacy, lambda pipe, filename: pipe.hgetall(
+                'youtube:' + ids[filename]))
+        for filename, counts in play_counts.items():
+            if len(counts) > 0:
+                snapshots[filename] = legacy_youtube_snapshots(counts)
+                latest[filename] = snapshots[filename][-1]
+
+        results = {}
+        for filename in filenames:
+            if filename in latest:
+                results[filename] = youtube_result(
+                    filename, latest[filename], snapshots[filename],
+                    date_strings)
+            else:
+                results[filename] = {'filename': filename}
+        return results
+
+    async def youtube_snapshot_file(self,
+                                    filename,
+                                    start_date=None,
+                                    end_date=None,
+                                    last=None):
+        filename = filename.replace(' ', '_')
+        results = await self._youtube_snapshots(
+            [filename], range_dates(start_date, end_date, last))
+        return results[filename]
+
+    async def youtube_snapshot_category(self,
+                                        category,
+                                        depth=9,
+                                        start_date=None,
+                                        end_date=None,
+                                        last=None):
+        manifest = await self.manifest(category, depth)
+        results = await self._youtube_snapshots(
+            manifest, range_dates(start_date, end_date, last))
+
+        data = [results[file] for file in sorted(manifest)]
+        total = 0
+        for block in data:
+            if 'count' in block:
+                total += block['count']
+
+        return category_result(category, depth, data, total)
+
+    async def image_single_viewcount(self,
+                                     filename,
+                                     start_date=None,
+                                     end_date=None,
+                                     last=None,
+                                     details=True):
+        filename = filename.replace(' ', '_')
+        date_strings = range_dates(start_date, end_date, last)
+
+        if not details:
+            totals = await self._image_totals([filename], date_strings)
+            return image_total_result(filename, totals[filename])
+
+        counts = await self._image_counts([filename], date_strings)
+        return image_result(filename, counts[filename])
+
+    async def image_category_viewcount(self,
+                                       category,
+                                       depth=9,
+                                       start_date=None,
+                                       end_date=None,
+                                       last=None,
+                                       details=True,
+                                       per_file=True):
+        metric_groups = METRIC_GROUPS + ['total']
+        date_strings = range_dates(start_date, end_date, last)
+
+        if not details and not per_file:
+            total = await self._watched_total(category, depth, 'static',
+                                              date_strings)
+            if total is None:
+                manifest = await self.manifest(category, depth, mode='static')
+                total = [0, 0, 0, 0]
+                for counts in (await self._image_totals(
+                        manifest, date_strings)).values():
+                    for group_num in range(len(METRIC_GROUPS)):
+                        total[group_num] += counts[group_num]
+            return OrderedDict(
+                [('category', category), ('depth', depth),
+                 (metric_groups[0], total[0]), (metric_groups[1], total[1]),
+                 (metric_groups[2], total[2]), (metric_groups[3], total[3]),
+                 (metric_groups[4], sum(total))])
+
+        manifest = await self.manifest(category, depth, mode='static')
+
+        if details:
+            counts = await self._image_counts(manifest, date_strings)
+        else:
+            totals = await self._image_totals(manifest, date_strings)
+
+        data = []
+        total = [0, 0, 0, 0, 0]
+        for file in sorted(manifest):
+            if details:
+                block = image_result(file, counts[file])
+            else:
+                block = image_total_result(file, totals[file])
+            for group_num, group_name in enumerate(metric_groups):
+                total[group_num] += block[group_name]
+            data.append(block)
+
+        return image_category_result(category, depth, data, total)
+
+    async def _manifest_totals(self, category, depth, metric, date_strings):
+        if metric == 'plays':
+            manifest = await self.manifest(category, depth)
+            return await self._playcount_totals(manifest, date_strings)
+
+        manifest = await self.manifest(category, depth, mode='static')
+        totals = await self._image_totals(manifest, date_strings)
+        if metric == 'images':
+            return {x: sum(y) for x, y in totals.items()}
+        group_num = METRIC_GROUPS.index(metric)
+        return {x: y[group_num] for x, y in totals.items()}
+
+    async def top_files(self,
+                        metric='plays',
+                        start_date=None,
+                        end_date=None,
+                        last=None,
+                        limit=100,
+                        category=None,
+                        depth=9):
+        if metric not in TOP_METRICS:
+            raise ValueError('Unknown metric: ' + metric)
+
+        date_strings = range_dates(start_date, end_date, last)
+
+        if category is not None:
+            totals = await self._manifest_totals(category, depth, metric,
+                                                 date_strings)
+            return top_result(metric, rank(totals, limit), category, depth)
+
+        pipe = self.redis.pipeline(transaction=False)
+        for period in board_periods(date_strings):
+            pipe.zrange(board_key(metric, period), 0, -1, withscores=True)
+        return top_result(metric, ranked(await pipe.execute(), limit))
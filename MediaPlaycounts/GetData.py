@@ -1,38 +1,66 @@
-import arrow, hashlib, re
-from .helper import Helper
 from collections import OrderedDict
 
+# Importable both as part of the package and from scripts run inside it, like
+# LogProcessor
+try:
+    from . import cache
+    from .cache import ManifestCache
+    from .categories import (category_files, find_media_files,
+                             find_subcategories)
+    from .helper import Helper
+    from .queries import (
+        METRIC_GROUPS, READ_CHUNK, category_result, chunks,
+        image_category_result, image_result, image_total_result,
+        legacy_youtube_snapshots, playcount_result, playcount_total_result,
+        range_dates, top_result, youtube_result, youtube_score_range,
+        youtube_snapshot)
+    from .storage import open_storage
+    from .top import TOP_METRICS, board_key, board_periods, rank, ranked
+    from .watched import WatchedCategories
+except ImportError:
+    import cache
+    from cache import ManifestCache
+    from categories import (category_files, find_media_files,
+                            find_subcategories)
+    from helper import Helper
+    from queries import (
+        METRIC_GROUPS, READ_CHUNK, category_result, chunks,
+        image_category_result, image_result, image_total_result,
+        legacy_youtube_snapshots, playcount_result, playcount_total_result,
+        range_dates, top_result, youtube_result, youtube_score_range,
+        youtube_snapshot)
+    from storage import open_storage
+    from top import TOP_METRICS, board_key, board_periods, rank, ranked
+    from watched import WatchedCategories
+
 h = Helper()
 
+# Daily counts are read from the backend picked by STORAGE_BACKEND; see the
+# storage module.
+storage = open_storage(h)
+
+
+def _timed(function):
+    # Per-request timings for the METRICS export; a no-op while it is off
+    return h.metrics.timed('getdata_request_seconds', function=function)
+
 
 def _find_subcategories(category, depth=9):
     """
     Finds subcategories of a given category up to the provided depth. Category
     should not have the "Category:" prefix. Returns a flat list of categories.
+    See `categories.find_subcategories`.
     """
 
-    if depth == 0:
-        return [category]
-
-    categorylist = []
-
-    query = (
-        "select page_title from categorylinks join page on cl_from = page_id"
-        " where cl_to = %s and cl_type = 'subcat'")
-    params = (category.replace(' ', '_'))
+    return find_subcategories(h, category, depth=depth)
 
-    results = h.query_commons(query, params)
 
-    for result in results:
-        val = result[0].decode('utf-8')
-        categorylist.append(val)
-        more = _find_subcategories(val, depth=depth - 1)
-        if more != None:
-            for more_result in more:
-                categorylist.append(more_result)
+def _find_media_files_bulk(categories, mode='playable'):
+    """
+    Returns the set of media files in any of the given categories.
+    """
 
-    categorylist = sorted(list(set(categorylist)))
-    return categorylist
+    return find_media_files(h, categories, mode=mode)
 
 
 def _find_media_files(category, mode='playable'):
@@ -40,116 +68,213 @@ def _find_media_files(category, mode='playable'):
     Generates a list of media files for a single category. Use the _find_subcategories
     method to generate a list of subcategories to feed individually into this
     method. Note that the returned files do not include still images; only videos
-    and the like are returned.
+    and the like are returned, unless mode is 'static'.
+    """
+
+    return sorted(_find_media_files_bulk([category], mode=mode))
+
+
+def _recursive_file_finder(category, depth, mode='playable'):
+    """
+    Recursively goes through categories (up to the depth provided) and produces
+    a list of files.
     """
 
-    filelist = []
+    return category_files(h, category, depth, mode=mode)
+
+
+# Manifests keyed by (category, depth, mode). MANIFEST_CACHE picks where they
+# are kept: 'redis' to share them between processes, 'local' for an in-process
+# LRU cache of MANIFEST_CACHE_SIZE entries.
+manifests = ManifestCache(
+    _recursive_file_finder,
+    redis=h.redis if h.settings['manifest_cache'] == 'redis' else None,
+    ttl=h.settings['manifest_ttl'],
+    max_entries=h.settings['manifest_cache_size'],
+    error_log=h.error_log)
 
-    q = ("select page_title from page join categorylinks on cl_from = page_id "
-         "where page_namespace=6 and cl_to = %s;")
+# Daily totals of the watched categories; see the watched module
+watched = WatchedCategories(h, storage, manifests)
 
-    params = (category.replace(" ", "_"))
-    results = h.query_commons(q, params)
-    ext_regex = re.compile('.*\.(mid|ogg|ogv|wav|webm|flac|oga)')
-    for result in results:
-        filename = result[0].decode("utf-8")
-        if (re.match(ext_regex, filename) is not None and mode == 'playable') \
-        or (re.match(ext_regex, filename) is None and mode == 'static'):
-            filelist.append(filename)
 
-    filelist.sort()
+def refresh_manifest(category, depth=9, mode='playable'):
+    """
+    Rebuilds the cached manifest for a category right away, e.g. after its
+    membership changed. Returns the new manifest.
+    """
 
-    return filelist
+    return manifests.refresh(category, depth, mode)
 
 
-def _recursive_file_finder(category, depth, mode='playable'):
+def invalidate_manifest(category=None, depth=None, mode=None):
     """
-    Recursively goes through categories (up to the depth provided) and produces
-    a list of files.
+    Drops cached manifests so they are rebuilt on their next use. Arguments
+    left as None match everything.
+    """
+
+    manifests.invalidate(category, depth, mode)
+
+
+def refresh_hot_categories(entries, interval=None):
+    """
+    Keeps the manifests for the given (category, depth, mode) entries fresh
+    from a background thread, every `interval` seconds (by default half the
+    MANIFEST_TTL). Returns an Event that stops the thread when set.
     """
 
-    manifest = []
+    if interval is None:
+        interval = h.settings['manifest_ttl'] / 2
+    return manifests.refresh_in_background(entries, interval)
 
-    root_list = _find_media_files(category, mode=mode)
-    for entry in root_list:
-        manifest.append(entry)
 
-    subcat_list = _find_subcategories(category, depth=depth)
-    for subcat in subcat_list:
-        subcat_file_list = _find_media_files(subcat, mode=mode)
-        for entry in subcat_file_list:
-            manifest.append(entry)
+def export_metrics(interval=None):
+    """
+    With METRICS on, exports this process's metrics as the getdata job from a
+    background thread, every `interval` seconds (by default METRICS_INTERVAL).
+    Returns an Event that stops the thread when set.
+    """
 
-    return sorted(list(set(manifest)))
+    if interval is None:
+        interval = h.settings['metrics_interval']
+    return h.metrics.export_in_background('getdata', interval)
 
 
-def file_playcount(filename, start_date=None, end_date=None, last=None):
+@_timed('file_playcount')
+def file_playcount(filename,
+                   start_date=None,
+                   end_date=None,
+                   last=None,
+                   details=True):
     """
     Returns play count information for a single file, either on a specific date,
     a range of dates, in the last X days, or all-time by having all the keyword
-    parameters set to None.
+    parameters set to None. With `details` set to False only the total is
+    returned, which is answered from the month and year rollups once they
+    are built.
     """
 
-    data = []
     filename = filename.replace(' ', '_')
+    date_strings = range_dates(start_date, end_date, last)
 
-    if start_date is None and end_date is None and last is None:
-        everything = h.redis.hgetall('mpc:' + filename)
-        for date_string, count in everything.items():
-            date_string = date_string.decode('utf-8')
-            count = int(count.decode('utf-8'))
-            data.append({'date': date_string, 'count': count})
-    else:
-        date_range = h.date_ranger(
-            start_date=start_date, end_date=end_date, last=last)
-        for date in date_range:
-            date_string = date.format('YYYYMMDD')
-            count = h.redis.hget('mpc:' + filename, date_string)
-            if count is None:
-                count = 0
-            else:
-                count = int(count.decode('utf-8'))
-            data.append(OrderedDict([('date', date_string), ('count', count)]))
-
-    total = 0
-    for triplet in data:
-        total += triplet['count']
+    if not details:
+        totals = storage.playcount_totals([filename], date_strings)
+        return playcount_total_result(filename, totals[filename])
 
-    data = sorted(data, key=lambda k: k['date'])
+    counts = storage.playcounts([filename], date_strings)
 
-    return OrderedDict([('filename', filename), ('total', total), ('details',
-                                                                   data)])
+    return playcount_result(filename, counts[filename])
 
 
+@_timed('category_playcount')
 def category_playcount(category,
                        depth=9,
                        start_date=None,
                        end_date=None,
-                       last=None):
+                       last=None,
+                       details=True,
+                       per_file=True):
     """
     Returns play count information for a category of files, up to the specified
     level of category recursion, either on a specific date, a range of dates, or
-    in the last X days.
+    in the last X days. With `details` set to False, the per-file entries only
+    carry totals. With `per_file` also False, only the category total is
+    returned; for watched categories it comes straight from their stored
+    daily totals.
     """
 
-    manifest = _recursive_file_finder(category, depth)
+    date_strings = range_dates(start_date, end_date, last)
 
-    data = []
-    for file in manifest:
-        data.append(
-            file_playcount(
-                file, start_date=start_date, end_date=end_date, last=last))
+    if not details and not per_file:
+        total = watched.total(category, depth, 'playable', date_strings)
+        if total is None:
+            manifest = manifests.get(category, depth)
+            total = sum(
+                storage.playcount_totals(manifest, date_strings).values())
+        return OrderedDict([('category', category), ('depth', depth),
+                            ('total', total)])
 
-    data = sorted(data, key=lambda k: k['filename'])
+    manifest = manifests.get(category, depth)
 
+    data = []
     total = 0
-    for block in data:
-        total += block['total']
+    if details:
+        counts = storage.playcounts(manifest, date_strings)
+        for file in sorted(manifest):
+            block = playcount_result(file, counts[file])
+            total += block['total']
+            data.append(block)
+    else:
+        totals = storage.playcount_totals(manifest, date_strings)
+        for file in sorted(manifest):
+            total += totals[file]
+            data.append(playcount_total_result(file, totals[file]))
 
-    return OrderedDict([('category', category), ('depth', depth),
-                        ('total', total), ('details', data)])
+    return category_result(category, depth, data, total)
 
 
+def _youtube_snapshots(filenames, date_strings):
+    """
+    Returns a dict of filename to snapshot result for many files at once. The
+    YouTube IDs are looked up with one round of pipelines; the latest counts
+    and, for a range, the snapshots within it with another. Videos whose
+    snapshots are still in an old-style youtube: hash are read from it.
+    """
+
+    ids = {}
+    for chunk in chunks(filenames, READ_CHUNK):
+        pipe = h.redis.pipeline(transaction=False)
+        for filename in chunk:
+            pipe.get('com2yt:' + filename)
+        for filename, youtube_id in zip(chunk, pipe.execute()):
+            if youtube_id is not None:
+                ids[filename] = youtube_id.decode('utf-8')
+
+    if date_strings is not None:
+        low, high = youtube_score_range(date_strings)
+
+    latest = {}
+    snapshots = {}
+    legacy = []
+    for chunk in chunks(sorted(ids), READ_CHUNK):
+        pipe = h.redis.pipeline(transaction=False)
+        for filename in chunk:
+            pipe.hget('ytlatest', ids[filename])
+            if date_strings is not None:
+                pipe.zrangebyscore('ytts:' + ids[filename], low, high)
+        replies = pipe.execute()
+        if date_strings is None:
+            replies = [(x, []) for x in replies]
+        else:
+            replies = zip(replies[0::2], replies[1::2])
+
+        for filename, (member, members) in zip(chunk, replies):
+            if member is None:
+                legacy.append(filename)
+            else:
+                latest[filename] = youtube_snapshot(member)
+                snapshots[filename] = [youtube_snapshot(x) for x in members]
+
+    for chunk in chunks(legacy, READ_CHUNK):
+        pipe = h.redis.pipeline(transaction=False)
+        for filename in chunk:
+            pipe.hgetall('youtube:' + ids[filename])
+        for filename, play_counts in zip(chunk, pipe.execute()):
+            if len(play_counts) > 0:
+                snapshots[filename] = legacy_youtube_snapshots(play_counts)
+                latest[filename] = snapshots[filename][-1]
+
+    results = {}
+    for filename in filenames:
+        if filename in latest:
+            results[filename] = youtube_result(filename, latest[filename],
+                                               snapshots[filename],
+                                               date_strings)
+        else:
+            results[filename] = {'filename': filename}
+    return results
+
+
+@_timed('youtube_snapshot_file')
 def youtube_snapshot_file(filename, start_date=None, end_date=None, last=None):
     """
     Returns the total plays for a YouTube video, identified by its filename on
@@ -161,43 +286,12 @@ def youtube_snapshot_file(filename, start_date=None, end_date=None, last=None):
     """
 
     filename = filename.replace(' ', '_')
-    youtube_id = h.redis.get('com2yt:' + filename)
-
-    if youtube_id is None:
-        return {'filename': filename}
-    else:
-        youtube_id = youtube_id.decode('utf-8')
-
-    play_counts = h.redis.hgetall('youtube:' + youtube_id)
-    play_counts = {
-        x.decode('utf-8'): int(y.decode('utf-8'))
-        for x, y in play_counts.items()
-    }
-    timestamps = sorted(list(play_counts.keys()), reverse=True)
-    latest_time = timestamps[0]
-    latest_count = play_counts[latest_time]
-    ret = OrderedDict([('filename', filename), ('count', latest_count),
-                       ('as_of', latest_time)])
-
-    if start_date is None and end_date is None and last is None:
-        return ret
-    else:
-        details = []
-        time_map = {timestamp[:8]: timestamp for timestamp in timestamps}
-        date_range = h.date_ranger(
-            start_date=start_date, end_date=end_date, last=last)
-        for date in date_range:
-            date_string = date.format('YYYYMMDD')
-            timestamp = time_map[date_string]
-            if timestamp in play_counts:
-                details.append({
-                    'count': play_counts[timestamp],
-                    'as_of': timestamp
-                })
-        ret.update({'details': details})
-        return ret
+    results = _youtube_snapshots([filename],
+                                 range_dates(start_date, end_date, last))
+    return results[filename]
 
 
+@_timed('youtube_snapshot_category')
 def youtube_snapshot_category(category,
                               depth=9,
                               start_date=None,
@@ -208,126 +302,200 @@ def youtube_snapshot_category(category,
     files.
     """
 
-    manifest = _recursive_file_finder(category, depth)
-
-    data = []
-    for file in manifest:
-        data.append(
-            youtube_snapshot_file(
-                file, start_date=start_date, end_date=end_date, last=last))
+    manifest = manifests.get(category, depth)
+    results = _youtube_snapshots(manifest,
+                                 range_dates(start_date, end_date, last))
 
-    data = sorted(data, key=lambda k: k['filename'])
+    data = [results[file] for file in sorted(manifest)]
 
     total = 0
     for block in data:
         if 'count' in block:
             total += block['count']
 
-    return OrderedDict([('category', category), ('depth', depth),
-                        ('total', total), ('details', data)])
+    return category_result(category, depth, data, total)
 
 
-def image_single_viewcount(filename, start_date=None, end_date=None,
-                           last=None):
+@_timed('image_single_viewcount')
+def image_single_viewcount(filename,
+                           start_date=None,
+                           end_date=None,
+                           last=None,
+                           details=True):
     """
     Returns view count data for static images, including drill-down metrics for
-    loads of thumbnails and of the original images.
+    loads of thumbnails and of the original images. With `details` set to
+    False only the totals are returned, which are answered from the rollups
+    once they are built.
     """
 
-    metric_groups = ['original', '0-399', '400-799', '800+']
-
-    data = []
     filename = filename.replace(' ', '_')
-    filehash = hashlib.sha224(filename.encode('utf-8')).hexdigest()
-
-    if start_date is None and end_date is None and last is None:
-        dates = {}
-        everything = h.ssdb.hgetall('img:' + filehash)
-        everything = {
-            everything[n]: everything[n + 1]
-            for n in range(0, len(everything), 2)
-        }
-        for date_string, count in everything.items():
-            date_string = date_string.decode('utf-8')
-            actual_date = date_string[:8]
-            metric_group = int(date_string[-1:])
-            count = int(count.decode('utf-8'))
-            if actual_date not in dates:
-                dates[actual_date] = {'date': actual_date}
-            dates[actual_date][metric_groups[metric_group]] = count
-        for date in sorted(list(dates.keys())):
-            to_append = OrderedDict([('date', date)])
-            total = 0
-            for group in metric_groups:
-                if group in dates[date]:
-                    total += dates[date][group]
-                    to_append.update({group: dates[date][group]})
-                else:
-                    to_append.update({group: 0})
-            to_append.update({'total': total})
-            data.append(to_append)
+    date_strings = range_dates(start_date, end_date, last)
 
-    else:
-        total = [0, 0, 0, 0]  # corresponding to each metrics group
-        date_range = h.date_ranger(
-            start_date=start_date, end_date=end_date, last=last)
-        for date in date_range:
-            date_string = date.format('YYYYMMDD')
-            to_append = OrderedDict([('date', date_string)])
-            subtotal = 0
-            for group_num, group_name in enumerate(metric_groups):
-                count = h.ssdb.hget('img:' + filehash,
-                                    date_string + str(group_num))
-                if count is None:
-                    count = 0
-                else:
-                    count = int(count.decode('utf-8'))
-                    subtotal += count
-                    total[group_num] += count
-                to_append.update({group_name: count})
-            to_append.update({'total': subtotal})
-            data.append(to_append)
-
-        total_total = total[0] + total[1] + total[2] + total[3]
-
-    data = sorted(data, key=lambda k: k['date'])
-
-    return OrderedDict([('filename', filename), (metric_groups[0], total[0]),
-                        (metric_groups[1], total[1]),
-                        (metric_groups[2], total[2]),
-                        (metric_groups[3], total[3]),
-                        ('total', total_total), ('details', data)])
+    if not details:
+        totals = storage.image_totals([filename], date_strings)
+        return image_total_result(filename, totals[filename])
 
+    counts = storage.image_counts([filename], date_strings)
 
+    return image_result(filename, counts[filename])
+
+
+@_timed('image_category_viewcount')
 def image_category_viewcount(category,
                              depth=9,
                              start_date=None,
                              end_date=None,
-                             last=None):
+                             last=None,
+                             details=True,
+                             per_file=True):
     """
     Does the samne thing as the function above, but with a whole category of
     files.
     """
 
-    metric_groups = ['original', '0-399', '400-799', '800+', 'total']
-
-    manifest = _recursive_file_finder(category, depth, mode='static')
+    metric_groups = METRIC_GROUPS + ['total']
+    date_strings = range_dates(start_date, end_date, last)
+
+    if not details and not per_file:
+        total = watched.total(category, depth, 'static', date_strings)
+        if total is None:
+            manifest = manifests.get(category, depth, mode='static')
+            total = [0, 0, 0, 0]
+            for counts in storage.image_totals(manifest,
+                                               date_strings).values():
+                for group_num in range(len(METRIC_GROUPS)):
+                    total[group_num] += counts[group_num]
+        return OrderedDict(
+            [('category', category), ('depth', depth),
+             (metric_groups[0], total[0]), (metric_groups[1], total[1]),
+             (metric_groups[2], total[2]), (metric_groups[3], total[3]),
+             (metric_groups[4], sum(total))])
+
+    manifest = manifests.get(category, depth, mode='static')
+
+    if details:
+        counts = storage.image_counts(manifest, date_strings)
+    else:
+        totals = storage.image_totals(manifest, date_strings)
 
     data = []
-    for file in manifest:
-        data.append(
-            image_single_viewcount(
-                file, start_date=start_date, end_date=end_date, last=last))
-
-    data = sorted(data, key=lambda k: k['filename'])
-
     total = [0, 0, 0, 0, 0]
-    for block in data:
+    for file in sorted(manifest):
+        if details:
+            block = image_result(file, counts[file])
+        else:
+            block = image_total_result(file, totals[file])
         for group_num, group_name in enumerate(metric_groups):
             total[group_num] += block[group_name]
+        data.append(block)
+
+    return image_category_result(category, depth, data, total)
+
+
+def _manifest_totals(category, depth, metric, date_strings):
+    """
+    Returns a dict of filename to total for `metric` over every file in a
+    category's manifest.
+    """
+
+    if metric == 'plays':
+        manifest = manifests.get(category, depth)
+        return storage.playcount_totals(manifest, date_strings)
+
+    manifest = manifests.get(category, depth, mode='static')
+    totals = storage.image_totals(manifest, date_strings)
+    if metric == 'images':
+        return {x: sum(y) for x, y in totals.items()}
+    group_num = METRIC_GROUPS.index(metric)
+    return {x: y[group_num] for x, y in totals.items()}
+
+
+@_timed('top_files')
+def top_files(metric='plays',
+              start_date=None,
+              end_date=None,
+              last=None,
+              limit=100,
+              category=None,
+              depth=9):
+    """
+    Returns the `limit` files with the highest counts of `metric` over a range
+    of dates, or all-time with the date parameters set to None. `metric` is
+    'plays', 'images' for all loads of a static file, or one of the
+    METRIC_GROUPS.
+
+    Answered from the leaderboards LogProcessor keeps, reading at most a few
+    boards of TOP_K files each; see the top module for how exact they are.
+    With a `category`, its files are instead ranked by their totals, read
+    from the rollups.
+    """
+
+    if metric not in TOP_METRICS:
+        raise ValueError('Unknown metric: ' + metric)
+
+    date_strings = range_dates(start_date, end_date, last)
+
+    if category is not None:
+        totals = _manifest_totals(category, depth, metric, date_strings)
+        return top_result(metric, rank(totals, limit), category, depth)
+
+    pipe = h.redis.pipeline(transaction=False)
+    for period in board_periods(date_strings):
+        pipe.zrange(board_key(metric, period), 0, -1, withscores=True)
+    return top_result(metric, ranked(pipe.execute(), limit))
+
+
+def watch_category(category, depth=9, mode='playable', start_date=None,
+                   end_date=None, last=None):
+    """
+    Starts keeping daily totals for a category. Totals are added for each day
+    LogProcessor ingests from now on; pass a date range to also compute them
+    for days already stored.
+    """
+
+    date_strings = None
+    if start_date is not None or end_date is not None or last is not None:
+        date_strings = range_dates(start_date, end_date, last)
+    watched.watch(category, depth, mode, date_strings)
+
+
+def unwatch_category(category, depth=9, mode='playable'):
+    watched.unwatch(category, depth, mode)
+
+
+def update_watched_categories(date_strings):
+    """
+    Refreshes the membership of every watched category and adds the given
+    days, once they are stored, to its series. LogProcessor does this itself
+    after each day.
+    """
+
+    watched.add_days(date_strings)
+
+
+def drop_watched_days(date_strings):
+    """
+    Removes days from every watched category's series, e.g. after they were
+    deleted from the store.
+    """
+
+    watched.drop_days(date_strings)
+
+
+def record_changed_days(date_strings):
+    """
+    Marks days as changed for services caching these results; see
+    `cache.record_changed_days`.
+    """
+
+    cache.record_changed_days(h.redis, date_strings)
+
+
+def changed_days(since):
+    """
+    Returns the current change counter and the days changed after `since`;
+    see `cache.changed_days`.
+    """
 
-    return OrderedDict(
-        [('category', category), ('depth', depth),
-         (metric_groups[0], total[0]), (metric_groups[1], total[1]),
-         (metric_groups[2], total[2]), (metric_groups[3], total[3]),
-         (metric_groups[4], total[4]), ('details', data)])
+    return cache.changed_days(h.redis, since)
@@ -1,165 +1,1207 @@
-import arrow, bz2, hashlib, os, re, requests, sys, urllib.parse
+import arrow, bz2, collections, functools, hashlib, heapq, itertools, json
+import multiprocessing, operator, os, queue, re, redis, requests, shutil, sys
+import tempfile, threading
+from cache import ManifestCache, record_changed_days
+from categories import category_files
+from columnar import write_day
 from helper import Helper
+from mediacounts import parse_batch
+from packed import IMAGE_SLOTS, PLAY_SLOTS, add, pack_fields, packed_key
+from queries import READ_CHUNK, batches, rollup_fields
+from storage import HashStorage, SQLiteStorage, open_storage
+from top import DayTop, delete_day_boards, merge_boards, write_day_boards
+from watched import WatchedCategories
 
 h = Helper()
+storage = open_storage(h)
+# Manifests are resolved as GetData does, but memberships are only brought up
+# to date once per MANIFEST_TTL rather than for every day stored
+watched = WatchedCategories(h, storage, ManifestCache(
+    functools.partial(category_files, h),
+    redis=h.redis if h.settings['manifest_cache'] == 'redis' else None,
+    ttl=h.settings['manifest_ttl'],
+    max_entries=h.settings['manifest_cache_size'],
+    error_log=h.error_log))
 DATE_REGEX = re.compile('^\d{8}$')
+CHUNK_SIZE = 256 * 1024
+PREFETCH_CHUNKS = 8
+PARSE_BLOCK = 10000
+# Fields summed in memory before they are sorted and spilled to a run file
+SORT_RUN = 200000
+# Days whose sorted runs may wait on disk for the backfill parent at once,
+# where workers cannot write their own days
+BACKFILL_AGGREGATES = 2
+# Stages of ingest timed in the ingest_stage_seconds histogram, in order
+STAGES = ('read', 'decompress', 'parse', 'write', 'publish')
 
 
-def download(date):
+def _dump_filename(date):
+    return 'mediacounts.{0}.v00.tsv.bz2'.format(date.format('YYYY-MM-DD'))
+
+
+def _local_dump(source, date):
     """
-    Downloads, decompresses, and parses a Mediacounts logfile from
-    dumps.wikimedia.org and stores it in memory for parsing.
-    Requires an Arrow date object.
-    Yields a parsed line
+    If `source` is a local file, returns it. If it is a local directory,
+    returns the path of the dump for `date` in it, either directly inside or in
+    a per-year subdirectory like the one on dumps.wikimedia.org. Returns None
+    for anything else, which is treated as a URL.
     """
-    root_url = 'https://dumps.wikimedia.org/other/mediacounts/daily/'
-    date_string = date.format('YYYY-MM-DD')
-    year_string = date.format('YYYY')
-    filename = 'mediacounts.{0}.v00.tsv.bz2'.format(date_string)
 
-    to_download = root_url + year_string + '/' + filename
+    if os.path.isfile(source):
+        return source
+
+    if os.path.isdir(source):
+        filename = _dump_filename(date)
+        for path in [
+                os.path.join(source, filename),
+                os.path.join(source, date.format('YYYY'), filename)
+        ]:
+            if os.path.isfile(path):
+                return path
+        message = 'No dump for ' + date.format('YYYY-MM-DD') + ' in ' + source
+        h.error_log(message)
+        raise RuntimeError(message)
+
+
+def _file_chunks(path):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def _http_chunks(url, cache_path=None):
+    """
+    Streams the compressed dump at `url`, optionally writing a copy to
+    `cache_path`. The copy is only moved into place once the transfer has
+    finished, so an interrupted download never leaves a truncated cache entry.
+    """
 
     try:
-        with open('/tmp/' + filename, 'wb') as f:
-            f.write(requests.get(to_download).content)
-        h.success_log('Downloaded: ' + to_download)
+        with requests.get(url, stream=True) as r:
+            r.raise_for_status()
+            if cache_path is None:
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    yield chunk
+            else:
+                with open(cache_path + '.part', 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+                        yield chunk
+                os.replace(cache_path + '.part', cache_path)
+        h.success_log('Downloaded: ' + url)
     except Exception as e:
-        message = 'Failed to download ' + to_download + ' - ' + str(e)
+        message = 'Failed to download ' + url + ' - ' + str(e)
         h.error_log(message)
         raise RuntimeError(message)
 
-    with bz2.open('/tmp/' + filename) as f:
-        for line in f:
-            yield line.decode('utf-8')
 
-    h.success_log('Processed ' + to_download)
+def _prefetch(chunks, depth=PREFETCH_CHUNKS):
+    """
+    Pulls items from `chunks` in a background thread, keeping at most `depth`
+    of them waiting, so that the network transfer carries on while the
+    consumer decompresses and parses. If the consumer stops early, by an
+    error or by closing this generator, the thread closes `chunks`, which
+    ends the transfer, and exits.
+    """
+
+    buffer = queue.Queue(maxsize=depth)
+    done = object()
+    stop = threading.Event()
 
+    def put(item):
+        # Waits for room in the buffer until the consumer has stopped
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fill():
+        try:
+            for chunk in chunks:
+                if not put(chunk):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        finally:
+            chunks.close()
+        put(done)
+
+    threading.Thread(target=fill, daemon=True).start()
+
+    try:
+        while True:
+            chunk = buffer.get()
+            if chunk is done:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stop.set()
 
-def parse(row):
+
+def _decompress_lines(chunks, origin):
     """
-    Takes a line from a raw, decompressed log file and returns a tuple
-    (filename, playcount)
+    Decompresses a stream of bzip2 chunks and yields the decoded lines as soon
+    as they are complete. Handles files made of several concatenated bzip2
+    streams. Raises RuntimeError if the input ends partway through a stream,
+    as a truncated file or download from `origin` does.
     """
 
-    video_regex = re.compile('.*\.(mid|ogg|ogv|wav|webm|flac|oga)')
+    decompressor = bz2.BZ2Decompressor()
+    # Whether the current decompressor has been given any input
+    started = False
+    remainder = b''
 
-    columns = row.split('\t')
-    if len(columns) < 2:  # Not a real row
-        return
-    base_name = columns[0]
-
-    for column_num, column in enumerate(columns):
-        if column == '-':
-            columns[column_num] = 0
-        elif column_num > 0:  # column 0 is the name row
-            columns[column_num] = int(column)
-
-    original = columns[3]
-    playable_transcoded = columns[4] + columns[16]
-    thumbnails = {
-        '0-399': columns[8] + columns[9],
-        '400-799': columns[10] + columns[11],
-        '800': columns[12] + columns[13]
-    }
+    for chunk in chunks:
+        h.metrics.count('ingest_bytes_total', len(chunk))
+        while chunk:
+            with h.metrics.timer('ingest_stage_seconds', stage='decompress'):
+                data = decompressor.decompress(chunk)
+            started = True
+            chunk = b''
+            if decompressor.eof:
+                chunk = decompressor.unused_data
+                decompressor = bz2.BZ2Decompressor()
+                started = False
+            if data:
+                lines = (remainder + data).split(b'\n')
+                remainder = lines.pop()
+                for line in lines:
+                    yield line.decode('utf-8') + '\n'
+
+    if started:
+        message = 'Truncated dump: ' + origin
+        h.error_log(message)
+        raise RuntimeError(message)
+
+    if remainder:
+        yield remainder.decode('utf-8')
+
+
+def download(date, source=None, cache_dir=None):
+    """
+    Streams a Mediacounts logfile for an Arrow date object and yields its
+    lines, decompressing and parsing while the transfer is still running.
+
+    `source` is the root URL to download from (dumps.wikimedia.org by default)
+    or a local dump file or directory of dumps. If `cache_dir` is given,
+    downloaded dumps are kept there and read back on later runs. Both default
+    to the MEDIACOUNTS_SOURCE and CACHE_DIR settings.
+    """
+
+    if source is None:
+        source = h.settings['mediacounts_source']
+    if cache_dir is None:
+        cache_dir = h.settings['cache_dir']
+
+    filename = _dump_filename(date)
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, filename)
+
+    origin = _local_dump(source, date)
+    if origin is None and cache_path is not None \
+    and os.path.isfile(cache_path):
+        origin = cache_path
+
+    if origin is not None:
+        chunks = _file_chunks(origin)
+    else:
+        origin = source.rstrip('/') + '/' + date.format('YYYY') + '/' + filename
+        chunks = _prefetch(_http_chunks(origin, cache_path))
+
+    # With a download, this is the time spent waiting on the network
+    chunks = h.metrics.timed_iter(chunks, 'ingest_stage_seconds', stage='read')
+    for line in _decompress_lines(chunks, origin):
+        yield line
 
-    if columns[3] + columns[4] + columns[7] + columns[16] > 0:
-        # First we must determine if this is a media file
-        components = base_name.split('/')
-        # /wikipedia/commons/x/xx/FILENAME
-        if len(components) == 6:
-            if components[1] == 'wikipedia' and components[2] == 'commons':
-                if len(components[3]) == 1 and len(components[4]) == 2:
-                    filename = urllib.parse.unquote_plus(components[5])
-                    if re.match(video_regex, filename) is not None:
-                        return (filename, original, playable_transcoded,
-                                'playable')
-                    else:
-                        return (filename, original, thumbnails, 'static')
+    h.success_log('Processed ' + origin)
+
+
+def _ssdb_key(filename):
+    """
+    We change the filename to a hash because SSDB is inexplicably fussy about
+    the keys you use.
+    """
+
+    return hashlib.sha224(filename.encode('utf-8')).hexdigest()
 
 
 def store(engine, prefix, filename, date, payload):
     """
     Stores a given `payload` in the `date` field of the `prefix`:`filename`
-    hash table in Redis.
+    hash table, through the configured storage backend. Rollups and date
+    indexes are kept up to date as with `BatchWriter`, which should be used
+    for anything more than a few fields.
+    """
+
+    writer = BatchWriter()
+    writer.add(engine, prefix, filename, date, payload)
+    writer.flush()
+
+
+class BatchWriter:
+    """
+    Buffers the increments that `store` would make and writes them out in
+    batches of `batch_size` fields, each with a single `write` to the
+    storage backend: one Redis pipeline and one SSDB command batch, or one
+    SQLite transaction. Increments to the same field are summed while
+    buffered. Call `flush` once the input is exhausted.
+
+    Unless the ROLLUPS setting is off or the backend keeps none, each daily
+    increment is also added to the month and year rollup fields of the same
+    hash: YYYYMM and YYYY for plays, YYYYMM<cohort> and YYYY<cohort> for
+    images.
+
+    With `replace`, the buffered amounts are written over the daily fields
+    instead of being added to them, and no rollups are buffered: the caller
+    publishes the day with `Storage.publish_day` once it is complete. Each
+    field must then be added once, with its total for the whole day, as
+    `_write_day` does, or a later batch would overwrite the amount an earlier
+    one wrote. `on_flush` is called after each batch has been written.
+    """
+
+    def __init__(self, batch_size=None, rollups=None, replace=False,
+                 on_flush=None):
+        if batch_size is None:
+            batch_size = h.settings['batch_size']
+        if rollups is None:
+            rollups = h.settings['rollups']
+        self.batch_size = batch_size
+        self.replace = replace
+        self.on_flush = on_flush
+        self.rollups = rollups and storage.rollups and not replace
+        self.pending = {'redis': {}, 'ssdb': {}}
+        self.size = 0
+        self.batches = 0
+        self.written = 0
+
+    def add(self, engine, prefix, filename, date, payload):
+        if engine == 'ssdb':
+            filename = _ssdb_key(filename)
+        self.add_field(engine, prefix + filename, date, payload)
+
+    def add_field(self, engine, key, date, payload):
+        """
+        Adds `payload` to the daily field `date` of `key`, plus its rollups.
+        """
+
+        self._add(engine, key, date, payload)
+        if self.rollups:
+            for field in rollup_fields(date):
+                self._add(engine, key, field, payload)
+
+        if self.size >= self.batch_size:
+            self.flush()
+
+    def _add(self, engine, key, date, payload):
+        pending = self.pending[engine]
+        field = (key, date)
+        if field in pending:
+            pending[field] += payload
+        else:
+            pending[field] = payload
+            self.size += 1
+
+    def flush(self):
+        if self.size == 0:
+            return
+
+        self.batches += 1
+
+        try:
+            with h.metrics.timer('ingest_stage_seconds', stage='write'):
+                storage.write(self.pending, replace=self.replace)
+        except Exception as e:
+            message = 'Failed to write batch {0} ({1} fields) - {2}'.format(
+                self.batches, self.size, str(e))
+            h.error_log(message)
+            raise RuntimeError(message)
+
+        h.metrics.count('ingest_fields_total', self.size)
+        self.written += self.size
+        self.pending = {'redis': {}, 'ssdb': {}}
+        self.size = 0
+
+        if self.on_flush is not None:
+            self.on_flush()
+
+
+def _parsed_blocks(lines):
+    """
+    Parses the lines of one day's logfile in blocks, yielding the
+    (playables, statics) lists from `parse_batch` for each block.
+    """
+
+    for block in batches(lines, PARSE_BLOCK):
+        yield _parse_block(block)
+
+
+def _parse_block(block):
+    h.metrics.count('ingest_lines_total', len(block))
+    with h.metrics.timer('ingest_stage_seconds', stage='parse'):
+        return parse_batch(block)
+
+
+def _sort_day(date, source, cache_dir, directory, top=None):
+    """
+    Downloads and parses one day and sums its increments per field in runs of
+    up to SORT_RUN fields, each written out sorted to a file in `directory`,
+    so that memory stays bounded however many fields the day has. Returns
+    the paths of the run files, for `_merged_fields`. The rows are also added
+    to `top`, a DayTop, if given.
+    """
+
+    runs = []
+    counts = collections.Counter()
+
+    def spill():
+        path = os.path.join(directory, 'run{0}.tsv'.format(len(runs)))
+        with open(path, 'w', encoding='utf-8') as f:
+            for (engine, key, field), amount in sorted(counts.items()):
+                f.write('{0}\t{1}\t{2}\t{3}\n'.format(engine, key, field,
+                                                     amount))
+        runs.append(path)
+        counts.clear()
+
+    lines = download(date, source=source, cache_dir=cache_dir)
+    for engine, key, field, amount in _day_increments(
+            lines, date.format('YYYYMMDD'), top):
+        counts[(engine, key, field)] += amount
+        if len(counts) >= SORT_RUN:
+            spill()
+    if len(counts) > 0 or len(runs) == 0:
+        spill()
+    return runs
+
+
+def _read_run(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            engine, key, field, amount = line.rstrip('\n').split('\t')
+            yield (engine, key, field), int(amount)
+
+
+def _merged_fields(runs):
+    """
+    Merges the run files of `_sort_day` into (engine, key, field, amount)
+    increments, one per field with its total over the whole day. Rows for
+    the same file, such as differently escaped names, add up wherever they
+    are in the dump. The fields come out sorted, so the same dump always
+    gives them in the same order.
+    """
+
+    merged = heapq.merge(*[_read_run(x) for x in runs],
+                         key=operator.itemgetter(0))
+    for field, group in itertools.groupby(merged, operator.itemgetter(0)):
+        yield field + (sum(x[1] for x in group), )
+
+
+def _write_day(date_string, fields, batch_size, checkpoints=None):
+    """
+    Writes a day's fields from `_merged_fields` with a replacing BatchWriter.
+    With `checkpoints`, the number of fields written is saved after every
+    batch, and a day that was interrupted carries on from there.
+    """
+
+    position = 0
+    if checkpoints is not None:
+        position = checkpoints['fields'].get(date_string, 0)
+
+    def checkpoint():
+        checkpoints['fields'][date_string] = position + writer.written
+        _save_checkpoints(checkpoints)
+
+    writer = BatchWriter(batch_size, replace=True,
+                         on_flush=checkpoint if checkpoints is not None
+                         else None)
+    if position > 0:
+        print('Resuming {0} after field {1}'.format(date_string, position))
+        fields = itertools.islice(fields, position, None)
+
+    for increment in fields:
+        writer.add_field(*increment)
+    writer.flush()
+    h.success_log('Stored {0} fields in {1} batches for {2}'.format(
+        writer.written, writer.batches, date_string))
+
+
+def _day_increments(lines, date_string, top=None):
+    """
+    Yields the (engine, key, field, amount) increments that the lines of one
+    day's logfile contribute. SSDB keys come out already hashed. The rows are
+    also added to `top`, a DayTop, if given.
+    """
+
+    for block in batches(lines, PARSE_BLOCK):
+        for increment in _block_increments(block, date_string, top):
+            yield increment
+
+
+def _block_increments(block, date_string, top=None):
+    """
+    `_day_increments` for one block of lines.
+    """
+
+    playables, statics = _parse_block(block)
+    if top is not None:
+        top.add_block(playables, statics)
+    for filename, originals, transcodes in playables:
+        if originals + transcodes > 0:
+            yield ('redis', 'mpc:' + filename, date_string,
+                   originals + transcodes)
+
+    # We append an integer to the date string to indicate which cohort of
+    # loads. This is because it can be stored as an integer, saving precious
+    # memory.
+    # 0 = originals
+    # 1 = 0-399
+    # 2 = 400-799
+    # 3 = 800+
+    for row in statics:
+        key = 'img:' + _ssdb_key(row[0])
+        for cohort in range(4):
+            if row[cohort + 1] > 0:
+                yield ('ssdb', key, date_string + str(cohort),
+                       row[cohort + 1])
+
+
+def _store_columnar(date, source, cache_dir):
+    """
+    Aggregates one day into per-file rows and writes them as a columnar day
+    file in COLUMNAR_DIR. Used instead of the Redis and SSDB writes when
+    STORAGE_BACKEND is 'columnar'. Returns the day's DayTop, or None, for
+    the caller to write.
+    """
+
+    rows = {}
+    date_string = date.format('YYYYMMDD')
+    top = _day_top()
+
+    lines = download(date, source=source, cache_dir=cache_dir)
+    for playables, statics in _parsed_blocks(lines):
+        if top is not None:
+            top.add_block(playables, statics)
+        for filename, originals, transcodes in playables:
+            if originals + transcodes > 0:
+                counts = rows.setdefault(filename, [0, 0, 0, 0, 0])
+                counts[0] += originals
+                counts[1] += transcodes
+        for row in statics:
+            if row[1] + row[2] + row[3] + row[4] > 0:
+                counts = rows.setdefault(row[0], [0, 0, 0, 0, 0])
+                counts[0] += row[1]
+                counts[2] += row[2]
+                counts[3] += row[3]
+                counts[4] += row[4]
+
+    with h.metrics.timer('ingest_stage_seconds', stage='write'):
+        write_day(h.settings['columnar_dir'], date_string, rows)
+    h.success_log('Stored {0} files in columnar day {1}'.format(
+        len(rows), date_string))
+    return top
+
+
+def _day_top():
+    """
+    A DayTop to collect the leaderboards of a day, or None with TOP_K 0.
+    """
+
+    if h.settings['top_k'] == 0:
+        return None
+    return DayTop(h.settings['top_k'])
+
+
+def _write_top(date_string, top):
+    """
+    Writes a day's leaderboards as collected so far; see the top module. The
+    boards are kept in Redis whatever the STORAGE_BACKEND, so a failure here
+    is logged but does not stop the day from being stored.
+    """
+
+    if top is None:
+        return
+
+    try:
+        with h.metrics.timer('ingest_stage_seconds', stage='write'):
+            pipe = h.redis.pipeline(transaction=False)
+            write_day_boards(pipe, date_string, top.boards(),
+                             h.settings['top_k'])
+            pipe.execute()
+    except Exception as e:
+        h.error_log('Failed to write the leaderboards of ' + date_string +
+                    ' - ' + str(e))
+
+
+def _merge_top(date_string, delete=False):
+    """
+    Rebuilds the week and month leaderboards of a day from its day boards,
+    after deleting the day's own boards with `delete`. Failures are logged as
+    in `_write_top`.
+    """
+
+    if h.settings['top_k'] == 0:
+        return
+
+    try:
+        pipe = h.redis.pipeline(transaction=False)
+        if delete:
+            delete_day_boards(pipe, date_string, h.settings['top_k'])
+        else:
+            merge_boards(pipe, date_string, h.settings['top_k'])
+        pipe.execute()
+    except Exception as e:
+        h.error_log('Failed to merge the leaderboards for ' + date_string +
+                    ' - ' + str(e))
+
+
+def _day_stored(date_string):
+    """
+    Follow-up work once a day is fully stored: adds it to the totals of the
+    watched categories and marks it changed for the query service's cache.
+    A failure here is logged but does not undo the day.
+    """
+
+    try:
+        watched.add_days([date_string])
+    except Exception as e:
+        h.error_log('Failed to update watched categories for ' + date_string +
+                    ' - ' + str(e))
+
+    try:
+        record_changed_days(h.redis, [date_string])
+    except Exception as e:
+        h.error_log('Failed to record the change of ' + date_string + ' - ' +
+                    str(e))
+
+
+def _load_checkpoints():
+    """
+    Reads the CHECKPOINT_FILE: the days that are completely stored, and for
+    days partly stored, how many of their fields have been written.
+    """
+
+    try:
+        with open(h.settings['checkpoint_file']) as f:
+            checkpoints = json.load(f)
+    except FileNotFoundError:
+        return {'done': [], 'fields': {}}
+
+    # Days partly stored by earlier versions, which counted lines, are
+    # written again in full
+    checkpoints.pop('lines', None)
+    checkpoints.setdefault('fields', {})
+    return checkpoints
+
+
+def _save_checkpoints(checkpoints):
+    # Written next to its final name and then renamed, so a crash never
+    # leaves a truncated checkpoint file
+    path = h.settings['checkpoint_file']
+    with open(path + '.part', 'w') as f:
+        json.dump(checkpoints, f)
+    os.replace(path + '.part', path)
+
+
+def _store_day(date, batch_size, source, cache_dir, checkpoints):
+    """
+    Sums one day's fields and writes them into the storage backend with
+    `_write_day`, after the day's leaderboards. A day that was interrupted
+    is parsed again in full, and its writing carries on after the last batch
+    written.
     """
 
-    if engine == 'redis':
-        h.redis.hincrby(prefix + filename, date, amount=payload)
-    elif engine == 'ssdb':
-        # We change the filename to a hash because SSDB is inexplicably fussy
-        # about the keys you use.
-        filename = hashlib.sha224(filename.encode('utf-8')).hexdigest()
-        h.ssdb.hincr(prefix + filename, date, payload)
+    date_string = date.format('YYYYMMDD')
+    top = _day_top()
+    with tempfile.TemporaryDirectory() as directory:
+        runs = _sort_day(date, source, cache_dir, directory, top)
+        _write_top(date_string, top)
+        _write_day(date_string, _merged_fields(runs), batch_size,
+                   checkpoints)
 
 
-def delete_file(date):
+def _publish_day(date_string, batch_size, checkpoints):
     """
-    Takes an Arrow date object and deletes the corresponding file from the /tmp
-    directory.
+    Completes a day once all of its fields are written: updates the rollups,
+    marks it done in the checkpoints and runs the follow-up work.
     """
 
-    date_string = date.format('YYYY-MM-DD')
-    filename = 'mediacounts.{0}.v00.tsv.bz2'.format(date_string)
-    os.remove('/tmp/' + filename)
+    with h.metrics.timer('ingest_stage_seconds', stage='publish'):
+        storage.publish_day(date_string, batch_size)
+        _merge_top(date_string)
+    checkpoints['fields'].pop(date_string, None)
+    checkpoints['done'] = sorted(set(checkpoints['done']) | {date_string})
+    _save_checkpoints(checkpoints)
+    _day_stored(date_string)
+    h.metrics.count('ingest_days_total', result='stored')
 
 
-def run(dates=[arrow.utcnow().replace(days=-1)]):
+def _log_stages(date_string, before):
+    """
+    With METRICS on, logs how long each stage of ingest took for one day,
+    given the stage totals from before it started, and exports the metrics.
+    """
+
+    if not h.metrics.enabled:
+        return
+
+    after = h.metrics.sums('ingest_stage_seconds')
+    times = []
+    for stage in STAGES:
+        labels = (('stage', stage), )
+        times.append('{0} {1:.2f}s'.format(
+            stage, after.get(labels, 0) - before.get(labels, 0)))
+    h.success_log('Stage times for {0}: {1}'.format(date_string,
+                                                    ', '.join(times)))
+    h.metrics.export('logprocessor')
+
+
+def run(dates=[arrow.utcnow().replace(days=-1)],
+        batch_size=None,
+        source=None,
+        cache_dir=None):
     """
     Runs through the LogProcessor for the dates specified. Dates must be Arrow
-    date objects.
+    date objects. Writes are buffered and sent in batches of `batch_size`
+    fields, defaulting to the BATCH_SIZE setting. `source` and `cache_dir` are
+    passed on to `download`.
+
+    Ingest can be stopped and run again at any point. Daily fields are set
+    rather than incremented and the rollups are recomputed once a day is
+    complete, so nothing is counted twice. Progress is saved in the
+    CHECKPOINT_FILE: days already complete are skipped, and an interrupted
+    day is parsed again and written from its last written batch on. Delete a
+    day with `delete_date` to ingest it again from scratch.
     """
 
+    if batch_size is None:
+        batch_size = h.settings['batch_size']
+
+    checkpoints = _load_checkpoints()
     for date in dates:
-        record = []
         date_string = date.format('YYYYMMDD')
+        if date_string in checkpoints['done']:
+            print('Already stored: ' + date_string)
+            continue
+
         print('Processing: ' + date_string)
-        for line in download(date):
-            line = parse(line)
-            if line is not None:
-                filename, originals, transcodes, filetype = line
-                if filetype == 'playable':
-                    if originals + transcodes > 0:
-                        store('redis', 'mpc:', filename, date_string,
-                              originals + transcodes)
-                elif filetype == 'static':
-                    # We append an integer to the date string to indicate which
-                    # cohort of loads. This is because it can be stored as an
-                    # integer, saving precious memory.
-                    # 0 = originals
-                    # 1 = 0-399
-                    # 2 = 400-799
-                    # 3 = 800+
-                    if originals > 0:
-                        store('ssdb', 'img:', filename, date_string + '0',
-                              originals)
-                    for interval, val in transcodes.items():
-                        if val > 0:
-                            if interval == '0-399':
-                                interval_code = date_string + '1'
-                            elif interval == '400-799':
-                                interval_code = date_string + '2'
-                            elif interval == '800':
-                                interval_code = date_string + '3'
-                            store('ssdb', 'img:', filename, interval_code, val)
-        delete_file(date)
-
-
-def delete_date(affected_date):
-    """
-    Deletes all values for a given date
+        before = h.metrics.sums('ingest_stage_seconds')
+        with h.metrics.timer('ingest_day_seconds'):
+            if h.settings['storage_backend'] == 'columnar':
+                _write_top(date_string,
+                           _store_columnar(date, source, cache_dir))
+            else:
+                _store_day(date, batch_size, source, cache_dir, checkpoints)
+            _publish_day(date_string, batch_size, checkpoints)
+        _log_stages(date_string, before)
+
+
+def _backfill_day(date, batch_size, source, cache_dir, directory):
+    """
+    Backfill worker: downloads, parses and sums one day into sorted runs in
+    `directory`, which it creates. Days are replaced whole, so they are
+    independent of each other; where the storage backend takes writes from
+    several processes at once, the worker writes its day itself, removes the
+    directory and returns None. Otherwise it returns the paths of the runs
+    for the parent to write. The day's DayTop and the metrics the worker
+    recorded are returned alongside, for the parent to write and merge.
+    """
+
+    # Pool workers exit without running atexit, so the logs are written out
+    # here
+    try:
+        if h.settings['storage_backend'] == 'columnar':
+            top = _store_columnar(date, source, cache_dir)
+            return (None, top, h.metrics.drain())
+
+        top = _day_top()
+        os.makedirs(directory)
+        runs = _sort_day(date, source, cache_dir, directory, top)
+        if storage.parallel_writes:
+            _write_day(date.format('YYYYMMDD'), _merged_fields(runs),
+                       batch_size)
+            shutil.rmtree(directory)
+            runs = None
+        return (runs, top, h.metrics.drain())
+    finally:
+        h.flush_logs()
+
+
+def _start_worker():
+    # A forked worker starts with a copy of what the parent had recorded,
+    # which the parent still holds
+    h.metrics.drain()
+
+
+def _backfill_pass(dates, workers, batch_size, source, cache_dir,
+                   checkpoints):
     """
+    Hands `dates` out to a pool of `workers` processes and publishes each day
+    from this process, one day at a time and in date order. Workers write
+    their own days where the backend allows it, and up to two days per worker
+    are in flight. Otherwise this process writes each day from the sorted
+    runs its worker left on disk, and only BACKFILL_AGGREGATES days are in
+    flight whatever the number of workers, so finished days cannot pile up
+    while an earlier one is still running. Returns the days that failed;
+    those are not published and are written again in full when retried.
+    """
+
+    failed = []
+    in_flight = collections.deque()
+    dates = iter(dates)
+    if storage.parallel_writes:
+        limit = workers * 2
+    else:
+        limit = BACKFILL_AGGREGATES
+
+    with multiprocessing.Pool(workers, initializer=_start_worker) as pool, \
+            tempfile.TemporaryDirectory() as spill:
+        while True:
+            while len(in_flight) < limit:
+                date = next(dates, None)
+                if date is None:
+                    break
+                directory = os.path.join(spill, date.format('YYYYMMDD'))
+                in_flight.append((date, pool.apply_async(
+                    _backfill_day,
+                    (date, batch_size, source, cache_dir, directory))))
+
+            if len(in_flight) == 0:
+                break
+
+            date, result = in_flight.popleft()
+            date_string = date.format('YYYYMMDD')
+            before = h.metrics.sums('ingest_stage_seconds')
+            try:
+                runs, top, metrics = result.get()
+            except Exception as e:
+                h.error_log('Backfill failed for ' + date_string + ' - ' +
+                            str(e))
+                h.metrics.count('ingest_days_total', result='failed')
+                print('Failed: ' + date_string)
+                failed.append(date)
+                shutil.rmtree(os.path.join(spill, date_string),
+                              ignore_errors=True)
+                continue
+            h.metrics.merge(metrics)
+
+            if runs is not None:
+                # A failed write stops the backfill. The day is rewritten in
+                # full when the backfill is run again.
+                _write_day(date_string, _merged_fields(runs), batch_size)
+                shutil.rmtree(os.path.join(spill, date_string))
+            _write_top(date_string, top)
+            _publish_day(date_string, batch_size, checkpoints)
+            _log_stages(date_string, before)
+            print('Stored: ' + date_string)
+
+    return failed
+
+
+def backfill(dates,
+             workers=None,
+             retries=0,
+             batch_size=None,
+             source=None,
+             cache_dir=None):
+    """
+    Processes many days in parallel: each day is downloaded, parsed and
+    summed in a worker process, which also writes it where the storage
+    backend allows, and the days are published in date order by this
+    process. Days that fail are retried up to `retries` more times
+    and the ones that still fail are written to the FAILED_DAYS file, which
+    `LogProcessor.py retry` reads back. Returns the list of failed days.
+
+    Days are written the same way as by `run`, and the ones the CHECKPOINT_FILE
+    lists as complete are skipped, so an interrupted backfill can simply be
+    started again.
+    """
+
+    if workers is None:
+        workers = os.cpu_count()
+    if batch_size is None:
+        batch_size = h.settings['batch_size']
+
+    checkpoints = _load_checkpoints()
+    done = set(checkpoints['done'])
+    failed = [x for x in dates if x.format('YYYYMMDD') not in done]
+    for attempt in range(retries + 1):
+        failed = _backfill_pass(failed, workers, batch_size, source,
+                                cache_dir, checkpoints)
+        if len(failed) == 0:
+            break
+
+    with open(h.settings['failed_days'], 'w') as f:
+        for date in failed:
+            f.write(date.format('YYYYMMDD') + '\n')
+
+    if len(failed) > 0:
+        h.error_log('Backfill finished with {0} failed days'.format(
+            len(failed)))
+    else:
+        h.success_log('Backfill finished')
+
+    return failed
+
+
+def _key_name(key):
+    return key.decode('utf-8') if isinstance(key, bytes) else key
+
+
+def delete_date(affected_date, batch_size=None):
+    """
+    Deletes all values for a given date from the storage backend, in batches
+    of `batch_size` keys where it works key by key. The deleted counts are
+    taken off the month and year rollups, where those exist. See the
+    `delete_date` method of each backend in the storage module.
+    """
+
+    if batch_size is None:
+        batch_size = h.settings['batch_size']
 
     date_string = affected_date.format('YYYYMMDD')
 
     try:
-        for entry in h.redis.keys('mpc:*'):
-            h.redis.hdel(entry, date_string)
-        h.success_log('Deleted entries for: ' + date_string)
+        storage.delete_date(date_string, batch_size)
+        # Straight after the delete, so that the day is ingested again even
+        # if the bookkeeping below fails
+        checkpoints = _load_checkpoints()
+        if date_string in checkpoints['done']:
+            checkpoints['done'].remove(date_string)
+        checkpoints['fields'].pop(date_string, None)
+        _save_checkpoints(checkpoints)
     except Exception as e:
         message = 'Failed to delete entries for ' + date_string + ': ' + str(e)
         h.error_log(message)
         raise e
 
+    h.success_log('Deleted entries for: ' + date_string)
+    _day_deleted(date_string)
+
+
+def _day_deleted(date_string):
+    """
+    Follow-up work once a day is deleted, the reverse of `_day_stored`:
+    drops it from the totals of the watched categories, rebuilds the
+    leaderboards without it and marks it changed for the query service's
+    cache. A failure here is logged but does not undo the delete.
+    """
+
+    try:
+        watched.drop_days([date_string])
+    except Exception as e:
+        h.error_log('Failed to update watched categories for ' + date_string +
+                    ' - ' + str(e))
+
+    _merge_top(date_string, delete=True)
+
+    try:
+        record_changed_days(h.redis, [date_string])
+    except Exception as e:
+        h.error_log('Failed to record the change of ' + date_string + ' - ' +
+                    str(e))
+
+
+def _rollups_from(fields, day_length):
+    """
+    Sums a hash's daily fields, those `day_length` characters long, into its
+    month and year rollup fields.
+    """
+
+    rollups = collections.Counter()
+    for field, count in fields.items():
+        if len(field) == day_length:
+            for rollup in rollup_fields(field):
+                rollups[rollup] += count
+    return rollups
+
+
+def rebuild_rollups(batch_size=None):
+    """
+    Recomputes every month and year rollup from the daily fields, for data
+    ingested before rollups were kept or after they were turned back on.
+    Totals are summed from the daily fields until this has finished; see
+    `Storage.rollups_built`. Stop ingestion while it runs.
+    """
+
+    if batch_size is None:
+        batch_size = h.settings['batch_size']
+
+    if not storage.rollups:
+        print('Rollups are off or not kept by the storage backend')
+        return
+
+    if isinstance(storage, SQLiteStorage):
+        storage.rebuild_rollups()
+        h.success_log('Rebuilt rollups')
+        return
+
+    rebuilt = 0
+    for keys in batches(h.redis.scan_iter(match='mpc:*', count=batch_size),
+                         batch_size):
+        pipe = h.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        values = pipe.execute()
+
+        pipe = h.redis.pipeline(transaction=False)
+        for key, fields in zip(keys, values):
+            fields = {
+                field.decode('utf-8'): int(count)
+                for field, count in fields.items()
+            }
+            rollups = _rollups_from(fields, 8)
+            if len(rollups) > 0:
+                pipe.hset(key, mapping=rollups)
+            stale = [x for x in fields if len(x) < 8 and x not in rollups]
+            if len(stale) > 0:
+                pipe.hdel(key, *stale)
+        pipe.execute()
+
+        rebuilt += len(keys)
+        print('Redis: rebuilt rollups for {0} keys'.format(rebuilt))
+
+    rebuilt = 0
+    hashes = HashStorage(h)
+    for keys in batches(hashes.ssdb_hash_names(batch_size), batch_size):
+        values = h.ssdb_batch([('hgetall', key) for key in keys])
+
+        commands = []
+        for key, fields in zip(keys, values):
+            fields = {
+                fields[n].decode('utf-8'): int(fields[n + 1])
+                for n in range(0, len(fields), 2)
+            }
+            rollups = _rollups_from(fields, 9)
+            if len(rollups) > 0:
+                command = ['multi_hset', key]
+                for field, count in rollups.items():
+                    command += [field, count]
+                commands.append(tuple(command))
+            stale = [x for x in fields if len(x) < 9 and x not in rollups]
+            if len(stale) > 0:
+                commands.append(('multi_hdel', key) + tuple(stale))
+        if len(commands) > 0:
+            h.ssdb_batch(commands)
+
+        rebuilt += len(keys)
+        print('SSDB: rebuilt rollups for {0} keys'.format(rebuilt))
+
+    storage.mark_rollups_built()
+    h.success_log('Rebuilt rollups')
+
+
+def trim_indexes():
+    """
+    Drops the per-date key indexes of days more than INDEX_DAYS old, finding
+    them with a SCAN. Ingest drops them as it goes; this is for the indexes
+    of data stored before it did.
+    """
+
+    if not isinstance(storage, HashStorage):
+        print('The storage backend keeps no date indexes')
+        return
+
+    storage.trim_indexes(scan=True)
+    h.success_log('Trimmed date indexes')
+
+
+def _decode_fields(fields):
+    """
+    Decodes a Redis HGETALL reply or a flat SSDB hgetall reply.
+    """
+
+    if isinstance(fields, dict):
+        fields = [x for pair in fields.items() for x in pair]
+    return {
+        fields[n].decode('utf-8'): int(fields[n + 1])
+        for n in range(0, len(fields), 2)
+    }
+
+
+def pack(batch_size=None):
+    """
+    Converts the mpc: and img: hashes to the packed encoding and deletes
+    them. Packed data already stored is added to, so this can be run again
+    after an interruption. Stop ingestion while it runs, and set
+    STORAGE_BACKEND to 'packed' once it has finished.
+    """
+
+    if batch_size is None:
+        batch_size = h.settings['batch_size']
+
+    packed = 0
+    for keys in batches(h.redis.scan_iter(match='mpc:*', count=batch_size),
+                         batch_size):
+        keys = [_key_name(key) for key in keys]
+        pipe = h.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        arrays = {}
+        for key, fields in zip(keys, pipe.execute()):
+            for year, data in pack_fields(_decode_fields(fields),
+                                          PLAY_SLOTS).items():
+                arrays[packed_key(key, year)] = data
+
+        targets = sorted(arrays)
+        current = h.redis.mget(targets) if len(targets) > 0 else []
+
+        # Each batch is written and its hashes deleted in one transaction, so
+        # an interrupted run never counts a hash twice
+        pipe = h.redis.pipeline()
+        for key, existing in zip(targets, current):
+            pipe.set(key, add(arrays[key], existing or b''))
+        pipe.delete(*keys)
+        pipe.execute()
+
+        packed += len(keys)
+        print('Redis: packed {0} keys'.format(packed))
+
+    packed = 0
+    hashes = HashStorage(h)
+    for keys in batches(hashes.ssdb_hash_names(batch_size), batch_size):
+        keys = [_key_name(key) for key in keys]
+        values = h.ssdb_batch([('hgetall', key) for key in keys])
+        arrays = {}
+        for key, fields in zip(keys, values):
+            for year, data in pack_fields(_decode_fields(fields or []),
+                                          IMAGE_SLOTS).items():
+                arrays[packed_key(key, year)] = data
+
+        current = {}
+        for chunk in batches(sorted(arrays), READ_CHUNK):
+            reply = h.ssdb_batch([('multi_get', ) + tuple(chunk)])[0] or []
+            for n in range(0, len(reply), 2):
+                current[reply[n].decode('utf-8')] = reply[n + 1]
+
+        commands = []
+        for chunk in batches(sorted(arrays), READ_CHUNK):
+            command = ['multi_set']
+            for key in chunk:
+                command += [key, add(arrays[key], current.get(key, b''))]
+            commands.append(tuple(command))
+        commands += [('hclear', key) for key in keys]
+        h.ssdb_batch(commands)
+
+        packed += len(keys)
+        print('SSDB: packed {0} keys'.format(packed))
+
+    h.success_log('Packed daily counts')
+
+
+def _redis_memory(keys):
+    """
+    Returns the memory Redis reports for each key, or None if the server has
+    no MEMORY USAGE.
+    """
+
+    pipe = h.redis.pipeline(transaction=False)
+    for key in keys:
+        pipe.memory_usage(key)
+    try:
+        return pipe.execute()
+    except redis.exceptions.ResponseError:
+        return None
+
+
+def _ssdb_hash_bytes(name, fields):
+    # SSDB stores every hash field as its own record, keyed by the hash name
+    # and the field
+    return sum(
+        len(name) + len(field) + len(str(value)) + 3
+        for field, value in fields.items())
+
+
+def _report_line(label, keys, sample, before, after):
+    if sample == 0:
+        return '{0}: no keys to pack'.format(label)
+    estimate = (before - after) / sample * keys
+    return ('{0}: {1} keys; sampled {2}: {3:.0f} bytes per key now, {4:.0f} '
+            'packed ({5:.0%} less); about {6:.1f} MB saved in all').format(
+                label, keys, sample, before / sample, after / sample,
+                1 - after / before, estimate / 1024 / 1024)
+
+
+def pack_report(sample=1000, batch_size=None):
+    """
+    Estimates the memory the packed encoding saves. Packs a sample of up to
+    `sample` hashes of each kind in memory and compares sizes: MEMORY USAGE
+    for Redis where the server supports it, stored bytes for SSDB. Also
+    counts the keys already packed. Prints the report and logs it.
+    """
+
+    if batch_size is None:
+        batch_size = h.settings['batch_size']
+
+    lines = []
+
+    keys = 0
+    sampled = []
+    for key in h.redis.scan_iter(match='mpc:*', count=batch_size):
+        keys += 1
+        if len(sampled) < sample:
+            sampled.append(_key_name(key))
+    pipe = h.redis.pipeline(transaction=False)
+    for key in sampled:
+        pipe.hgetall(key)
+    hashes = pipe.execute()
+    arrays = []
+    for key, fields in zip(sampled, hashes):
+        for year, data in pack_fields(_decode_fields(fields),
+                                      PLAY_SLOTS).items():
+            arrays.append((packed_key(key, year), data))
+
+    before = _redis_memory(sampled)
+    if before is not None and len(arrays) > 0:
+        # Measure the packed strings the same way, under scratch keys
+        scratch = ['packreport:{0}'.format(n) for n in range(len(arrays))]
+        h.redis.mset({x: data for x, (key, data) in zip(scratch, arrays)})
+        after = _redis_memory(scratch)
+        h.redis.delete(*scratch)
+        before, after = sum(before), sum(after)
+    else:
+        # No MEMORY USAGE: compare the bytes of the keys, fields and values
+        before = sum(
+            len(key) + sum(len(x) + len(y) for x, y in fields.items())
+            for key, fields in zip(sampled, hashes))
+        after = sum(len(key) + len(data) for key, data in arrays)
+    lines.append(
+        _report_line('Redis mpc: hashes', keys, len(sampled), before, after))
+
+    keys = 0
+    sampled = []
+    for key in HashStorage(h).ssdb_hash_names(batch_size):
+        keys += 1
+        if len(sampled) < sample:
+            sampled.append(_key_name(key))
+    before = 0
+    after = 0
+    for chunk in batches(sampled, READ_CHUNK):
+        values = h.ssdb_batch([('hgetall', key) for key in chunk])
+        for key, fields in zip(chunk, values):
+            fields = _decode_fields(fields or [])
+            before += _ssdb_hash_bytes(key, fields)
+            for year, data in pack_fields(fields, IMAGE_SLOTS).items():
+                after += len(packed_key(key, year)) + len(data)
+    lines.append(
+        _report_line('SSDB img: hashes', keys, len(sampled), before, after))
+
+    packed = sum(1 for key in h.redis.scan_iter(match='mpcy:*',
+                                                count=batch_size))
+    lines.append('Already packed: {0} Redis mpcy: keys'.format(packed))
+
+    for line in lines:
+        print(line)
+        h.success_log(line)
+
 
 def process_args(args):
     """
@@ -172,23 +1214,43 @@ def process_args(args):
 
     elif len(args) == 1:
         # One argument: add data for the specified day.
-        # Unless that argument is "initial"
+        # Unless that argument is "initial", "retry", "rollup", "trim" or
+        # "pack"
 
         if args[0] == 'initial':
             date_range = h.date_ranger(start_date='20150101')
-            run(date_range)
+            backfill(date_range)
+
+        elif args[0] == 'retry':
+            with open(h.settings['failed_days']) as f:
+                days = [arrow.get(line.strip(), 'YYYYMMDD') for line in f
+                        if line.strip() != '']
+            backfill(days)
+
+        elif args[0] == 'rollup':
+            rebuild_rollups()
+
+        elif args[0] == 'trim':
+            trim_indexes()
+
+        elif args[0] == 'pack':
+            pack()
 
         elif re.match(DATE_REGEX, args[0]) is None:
             raise ValueError('Invalid input: ' + args[0])
 
-        day = [arrow.get(args[0], 'YYYYMMDD')]
-        run(dates=day)
+        else:
+            day = [arrow.get(args[0], 'YYYYMMDD')]
+            run(dates=day)
 
     elif len(args) == 2:
         # Two arguments: add data for the given date range
-        # Unless the first word is "delete"
+        # Unless the first word is "delete", or the words are "pack report"
 
-        if args[0] == 'delete':
+        if args == ['pack', 'report']:
+            pack_report()
+
+        elif args[0] == 'delete':
             if re.match(DATE_REGEX, args[1]) is None:
                 raise ValueError('Invalid input: ' + args[1])
 
@@ -205,7 +1267,7 @@ def process_args(args):
                     'The first date must be before the second date')
 
             date_range = h.date_ranger(start_date=args[0], end_date=args[1])
-            run(dates=date_range)
+            backfill(date_range)
 
     else:
         raise RuntimeError('You put down too many parameters, dude')
@@ -213,4 +1275,7 @@ def process_args(args):
 
 if __name__ == '__main__':
     args = sys.argv[1:]
-    process_args(args)
+    try:
+        process_args(args)
+    finally:
+        h.metrics.export('logprocessor')
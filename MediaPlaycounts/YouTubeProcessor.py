@@ -1,10 +1,40 @@
-import arrow, mwparserfromhell, pywikibot, requests
+import arrow, random, re, requests, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from helper import Helper
-from pprint import pprint
+from itertools import islice
+from queries import (READ_CHUNK, chunks, legacy_youtube_snapshots,
+                     youtube_member, youtube_snapshot)
+
+# Only needed to read File pages in `resolve_video_ids`
+try:
+    import pywikibot
+    from pywikibot import pagegenerators
+except ImportError:
+    pywikibot = pagegenerators = None
 
 h = Helper()
-s = requests.Session()
-site = pywikibot.Site()
+sessions = threading.local()
+# The Commons site for pywikibot; see `_site`
+site = None
+
+# The videos endpoint takes up to 50 comma-separated IDs per request, and
+# every request costs one unit of the daily quota however many IDs it has.
+YOUTUBE_BATCH = 50
+
+# Worth another try after a pause; anything else is a problem with the request
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+RETRY_REASONS = ['rateLimitExceeded', 'userRateLimitExceeded', 'backendError']
+QUOTA_REASONS = ['quotaExceeded', 'dailyLimitExceeded']
+
+# Start of a {{From YouTube}} transclusion, in any of the ways wikitext allows
+# it to be written. Its parameters follow the match.
+FROM_YOUTUBE = re.compile(
+    r'\{\{\s*(?:template\s*:\s*)?from[ _]+youtube\s*(?=\||\}\})',
+    re.IGNORECASE)
+# What separates and nests template parameters
+TEMPLATE_TOKENS = re.compile(r'\{\{|\}\}|\[\[|\]\]|\||=')
+# A parameter value that is more wikitext rather than a plain ID
+WIKITEXT = re.compile(r'[{}\[\]<>|]')
 
 
 def _get_manifest():
@@ -17,69 +47,388 @@ def _get_manifest():
     return [x[0].decode('utf-8') for x in h.query_commons(q, None)]
 
 
-def _get_video_id(file):
-    cached = h.redis.get('com2yt:' + file)
-    if cached is not None:
-        return cached.decode('utf-8')
-    else:
-        page = pywikibot.Page(site, 'File:' + file)
-        parsed = mwparserfromhell.parse(page.text)
-        templates = parsed.filter_templates()
-        for template in templates:
-            if template.name == 'From YouTube':
-                try:
-                    ret = str(template.get(1).value)
-                    h.redis.set('com2yt:' + file, ret)
-                    return ret
-                except:
-                    return None
-
-
-def _get_youtube_data(video_id):
+def _site():
+    """
+    The pywikibot Site for Commons, created on first use rather than at
+    import, since creating it reads the pywikibot configuration and may log
+    in.
+    """
+
+    global site
+    if site is None:
+        if pywikibot is None:
+            raise RuntimeError('pywikibot is needed to read File pages')
+        site = pywikibot.Site()
+    return site
+
+
+def _template_params(text, start):
+    """
+    Splits the parameters of a template whose name ends at `start` into
+    (name, value) pairs, name None for positional ones. Pipes and equals signs
+    inside nested templates and links are part of the value, as MediaWiki
+    reads them. Returns None if the template is not closed.
+    """
+
+    params = []
+    depth = 0
+    name = None
+    last = start
+    for token in TEMPLATE_TOKENS.finditer(text, start):
+        if token.group() in ('{{', '[['):
+            depth += 1
+        elif token.group() == ']]' or (token.group() == '}}' and depth > 0):
+            depth = max(depth - 1, 0)
+        elif depth > 0:
+            continue
+        elif token.group() == '=':
+            if name is None:
+                name = text[last:token.start()]
+                last = token.end()
+        else:
+            params.append((name, text[last:token.start()]))
+            name = None
+            last = token.end()
+            if token.group() == '}}':
+                # The first "parameter" is what came before the first pipe
+                return params[1:]
+    return None
+
+
+def parse_video_id(text):
+    """
+    Returns the video ID given to the first {{From YouTube}} template in a
+    page's wikitext, as its first positional parameter or as 1= or id=, or
+    None. Values that are themselves wikitext, such as nested templates, are
+    not IDs. Only the template's own parameters are looked at, so the rest of
+    the page is never parsed.
+    """
+
+    match = FROM_YOUTUBE.search(text)
+    if match is None:
+        return None
+
+    params = _template_params(text, match.end())
+    if params is None:
+        return None
+
+    positional = 0
+    for name, value in params:
+        if name is None:
+            positional += 1
+            if positional > 1:
+                continue
+        elif name.strip() not in ('1', 'id'):
+            continue
+        value = value.strip()
+        if value == '' or WIKITEXT.search(value) is not None:
+            return None
+        return value
+
+
+def _cached_video_ids(files):
+    """
+    Looks up files in com2yt: and in the com2ytmissing set of files known to
+    have no video ID, with one pipeline per READ_CHUNK files. Returns the IDs
+    found and the files that still need their page read. Misses older than
+    YOUTUBE_MISSING_TTL are read again, in case the page was fixed since.
+    """
+
+    cutoff = time.time() - h.settings['youtube_missing_ttl']
+    video_ids = {}
+    uncached = []
+
+    for chunk in chunks(files, READ_CHUNK):
+        pipe = h.redis.pipeline(transaction=False)
+        for file in chunk:
+            pipe.get('com2yt:' + file)
+            pipe.zscore('com2ytmissing', file)
+        replies = pipe.execute()
+
+        for file, video_id, missing in zip(chunk, replies[0::2],
+                                           replies[1::2]):
+            if video_id is not None:
+                video_ids[file] = video_id.decode('utf-8')
+            elif missing is None or missing < cutoff:
+                uncached.append(file)
+
+    return video_ids, uncached
+
+
+def _store_video_ids(resolved):
+    """
+    Writes a block of resolved files with one pipeline: the ID to com2yt:, or
+    the time of the miss to com2ytmissing.
+    """
+
+    now = time.time()
+    pipe = h.redis.pipeline(transaction=False)
+    for file, video_id in resolved:
+        if video_id is None:
+            pipe.zadd('com2ytmissing', {file: now})
+        else:
+            pipe.set('com2yt:' + file, video_id)
+            pipe.zrem('com2ytmissing', file)
+    pipe.execute()
+
+
+def resolve_video_ids(files):
+    """
+    Returns a dict of file to YouTube video ID for the files that have one.
+    Files not cached in Redis have their wikitext fetched YOUTUBE_PRELOAD
+    pages per API request, and the results, hits and misses alike, are cached
+    in bulk as they come in.
+    """
+
+    video_ids, uncached = _cached_video_ids(files)
+    if len(uncached) == 0:
+        return video_ids
+
+    commons = _site()
+    pages = (pywikibot.Page(commons, 'File:' + file) for file in uncached)
+    resolved = []
+    for page in pagegenerators.PreloadingGenerator(
+            pages, groupsize=h.settings['youtube_preload']):
+        file = page.title(underscore=True, with_ns=False)
+        video_id = parse_video_id(page.text) if page.exists() else None
+        resolved.append((file, video_id))
+        if video_id is not None:
+            video_ids[file] = video_id
+
+        if len(resolved) >= READ_CHUNK:
+            _store_video_ids(resolved)
+            resolved = []
+
+    if len(resolved) > 0:
+        _store_video_ids(resolved)
+
+    return video_ids
+
+
+def _session():
+    # One session per fetcher thread; sessions are not safe to share
+    if not hasattr(sessions, 'session'):
+        sessions.session = requests.Session()
+    return sessions.session
+
+
+def _quota_key():
+    # The API's daily quota resets at midnight Pacific time
+    return 'ytquota:' + arrow.utcnow().to('US/Pacific').format('YYYYMMDD')
+
+
+def _spend_quota(units=1):
+    """
+    Records quota units about to be spent in Redis, so that every run on the
+    same day shares the YOUTUBE_QUOTA budget. Raises once it is used up.
+    """
+
+    key = _quota_key()
+    pipe = h.redis.pipeline()
+    pipe.incrby(key, units)
+    pipe.expire(key, 2 * 24 * 60 * 60)
+    used = pipe.execute()[0]
+
+    if used > h.settings['youtube_quota']:
+        h.redis.decrby(key, units)
+        message = 'YouTube quota of {0} units for today is used up'.format(
+            h.settings['youtube_quota'])
+        h.error_log(message)
+        raise RuntimeError(message)
+
+
+def quota_used():
+    used = h.redis.get(_quota_key())
+    return 0 if used is None else int(used)
+
+
+def _error_reasons(response):
+    try:
+        errors = response.json()['error']['errors']
+        return [error.get('reason') for error in errors]
+    except Exception:
+        return []
+
+
+def _get_youtube_data(video_ids):
+    """
+    Fetches the view counts of up to YOUTUBE_BATCH videos with one request,
+    retrying with exponential backoff on rate limiting, server errors and
+    network failures. Returns ({video_id: view_count}, timestamp); videos that
+    are gone or private are missing from the dict. Returns None if the batch
+    still failed after YOUTUBE_RETRIES retries, and raises if the daily quota
+    runs out.
+    """
+
     params = {
         'part': 'statistics',
-        'id': video_id,
+        'id': ','.join(video_ids),
+        'maxResults': YOUTUBE_BATCH,
         'key': h.settings['google_api']
     }
+    retries = h.settings['youtube_retries']
+    backoff = h.settings['youtube_backoff']
 
-    try:
-        r = s.get(
-            'https://www.googleapis.com/youtube/v3/videos', params=params)
-        timestamp = arrow.utcnow().format('YYYYMMDDHHmmss')
-        r = r.json()
+    for attempt in range(retries + 1):
+        _spend_quota()
         try:
-            return (r['items'][0]['statistics']['viewCount'], timestamp)
-        except:
-            return (None, timestamp)
-    except Exception as e:
-        pprint(r)
-        h.error_log('YouTube Processor choked on: ' + video_id)
-        raise e
+            r = _session().get(
+                h.settings['youtube_api_url'], params=params, timeout=60)
+        except requests.RequestException as e:
+            error = str(e)
+        else:
+            if r.status_code == 200:
+                timestamp = arrow.utcnow().format('YYYYMMDDHHmmss')
+                counts = {}
+                for item in r.json().get('items', []):
+                    if 'viewCount' in item.get('statistics', {}):
+                        counts[item['id']] = item['statistics']['viewCount']
+                return (counts, timestamp)
+
+            reasons = _error_reasons(r)
+            error = 'HTTP {0} {1}'.format(r.status_code, ', '.join(
+                str(x) for x in reasons))
+            if any(x in QUOTA_REASONS for x in reasons):
+                message = 'YouTube API quota exceeded: ' + error
+                h.error_log(message)
+                raise RuntimeError(message)
+            if r.status_code not in RETRY_STATUSES \
+            and not any(x in RETRY_REASONS for x in reasons):
+                break
+
+        if attempt < retries:
+            time.sleep(backoff * 2**attempt + random.uniform(0, backoff))
+
+    h.error_log('YouTube Processor gave up on {0} videos starting with {1}: '
+                '{2}'.format(len(video_ids), video_ids[0], error))
+    return None
+
+
+# Snapshots are kept per video in a sorted set, ytts:<video id>, scored by
+# their YYYYMMDDHHmmss timestamp so that a date range is a single range query.
+# Members are "timestamp:count". The latest snapshot of every video is also
+# kept in the ytlatest hash, so the current count is one lookup. Old-style
+# youtube:<video id> hashes are still read until `migrate` converts them.
+
+
+def _store_in_redis(counts, timestamp):
+    """
+    Writes the snapshots of a whole batch with one pipeline.
+    """
+
+    pipe = h.redis.pipeline(transaction=False)
+    for video_id, view_count in counts.items():
+        member = youtube_member(timestamp, view_count)
+        pipe.zremrangebyscore('ytts:' + video_id, timestamp, timestamp)
+        pipe.zadd('ytts:' + video_id, {member: int(timestamp)})
+        pipe.hset('ytlatest', video_id, member)
+    pipe.execute()
+
+
+def migrate(batch_size=1000):
+    """
+    Converts every youtube:<video id> hash into the ytts: sorted set and the
+    ytlatest pointer, merging with snapshots already stored the new way, then
+    deletes the hash. Safe to interrupt and run again.
+    """
+
+    migrated = 0
+    keys = h.redis.scan_iter(match='youtube:*', count=batch_size)
+    while True:
+        batch = [key.decode('utf-8') for key in islice(keys, batch_size)]
+        if len(batch) == 0:
+            break
 
+        pipe = h.redis.pipeline(transaction=False)
+        for key in batch:
+            pipe.hgetall(key)
+            pipe.hget('ytlatest', key[len('youtube:'):])
+        replies = pipe.execute()
 
-def _store_in_redis(video_id, timestamp, view_count):
-    h.redis.hset('youtube:' + video_id, timestamp, view_count)
+        pipe = h.redis.pipeline()
+        for key, play_counts, latest in zip(batch, replies[0::2],
+                                            replies[1::2]):
+            video_id = key[len('youtube:'):]
+            snapshots = legacy_youtube_snapshots(play_counts)
+            if len(snapshots) > 0:
+                pipe.zadd('ytts:' + video_id, {
+                    youtube_member(timestamp, count): int(timestamp)
+                    for timestamp, count in snapshots
+                })
+                newest = snapshots[-1]
+                if latest is None or youtube_snapshot(latest)[0] < newest[0]:
+                    pipe.hset('ytlatest', video_id, youtube_member(*newest))
+            pipe.delete(key)
+        pipe.execute()
+
+        migrated += len(batch)
+        print('Migrated ' + str(migrated) + ' videos')
+
+    h.success_log('Migrated ' + str(migrated) + ' YouTube snapshot hashes')
+
+
+def fetch_statistics(video_ids, workers=None):
+    """
+    Takes a snapshot of the view counts of the given videos: YOUTUBE_BATCH IDs
+    per request, with up to `workers` requests in flight. Batches are stored
+    as they come back. Returns (videos stored, batches that failed).
+    """
+
+    if workers is None:
+        workers = h.settings['youtube_workers']
+
+    video_ids = sorted(set(video_ids))
+    stored = 0
+    failed = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_get_youtube_data, batch)
+            for batch in chunks(video_ids, YOUTUBE_BATCH)
+        ]
+        try:
+            for future in as_completed(futures):
+                result = future.result()
+                if result is None:
+                    failed += 1
+                    continue
+                counts, timestamp = result
+                _store_in_redis(counts, timestamp)
+                stored += len(counts)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    return (stored, failed)
 
 
 def run():
     manifest = _get_manifest()
-    processed = 0
-    for file in manifest:
-        print('Processing: ' + file)
-        try:
-            video_id = _get_video_id(file)
-            if video_id is not None:
-                view_count, timestamp = _get_youtube_data(video_id)
-                if view_count is not None:
-                    _store_in_redis(video_id, timestamp, view_count)
-                    processed += 1
-        except Exception as e:
-            h.error_log(str(e))
-            raise e
-        finally:
-            log_msg = 'Processed ' + str(processed) + ' YouTube videos'
-            h.success_log(log_msg)
+    print('Resolving video IDs for ' + str(len(manifest)) + ' files')
+    try:
+        video_ids = resolve_video_ids(manifest)
+    except Exception as e:
+        h.error_log(str(e))
+        raise e
+
+    try:
+        processed, failed = fetch_statistics(video_ids.values())
+    except Exception as e:
+        h.error_log(str(e))
+        raise e
+
+    log_msg = 'Processed ' + str(processed) + ' YouTube videos'
+    if failed > 0:
+        log_msg += ', ' + str(failed) + ' batches failed'
+    log_msg += ' (' + str(quota_used()) + ' quota units used today)'
+    h.success_log(log_msg)
 
 
 if __name__ == '__main__':
-    run()
+    # With "migrate", converts stored snapshots to the time-indexed layout
+    # instead of taking a new snapshot.
+    if sys.argv[1:] == ['migrate']:
+        migrate()
+    else:
+        run()
@@ -0,0 +1,211 @@
+import re, threading, time, zlib
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    In-process cache holding up to `max_entries` values, each with its own
+    expiry time. The least recently used entry is evicted first.
+    """
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key: (expires, value)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            expires, value = self.entries[key]
+            if expires <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, match=None):
+        """
+        Deletes the keys for which `match(key)` is true, or everything.
+        """
+
+        with self.lock:
+            if match is None:
+                self.entries.clear()
+            else:
+                for key in [x for x in self.entries if match(x)]:
+                    del self.entries[key]
+
+
+class ManifestCache:
+    """
+    Caches category manifests, the sorted file lists built by `build(category,
+    depth, mode)`, for `ttl` seconds. Entries live in Redis under
+    manifest:<mode>:<depth>:<category> when a Redis client is given, so that
+    every process shares them, and in a local LRUCache otherwise. A `ttl` of 0
+    turns caching off. Failed background refreshes are passed to `error_log`.
+    """
+
+    def __init__(self,
+                 build,
+                 redis=None,
+                 ttl=3600,
+                 max_entries=128,
+                 error_log=None):
+        self.build = build
+        self.error_log = error_log
+        self.redis = redis
+        self.ttl = ttl
+        self.local = LRUCache(max_entries)
+        self.refresher = None
+
+    def get(self, category, depth, mode='playable'):
+        if self.ttl <= 0:
+            return self.build(category, depth, mode=mode)
+
+        key = manifest_key(category, depth, mode)
+        if self.redis is not None:
+            cached = self.redis.get(key)
+            if cached is not None:
+                cached = zlib.decompress(cached).decode('utf-8')
+                return cached.split('\n') if cached != '' else []
+        else:
+            cached = self.local.get(key)
+            if cached is not None:
+                return cached
+
+        return self.refresh(category, depth, mode)
+
+    def refresh(self, category, depth, mode='playable'):
+        """
+        Rebuilds a manifest from the database and stores it, whether or not
+        the cached copy has expired. Returns the new manifest.
+        """
+
+        manifest = self.build(category, depth, mode=mode)
+        if self.ttl <= 0:
+            return manifest
+
+        key = manifest_key(category, depth, mode)
+        if self.redis is not None:
+            self.redis.setex(key, self.ttl,
+                             zlib.compress('\n'.join(manifest).encode('utf-8')))
+        else:
+            self.local.set(key, manifest, self.ttl)
+        return manifest
+
+    def invalidate(self, category=None, depth=None, mode=None):
+        """
+        Drops cached manifests. Any of the arguments left as None matches
+        every value, so `invalidate()` empties the cache and
+        `invalidate('Foo')` drops every depth and mode of Category:Foo.
+        """
+
+        pattern = manifest_key(
+            '*' if category is None else _escape_glob(category),
+            '*' if depth is None else depth, '*' if mode is None else mode)
+
+        if self.redis is not None:
+            for key in self.redis.scan_iter(match=pattern, count=1000):
+                self.redis.delete(key)
+        else:
+            regex = re.compile(_glob_to_regex(pattern))
+            self.local.delete(lambda key: regex.match(key) is not None)
+
+    def refresh_in_background(self, entries, interval):
+        """
+        Starts a daemon thread that refreshes the given (category, depth,
+        mode) entries every `interval` seconds, so that requests for hot
+        categories never wait on the database. Keep `interval` below the TTL.
+        Returns a threading.Event; set it to stop the thread.
+        """
+
+        stop = threading.Event()
+
+        def loop():
+            while not stop.is_set():
+                for category, depth, mode in entries:
+                    if stop.is_set():
+                        break
+                    try:
+                        self.refresh(category, depth, mode)
+                    except Exception as e:
+                        # Keep serving the previous copy; try again next round
+                        if self.error_log is not None:
+                            self.error_log('Failed to refresh manifest for ' +
+                                           category + ' - ' + str(e))
+                stop.wait(interval)
+
+        self.refresher = threading.Thread(target=loop, daemon=True)
+        self.refresher.start()
+        return stop
+
+
+# Days whose counts changed, for services caching GetData's results:
+#
+#   changes       counter, incremented each time days are stored or deleted
+#   changeddays   sorted set of YYYYMMDD, scored by the counter when the day
+#                 last changed
+
+
+def record_changed_days(redis, date_strings):
+    """
+    Called by LogProcessor once days are stored or deleted, so that cached
+    results covering them can be dropped.
+    """
+
+    generation = redis.incr('changes')
+    redis.zadd('changeddays', {x: generation for x in date_strings})
+
+
+def changed_days(redis, since):
+    """
+    Returns the current change counter and the days changed after `since`,
+    or None in place of the days if the counter went back, e.g. after Redis
+    was flushed, and any day may have changed.
+    """
+
+    generation = int(redis.get('changes') or 0)
+    if generation < since:
+        return (generation, None)
+    if generation == since:
+        return (generation, [])
+    days = redis.zrangebyscore('changeddays', since + 1, generation)
+    return (generation, sorted(x.decode('utf-8') for x in days))
+
+
+def manifest_key(category, depth, mode):
+    return 'manifest:{0}:{1}:{2}'.format(mode, depth,
+                                          category.replace(' ', '_'))
+
+
+def _escape_glob(value):
+    return re.sub(r'([*?\[\]\\])', r'\\\1', value.replace(' ', '_'))
+
+
+def _glob_to_regex(pattern):
+    """
+    Translates the subset of Redis glob syntax produced by `invalidate`:
+    unescaped * and backslash escapes.
+    """
+
+    regex = ''
+    escaped = False
+    for char in pattern:
+        if escaped:
+            regex += re.escape(char)
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '*':
+            regex += '.*'
+        else:
+            regex += re.escape(char)
+    return regex + '$'
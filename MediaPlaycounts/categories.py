@@ -0,0 +1,71 @@
+try:
+    from .queries import (IN_CHUNK, PLAYABLE_SQL, chunks, media_files_query,
+                          subcategories_query)
+except ImportError:
+    from queries import (IN_CHUNK, PLAYABLE_SQL, chunks, media_files_query,
+                         subcategories_query)
+
+# Walks of the Commons category tree, through the replica connections of a
+# Helper. Used to build category manifests by GetData, and by LogProcessor for
+# the watched categories without loading the query API.
+
+
+def find_subcategories(helper, category, depth=9):
+    """
+    Finds subcategories of a given category up to the provided depth. Category
+    should not have the "Category:" prefix. Returns a flat list of categories.
+
+    The tree is walked one level at a time: the children of a whole level are
+    fetched with batched IN (...) queries, and categories already seen are not
+    expanded again, so cycles and shared subtrees cost nothing extra.
+    """
+
+    if depth == 0:
+        return [category]
+
+    root = category.replace(' ', '_')
+    visited = set([root])
+    frontier = [root]
+
+    for level in range(depth):
+        children = set()
+        for chunk in chunks(frontier, IN_CHUNK):
+            for result in helper.query_commons(
+                    subcategories_query(len(chunk)), chunk):
+                children.add(result[0].decode('utf-8'))
+
+        frontier = sorted(children - visited)
+        if len(frontier) == 0:
+            break
+        visited.update(frontier)
+
+    visited.discard(root)
+    return sorted(visited)
+
+
+def find_media_files(helper, categories, mode='playable'):
+    """
+    Returns the set of media files in any of the given categories. Categories
+    are queried IN_CHUNK at a time, and playable files are told apart from
+    static ones by the database, so only the wanted rows come over the wire.
+    Rows are streamed straight into the set.
+    """
+
+    manifest = set()
+    categories = sorted(set(x.replace(' ', '_') for x in categories))
+    for chunk in chunks(categories, IN_CHUNK):
+        q = media_files_query(len(chunk), mode)
+        for result in helper.query_commons_iter(q, chunk + [PLAYABLE_SQL]):
+            manifest.add(result[0].decode('utf-8'))
+
+    return manifest
+
+
+def category_files(helper, category, depth, mode='playable'):
+    """
+    The manifest of a category: the sorted files in it and in its
+    subcategories up to `depth` levels down.
+    """
+
+    categories = [category] + find_subcategories(helper, category, depth=depth)
+    return sorted(find_media_files(helper, categories, mode=mode))
@@ -0,0 +1,225 @@
+import array, mmap, os, struct, threading
+from collections import OrderedDict
+
+# One file per day, named YYYYMMDD.mpc:
+#
+#   header     magic, row count, length of the name blob
+#   offsets    row count + 1 unsigned 64-bit offsets into the name blob
+#   names      UTF-8 filenames, sorted bytewise, concatenated
+#   padding    up to a multiple of 4 bytes
+#   columns    one unsigned 32-bit array of row count entries per column
+#
+# Integers are stored in native byte order so the arrays can be used straight
+# from the memory map.
+MAGIC = b'MPC1'
+HEADER = struct.Struct('=4sIQ')
+COLUMNS = ['original', 'transcoded', '0-399', '400-799', '800+']
+SUFFIX = '.mpc'
+
+
+def write_day(directory, date_string, rows):
+    """
+    Writes the counts for one day. `rows` maps filenames to a sequence of five
+    counts in the order of COLUMNS. The file is written next to its final name
+    and then renamed, so readers never see a partial day.
+    """
+
+    names = sorted(filename.encode('utf-8') for filename in rows)
+    offsets = array.array('Q', [0])
+    columns = [array.array('I') for column in COLUMNS]
+
+    for name in names:
+        offsets.append(offsets[-1] + len(name))
+        counts = rows[name.decode('utf-8')]
+        for column_num, column in enumerate(columns):
+            column.append(counts[column_num])
+
+    blob = b''.join(names)
+    padding = b'\0' * (-len(blob) % 4)
+
+    path = os.path.join(directory, date_string + SUFFIX)
+    with open(path + '.part', 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(names), len(blob)))
+        f.write(offsets.tobytes())
+        f.write(blob)
+        f.write(padding)
+        for column in columns:
+            f.write(column.tobytes())
+    os.replace(path + '.part', path)
+
+
+class DayFile:
+    """
+    Read-only, memory-mapped view of one day. Columns are memoryviews over the
+    map, so reading counts copies nothing.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.view = view = memoryview(self.map)
+        magic, self.rows, blob_length = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError('Not a columnar day file: ' + path)
+
+        position = HEADER.size
+        end = position + (self.rows + 1) * 8
+        self.offsets = view[position:end].cast('Q')
+        self.names = view[end:end + blob_length]
+        position = end + blob_length + (-blob_length % 4)
+
+        self.columns = []
+        for column in COLUMNS:
+            end = position + self.rows * 4
+            self.columns.append(view[position:end].cast('I'))
+            position = end
+
+    def name(self, row):
+        return self.names[self.offsets[row]:self.offsets[row + 1]].tobytes()
+
+    def find(self, name, lo=0):
+        """
+        Returns the row of an encoded filename, or None. `lo` lets a caller
+        walking names in sorted order skip the rows it has already passed.
+        """
+
+        hi = self.rows
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.name(mid) < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.rows and self.name(lo) == name:
+            return lo
+
+    def counts(self, row):
+        return tuple(column[row] for column in self.columns)
+
+    def lookup(self, filenames):
+        """
+        Returns a dict of filename to counts for the given filenames that
+        appear on this day. The names are looked up in sorted order, so each
+        search starts where the previous one ended.
+        """
+
+        found = {}
+        lo = 0
+        for name in sorted(filename.encode('utf-8') for filename in filenames):
+            row = self.find(name, lo)
+            if row is not None:
+                found[name.decode('utf-8')] = self.counts(row)
+                lo = row + 1
+        return found
+
+    def totals(self):
+        return tuple(sum(column) for column in self.columns)
+
+    def close(self):
+        # The map can only be closed once no view of it is left
+        for view in [self.offsets, self.names] + self.columns + [self.view]:
+            view.release()
+        self.map.close()
+
+
+class ColumnarStore:
+    """
+    Directory of day files. Opened days are kept mapped, up to `max_open` of
+    them, least recently used first out; a day is unmapped and its file
+    closed when it goes out. Days are read under a lock, so that none is
+    closed while another thread is reading it.
+    """
+
+    def __init__(self, directory, max_open=400):
+        self.directory = directory
+        self.max_open = max_open
+        self.open_days = OrderedDict()
+        self.lock = threading.Lock()
+
+    def dates(self):
+        return sorted(
+            name[:-len(SUFFIX)] for name in os.listdir(self.directory)
+            if name.endswith(SUFFIX))
+
+    def day(self, date_string):
+        if date_string in self.open_days:
+            self.open_days.move_to_end(date_string)
+            return self.open_days[date_string]
+
+        path = os.path.join(self.directory, date_string + SUFFIX)
+        if not os.path.isfile(path):
+            return None
+
+        day = DayFile(path)
+        self.open_days[date_string] = day
+        if len(self.open_days) > self.max_open:
+            self.open_days.popitem(last=False)[1].close()
+        return day
+
+    def forget(self, date_string):
+        """
+        Closes a day if it is open, e.g. before its file is removed.
+        """
+
+        with self.lock:
+            day = self.open_days.pop(date_string, None)
+            if day is not None:
+                day.close()
+
+    def close(self):
+        with self.lock:
+            for day in self.open_days.values():
+                day.close()
+            self.open_days.clear()
+
+    def history(self, filenames, date_strings=None):
+        """
+        Yields (date_string, {filename: counts}) for each date, or for every
+        stored day if `date_strings` is None. Files with no loads that day are
+        left out.
+        """
+
+        if date_strings is None:
+            date_strings = self.dates()
+
+        for date_string in date_strings:
+            with self.lock:
+                day = self.day(date_string)
+                found = {} if day is None else day.lookup(filenames)
+            yield date_string, found
+
+    def playcounts(self, filenames, date_strings=None):
+        """
+        Returns a dict of filename to a list of (date_string, play count)
+        pairs, like GetData's Redis reader: every date in `date_strings`, or
+        only the days with plays if it is None.
+        """
+
+        counts = {filename: [] for filename in filenames}
+        for date_string, found in self.history(filenames, date_strings):
+            for filename in filenames:
+                if filename in found:
+                    counts[filename].append(
+                        (date_string, found[filename][0] + found[filename][1]))
+                elif date_strings is not None:
+                    counts[filename].append((date_string, 0))
+        return counts
+
+    def image_counts(self, filenames, date_strings=None):
+        """
+        Returns a dict of filename to a dict of date_string: [originals,
+        0-399, 400-799, 800+], like GetData's SSDB reader.
+        """
+
+        counts = {filename: {} for filename in filenames}
+        for date_string, found in self.history(filenames, date_strings):
+            for filename in filenames:
+                if filename in found:
+                    row = found[filename]
+                    counts[filename][date_string] = [
+                        row[0], row[2], row[3], row[4]
+                    ]
+                elif date_strings is not None:
+                    counts[filename][date_string] = [0, 0, 0, 0]
+        return counts
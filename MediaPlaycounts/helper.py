@@ -1,90 +1,380 @@
-import arrow, redis, pyssdb, pymysql
+import arrow, atexit, contextlib, os, redis, pyssdb, pymysql, threading, time
+import pymysql.cursors
 
 try:
     from . import config
 except:
     import config
 
+try:
+    from .metrics import instrument_redis, registry
+    from .queries import date_range
+except ImportError:
+    from metrics import instrument_redis, registry
+    from queries import date_range
+
+
+class CommonsPool:
+    """
+    Keeps up to `size` connections to the Commons replica open between
+    queries. Idle connections are pinged before reuse, which reconnects them
+    if the server dropped them, and closed once they have been idle for
+    longer than `idle_timeout` seconds. A connection that raised while in use
+    is closed rather than put back.
+    """
+
+    def __init__(self, connect, size=4, idle_timeout=300):
+        self.connect = connect
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.idle = []  # (connection, time it was last put back)
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def _checkout(self):
+        connection = None
+        now = time.monotonic()
+
+        with self.lock:
+            if self.pid != os.getpid():
+                # Forked: the sockets belong to the parent process.
+                self.idle = []
+                self.pid = os.getpid()
+            while len(self.idle) > 0:
+                candidate, last_used = self.idle.pop()
+                if now - last_used > self.idle_timeout:
+                    self._close(candidate)
+                else:
+                    connection = candidate
+                    break
+
+        if connection is not None:
+            try:
+                connection.ping(reconnect=True)
+            except Exception:
+                self._close(connection)
+                connection = None
+
+        if connection is None:
+            connection = self.connect()
+
+        return connection
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    @contextlib.contextmanager
+    def connection(self):
+        self.slots.acquire()
+        try:
+            connection = self._checkout()
+            try:
+                yield connection
+            except BaseException:
+                self._close(connection)
+                raise
+            with self.lock:
+                self.idle.append((connection, time.monotonic()))
+        finally:
+            self.slots.release()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection, last_used in idle:
+            self._close(connection)
+
+
+def load_settings():
+    """
+    Reads the settings from config, filling in defaults for the optional ones.
+    """
+
+    backend = getattr(config, 'STORAGE_BACKEND', 'redis')
+    return {
+        'redis_host': config.REDIS_HOST,
+        'redis_port': config.REDIS_PORT,
+        'ssdb_host': config.SSDB_HOST,
+        'ssdb_port': config.SSDB_PORT,
+        'success_log': config.SUCCESS_LOG,
+        'error_log': config.ERROR_LOG,
+        'commons_host': config.COMMONS_HOST,
+        'commons_port': config.COMMONS_PORT,
+        'commons_db': config.COMMONS_DB,
+        'sql_user': config.SQL_USER,
+        'sql_pass': config.SQL_PASS,
+        'google_api': config.GOOGLE_API,
+        'batch_size': getattr(config, 'BATCH_SIZE', 10000),
+        'mediacounts_source': getattr(
+            config, 'MEDIACOUNTS_SOURCE',
+            'https://dumps.wikimedia.org/other/mediacounts/daily/'),
+        'cache_dir': getattr(config, 'CACHE_DIR', None),
+        'failed_days': getattr(config, 'FAILED_DAYS', 'failed_days.txt'),
+        'checkpoint_file': getattr(config, 'CHECKPOINT_FILE',
+                                   'checkpoints.json'),
+        'storage_backend': backend,
+        'columnar_dir': getattr(config, 'COLUMNAR_DIR', None),
+        'sqlite_path': getattr(config, 'SQLITE_PATH', 'mediaplaycounts.db'),
+        'commons_pool_size': getattr(config, 'COMMONS_POOL_SIZE', 4),
+        'commons_idle_timeout': getattr(config, 'COMMONS_IDLE_TIMEOUT',
+                                        300),
+        'manifest_cache': getattr(config, 'MANIFEST_CACHE', 'local'),
+        'manifest_ttl': getattr(config, 'MANIFEST_TTL', 3600),
+        'manifest_cache_size': getattr(config, 'MANIFEST_CACHE_SIZE',
+                                       128),
+        'rollups': getattr(config, 'ROLLUPS', True),
+        'index_days': getattr(config, 'INDEX_DAYS', 30),
+        # The leaderboards are kept in Redis, which the local backends do
+        # not need otherwise
+        'top_k': getattr(config, 'TOP_K',
+                         0 if backend in ('sqlite', 'columnar') else 1000),
+        'youtube_api_url': getattr(
+            config, 'YOUTUBE_API_URL',
+            'https://www.googleapis.com/youtube/v3/videos'),
+        'youtube_workers': getattr(config, 'YOUTUBE_WORKERS', 4),
+        'youtube_retries': getattr(config, 'YOUTUBE_RETRIES', 5),
+        'youtube_backoff': getattr(config, 'YOUTUBE_BACKOFF', 1.0),
+        'youtube_quota': getattr(config, 'YOUTUBE_QUOTA', 10000),
+        'youtube_preload': getattr(config, 'YOUTUBE_PRELOAD', 50),
+        'youtube_missing_ttl': getattr(config, 'YOUTUBE_MISSING_TTL',
+                                       30 * 24 * 60 * 60),
+        'log_buffer': getattr(config, 'LOG_BUFFER', 100),
+        'log_flush_interval': getattr(config, 'LOG_FLUSH_INTERVAL', 5),
+        'metrics': getattr(config, 'METRICS', False),
+        'metrics_dir': getattr(config, 'METRICS_DIR', None),
+        'metrics_format': getattr(config, 'METRICS_FORMAT', 'prometheus'),
+        'metrics_interval': getattr(config, 'METRICS_INTERVAL', 60),
+        'server_host': getattr(config, 'SERVER_HOST', '127.0.0.1'),
+        'server_port': getattr(config, 'SERVER_PORT', 8080),
+        'server_cache_size': getattr(config, 'SERVER_CACHE_SIZE', 1024),
+        'server_ttl': getattr(config, 'SERVER_TTL', 300),
+        'server_past_ttl': getattr(config, 'SERVER_PAST_TTL',
+                                   30 * 24 * 60 * 60),
+        'server_settled_days': getattr(config, 'SERVER_SETTLED_DAYS', 2),
+        'server_poll_interval': getattr(config, 'SERVER_POLL_INTERVAL', 10)
+    }
+
+
+class BufferedLog:
+    """
+    Appends timestamped lines to a log file that is kept open, writing them
+    out once `size` lines are waiting or `interval` seconds have passed since
+    they were last written out, on `flush` and at exit.
+    """
+
+    def __init__(self, path, size=100, interval=5):
+        self.path = path
+        self.size = size
+        self.interval = interval
+        self.lines = []
+        self.file = None
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def write(self, message):
+        timestamp = arrow.utcnow().format('YYYY-MM-DD HH:mm:ss')
+        with self.lock:
+            self._check_fork()
+            self.lines.append(timestamp + "\t" + message + "\n")
+            if (len(self.lines) >= self.size or
+                    time.monotonic() - self.last_flush >= self.interval):
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._check_fork()
+            self._flush()
+
+    def _check_fork(self):
+        if self.pid != os.getpid():
+            # Forked: the parent writes out the lines it had buffered
+            self.lines = []
+            self.file = None
+            self.pid = os.getpid()
+
+    def _flush(self):
+        if len(self.lines) > 0:
+            if self.file is None:
+                self.file = open(self.path, "a")
+            self.file.write(''.join(self.lines))
+            self.file.flush()
+            self.lines = []
+        self.last_flush = time.monotonic()
+
+
+_logs = {}
+_logs_lock = threading.Lock()
+
+
+def _flush_logs():
+    for log in list(_logs.values()):
+        log.flush()
+
+
+atexit.register(_flush_logs)
+
+
+def open_log(save_to, size=100, interval=5):
+    """
+    The BufferedLog for a path, shared by everything in the process that
+    writes to it.
+    """
+
+    with _logs_lock:
+        if save_to not in _logs:
+            _logs[save_to] = BufferedLog(save_to, size, interval)
+        return _logs[save_to]
+
+
+def write_log(save_to, message, flush=False):
+    log = open_log(save_to)
+    log.write(message)
+    if flush:
+        log.flush()
+
 
 class Helper:
     def __init__(self):
-        self.settings = {
-            'redis_host': config.REDIS_HOST,
-            'redis_port': config.REDIS_PORT,
-            'ssdb_host': config.SSDB_HOST,
-            'ssdb_port': config.SSDB_PORT,
-            'success_log': config.SUCCESS_LOG,
-            'error_log': config.ERROR_LOG,
-            'commons_host': config.COMMONS_HOST,
-            'commons_port': config.COMMONS_PORT,
-            'commons_db': config.COMMONS_DB,
-            'sql_user': config.SQL_USER,
-            'sql_pass': config.SQL_PASS,
-            'google_api': config.GOOGLE_API
-        }
+        self.settings = load_settings()
+
+        self.metrics = registry
+        self.metrics.configure(
+            enabled=self.settings['metrics'],
+            directory=self.settings['metrics_dir'],
+            format=self.settings['metrics_format'])
 
         self.redis = redis.Redis(
             host=self.settings['redis_host'], port=self.settings['redis_port'])
+        if self.metrics.enabled:
+            instrument_redis(self.redis, self.metrics)
+
+        self.logs = {
+            x: open_log(self.settings[x], self.settings['log_buffer'],
+                        self.settings['log_flush_interval'])
+            for x in ('success_log', 'error_log')
+        }
 
-        self.ssdb = pyssdb.Client(
-            host=self.settings['ssdb_host'], port=self.settings['ssdb_port'])
+        self._ssdb = None
+
+        self.commons = CommonsPool(
+            self._connect_commons,
+            size=self.settings['commons_pool_size'],
+            idle_timeout=self.settings['commons_idle_timeout'])
+
+    @property
+    def ssdb(self):
+        # pyssdb connects as soon as a client is made, and the sqlite and
+        # columnar backends may run with no SSDB at all
+        if self._ssdb is None:
+            self._ssdb = pyssdb.Client(
+                host=self.settings['ssdb_host'],
+                port=self.settings['ssdb_port'])
+        return self._ssdb
 
     def success_log(self, message):
-        timestamp = arrow.utcnow().format('YYYY-MM-DD HH:mm:ss')
-        save_to = self.settings['success_log']
-        with open(save_to, "a") as f:
-            f.write(timestamp + "\t" + message + "\n")
+        self.logs['success_log'].write(message)
+
+    def flush_logs(self):
+        for log in self.logs.values():
+            log.flush()
 
     def error_log(self, message):
-        timestamp = arrow.utcnow().format('YYYY-MM-DD HH:mm:ss')
-        save_to = self.settings['error_log']
-        with open(save_to, "a") as f:
-            f.write(timestamp + "\t" + message + "\n")
+        # Errors usually come just before a raise, so they are written out
+        # straight away rather than risk being lost with the process
+        self.logs['error_log'].write(message)
+        self.logs['error_log'].flush()
 
-    def query_commons(self, query, params):
+    def ssdb_batch(self, commands):
         """
-        Helper function to perform database queries
+        Sends a list of SSDB commands, each a tuple of (command, arg, ...), over
+        a single connection without waiting for the replies in between, then
+        reads the replies back in order. SSDB has no pipeline of its own, but
+        it answers requests on a connection strictly in sequence.
         """
 
-        conn = pymysql.connect(
+        pool = self.ssdb.connection_pool
+        connection = pool.get_connection()
+        replies = []
+
+        self.metrics.count('ssdb_commands_total', len(commands))
+        try:
+            with self.metrics.timer('ssdb_batch_seconds'):
+                for command in commands:
+                    connection.send(*command)
+                for command in commands:
+                    # pyssdb decodes a reply based on the last command sent
+                    connection.last_cmd = command[0]
+                    replies.append(connection.recv())
+        except Exception as e:
+            pool.release(connection, error=True)
+            raise e
+
+        pool.release(connection)
+
+        return replies
+
+    def _connect_commons(self):
+        # Autocommit, so that a pooled connection does not keep reading from
+        # the snapshot of a transaction opened by an earlier query.
+        return pymysql.connect(
             host=self.settings['commons_host'],
             port=self.settings['commons_port'],
             db=self.settings['commons_db'],
             user=self.settings['sql_user'],
             password=self.settings['sql_pass'],
-            charset="utf8")
+            charset="utf8",
+            autocommit=True)
 
-        cur = conn.cursor()
-        cur.execute(query, params)
+    def query_commons(self, query, params):
+        """
+        Helper function to perform database queries
+        """
 
         data = []
 
-        if cur.rowcount > 0:
-            results = cur.fetchall()
-            for result in results:
-                data.append(result)
-
-        conn.close()
+        with self.metrics.timer('commons_query_seconds'), \
+                self.commons.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(query, params)
+            if cur.rowcount > 0:
+                results = cur.fetchall()
+                for result in results:
+                    data.append(result)
+            cur.close()
 
+        self.metrics.count('commons_rows_total', len(data))
         return data
 
+    def query_commons_iter(self, query, params, fetch_size=10000):
+        """
+        Like `query_commons`, but yields rows as they arrive from the server
+        instead of loading the whole result set first. The pooled connection
+        is held until the generator is exhausted or closed.
+        """
+
+        with self.commons.connection() as conn:
+            cur = conn.cursor(pymysql.cursors.SSCursor)
+            with self.metrics.timer('commons_query_seconds'):
+                cur.execute(query, params)
+            while True:
+                with self.metrics.timer('commons_fetch_seconds'):
+                    results = cur.fetchmany(fetch_size)
+                if len(results) == 0:
+                    break
+                self.metrics.count('commons_rows_total', len(results))
+                for result in results:
+                    yield result
+            cur.close()
+
     def date_ranger(self, start_date=None, end_date=None, last=None):
         """
         Helper function to take whatever date input the user gives and turn it into
         a range of Arrow objects
         """
 
-        if end_date is None:
-            end_date = arrow.utcnow().replace(days=-1)
-        else:
-            end_date = arrow.get(end_date, 'YYYYMMDD')
-
-        if start_date is not None:
-            start_date = arrow.get(start_date, 'YYYYMMDD')
-        elif last is not None:
-            amount = (last * -1) + 1
-            start_date = end_date.replace(days=amount)
-        else:
-            start_date = end_date
-
-        return arrow.Arrow.range('day', start_date, end_date)
+        return date_range(start_date=start_date, end_date=end_date, last=last)
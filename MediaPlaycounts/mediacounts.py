@@ -0,0 +1,102 @@
+import re, urllib.parse
+
+# Rows for Commons media look like /wikipedia/commons/x/xx/FILENAME; anything
+# else can be rejected before the row is split.
+COMMONS_PREFIX = '/wikipedia/commons/'
+PLAYABLE_EXTENSIONS = ['mid', 'ogg', 'ogv', 'wav', 'webm', 'flac', 'oga']
+PLAYABLE_REGEX = re.compile(r'.*\.(' + '|'.join(PLAYABLE_EXTENSIONS) + ')')
+
+
+def _count(column):
+    if column == '-':
+        return 0
+    return int(column)
+
+
+def _commons_filename(base_name):
+    """
+    Returns the unquoted filename for a /wikipedia/commons/x/xx/FILENAME path,
+    or None for any other path.
+    """
+
+    components = base_name.split('/')
+    if len(components) == 6 and len(components[3]) == 1 \
+    and len(components[4]) == 2:
+        return urllib.parse.unquote_plus(components[5])
+
+
+def parse(row):
+    """
+    Takes a line from a raw, decompressed log file and returns a tuple
+    (filename, originals, transcodes, filetype). For playable files
+    `transcodes` is the number of transcoded plays; for static files it is a
+    dict of thumbnail loads per size bucket. Returns None for rows that are not
+    Commons media files or were never requested.
+    """
+
+    if not row.startswith(COMMONS_PREFIX):
+        return
+
+    columns = row.split('\t')
+    if len(columns) < 2:  # Not a real row
+        return
+
+    original = _count(columns[3])
+    audio = _count(columns[4])
+    movie = _count(columns[16])
+    if original + audio + _count(columns[7]) + movie <= 0:
+        return
+
+    filename = _commons_filename(columns[0])
+    if filename is None:
+        return
+
+    if PLAYABLE_REGEX.match(filename) is not None:
+        return (filename, original, audio + movie, 'playable')
+
+    thumbnails = {
+        '0-399': _count(columns[8]) + _count(columns[9]),
+        '400-799': _count(columns[10]) + _count(columns[11]),
+        '800': _count(columns[12]) + _count(columns[13])
+    }
+    return (filename, original, thumbnails, 'static')
+
+
+def parse_batch(rows):
+    """
+    Parses a block of lines at once. Returns two lists: playable files as
+    (filename, originals, transcodes) and static files as (filename, originals,
+    0-399, 400-799, 800+). Rows are filtered exactly as in `parse`.
+    """
+
+    playables = []
+    statics = []
+    count = _count
+
+    for row in rows:
+        if not row.startswith(COMMONS_PREFIX):
+            continue
+
+        columns = row.split('\t')
+        if len(columns) < 2:
+            continue
+
+        original = count(columns[3])
+        audio = count(columns[4])
+        movie = count(columns[16])
+        if original + audio + count(columns[7]) + movie <= 0:
+            continue
+
+        filename = _commons_filename(columns[0])
+        if filename is None:
+            continue
+
+        if PLAYABLE_REGEX.match(filename) is not None:
+            playables.append((filename, original, audio + movie))
+        else:
+            statics.append(
+                (filename, original, count(columns[8]) + count(columns[9]),
+                 count(columns[10]) + count(columns[11]),
+                 count(columns[12]) + count(columns[13])))
+
+    return playables, statics
@@ -0,0 +1,311 @@
+import bisect, contextlib, functools, inspect, json, os, threading, time
+
+# Counters and latency histograms for the whole process, off unless METRICS
+# is set. Helper configures the registry and instruments the Commons, Redis
+# and SSDB calls; LogProcessor times each stage of ingest and GetData each
+# request. With METRICS_DIR set, `export` writes everything recorded so far
+# to <METRICS_DIR>/mediaplaycounts_<job>.prom, in the Prometheus textfile
+# collector format, or to .json with METRICS_FORMAT 'json'. LogProcessor
+# exports after every day; a process serving GetData requests can export
+# periodically with `GetData.export_metrics`.
+#
+# Names are prefixed with mediaplaycounts_ on export. Counters end in _total
+# and histograms of durations in _seconds.
+
+PREFIX = 'mediaplaycounts_'
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300,
+           float('inf'))
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.start,
+                             **self.labels)
+
+
+_NO_TIMER = contextlib.nullcontext()
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters and histograms, each identified by a
+    name and a set of labels. While disabled, recording costs one attribute
+    check and `timer` returns a shared no-op context manager.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self.format = 'prometheus'
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}  # key: [count per bucket, sum, count]
+
+    def configure(self, enabled=False, directory=None, format='prometheus'):
+        self.enabled = enabled
+        self.directory = directory
+        self.format = format
+
+    def count(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        bucket = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(BUCKETS), 0, 0]
+            histogram[0][bucket] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def timer(self, name, **labels):
+        """
+        Context manager that adds the time spent inside it to the histogram.
+        """
+
+        if not self.enabled:
+            return _NO_TIMER
+        return _Timer(self, name, labels)
+
+    def timed(self, name, **labels):
+        """
+        Decorator form of `timer`, for plain and async functions alike. While
+        disabled, returns the function unchanged.
+        """
+
+        def decorate(func):
+            if not self.enabled:
+                return func
+
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def timed_coroutine(*args, **kwargs):
+                    with self.timer(name, **labels):
+                        return await func(*args, **kwargs)
+
+                return timed_coroutine
+
+            @functools.wraps(func)
+            def timed_function(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return func(*args, **kwargs)
+
+            return timed_function
+
+        return decorate
+
+    def timed_iter(self, iterable, name, **labels):
+        """
+        Yields from `iterable`, adding the time spent waiting for each item to
+        the histogram.
+        """
+
+        if not self.enabled:
+            return iterable
+        return self._timed_iter(iter(iterable), name, labels)
+
+    def _timed_iter(self, iterator, name, labels):
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.observe(name, time.perf_counter() - start, **labels)
+            yield item
+
+    def sums(self, name):
+        """
+        Returns a dict of labels to the total seconds in a histogram.
+        """
+
+        with self.lock:
+            return {
+                labels: histogram[1]
+                for (key_name, labels), histogram in self.histograms.items()
+                if key_name == name
+            }
+
+    def drain(self):
+        """
+        Returns everything recorded and starts afresh, e.g. in a worker
+        process whose metrics are handed back to the parent with `merge`.
+        """
+
+        with self.lock:
+            state = (self.counters, self.histograms)
+            self.counters = {}
+            self.histograms = {}
+        return state
+
+    def merge(self, state):
+        counters, histograms = state
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, (buckets, total, count) in histograms.items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = [[0] * len(BUCKETS), 0,
+                                                        0]
+                for bucket, bucket_count in enumerate(buckets):
+                    histogram[0][bucket] += bucket_count
+                histogram[1] += total
+                histogram[2] += count
+
+    def prometheus(self):
+        """
+        Everything recorded, in the Prometheus text exposition format.
+        """
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {0}{1} counter'.format(PREFIX, name))
+            lines.append('{0}{1}{2} {3}'.format(PREFIX, name,
+                                                _labels(labels), value))
+        for (name, labels), (buckets, total, count) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {0}{1} histogram'.format(PREFIX, name))
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS, buckets):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{0}{1}_bucket{2} {3}'.format(
+                    PREFIX, name, _labels(labels + (('le', le), )),
+                    cumulative))
+            lines.append('{0}{1}_sum{2} {3}'.format(PREFIX, name,
+                                                    _labels(labels), total))
+            lines.append('{0}{1}_count{2} {3}'.format(PREFIX, name,
+                                                      _labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def as_json(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+
+        return {
+            'counters': [{
+                'name': PREFIX + name,
+                'labels': dict(labels),
+                'value': value
+            } for (name, labels), value in counters],
+            'histograms': [{
+                'name': PREFIX + name,
+                'labels': dict(labels),
+                'buckets': dict(zip([str(x) for x in BUCKETS], buckets)),
+                'sum': total,
+                'count': count
+            } for (name, labels), (buckets, total, count) in histograms]
+        }
+
+    def export(self, job):
+        """
+        Writes everything recorded to the METRICS_DIR file for `job`. Does
+        nothing while disabled or without METRICS_DIR.
+        """
+
+        if not self.enabled or self.directory is None:
+            return
+
+        if self.format == 'json':
+            path = os.path.join(self.directory, PREFIX + job + '.json')
+            content = json.dumps(self.as_json(), indent=2)
+        else:
+            path = os.path.join(self.directory, PREFIX + job + '.prom')
+            content = self.prometheus()
+
+        # The textfile collector may read at any moment, so the file is
+        # written next to its final name and then renamed
+        with open(path + '.part', 'w') as f:
+            f.write(content)
+        os.replace(path + '.part', path)
+
+    def export_in_background(self, job, interval):
+        """
+        Calls `export` every `interval` seconds from a daemon thread. Returns
+        an Event that stops the thread when set.
+        """
+
+        stop = threading.Event()
+
+        def loop():
+            while not stop.wait(interval):
+                self.export(job)
+
+        threading.Thread(target=loop, daemon=True).start()
+        return stop
+
+
+def _labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels) + '}'
+
+
+def instrument_redis(client, metrics):
+    """
+    Times the commands and pipelines of a Redis client, by wrapping the
+    methods of that one instance.
+    """
+
+    execute_command = client.execute_command
+    pipeline = client.pipeline
+
+    def timed_command(*args, **options):
+        with metrics.timer('redis_command_seconds', command=str(args[0])):
+            return execute_command(*args, **options)
+
+    def timed_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def timed_execute(*args, **kwargs):
+            metrics.count('redis_commands_total', len(pipe.command_stack))
+            with metrics.timer('redis_pipeline_seconds'):
+                return execute(*args, **kwargs)
+
+        pipe.execute = timed_execute
+        return pipe
+
+    client.execute_command = timed_command
+    client.pipeline = timed_pipeline
+    return client
+
+
+registry = Metrics()
@@ -0,0 +1,216 @@
+import array, datetime, struct, sys
+
+# Packed encoding: instead of one hash field per day, each file gets one
+# string per year holding a fixed-width array indexed by day of the year
+# (0 for 1 January, 365 only in leap years):
+#
+#   mpcy:<filename>:<YYYY>      plays, one count per day
+#   imgy:<sha224>:<YYYY>        image loads, four counts per day in the order
+#                               of the metric groups (originals, 0-399,
+#                               400-799, 800+)
+#
+# Counts are unsigned 32-bit big-endian, the layout of Redis BITFIELD u32, so
+# Redis can increment them in place. Strings only grow as far as the last day
+# written, and zeros at the end are trimmed where strings are rewritten.
+WIDTH = 4
+DAYS = 366
+PLAY_SLOTS = 1
+IMAGE_SLOTS = 4
+COUNT = struct.Struct('>I')
+MAX_COUNT = 2**32 - 1
+
+
+def packed_key(key, year):
+    """
+    Packed key for a year of a hash key: mpc:<filename> becomes
+    mpcy:<filename>:<YYYY> and img:<hash> becomes imgy:<hash>:<YYYY>.
+    """
+
+    prefix, name = key.split(':', 1)
+    return '{0}y:{1}:{2}'.format(prefix, name, year)
+
+
+def hash_key(key):
+    """
+    The reverse of `packed_key`: returns the hash key and the year.
+    """
+
+    prefix, rest = key.split(':', 1)
+    name, year = rest.rsplit(':', 1)
+    return (prefix[:-1] + ':' + name, year)
+
+
+def day_index(date_string):
+    date = datetime.date(
+        int(date_string[:4]), int(date_string[4:6]), int(date_string[6:8]))
+    return date.timetuple().tm_yday - 1
+
+
+def index_date(year, index):
+    date = datetime.date(int(year), 1, 1) + datetime.timedelta(days=index)
+    return date.strftime('%Y%m%d')
+
+
+def year_spans(date_strings, first_year=None, last_year=None):
+    """
+    Splits a range of dates into (year, first day index, last day index)
+    spans, one per year. With `date_strings` None, spans whole years from
+    `first_year` to `last_year`.
+    """
+
+    if date_strings is None:
+        return [(str(year), 0, DAYS - 1)
+                for year in range(first_year, last_year + 1)]
+
+    spans = {}
+    for date_string in date_strings:
+        index = day_index(date_string)
+        year = date_string[:4]
+        if year in spans:
+            first, last = spans[year]
+            spans[year] = (min(first, index), max(last, index))
+        else:
+            spans[year] = (index, index)
+    return [(year, first, last)
+            for year, (first, last) in sorted(spans.items())]
+
+
+def byte_range(first, last, slots):
+    """
+    Offset and length of the bytes for days `first` to `last` inclusive.
+    """
+
+    return (first * slots * WIDTH, (last - first + 1) * slots * WIDTH)
+
+
+def unpack(data):
+    """
+    Decodes packed bytes into an array of counts, ignoring a trailing
+    partial count.
+    """
+
+    counts = array.array('I')
+    counts.frombytes(data[:len(data) - len(data) % WIDTH])
+    if sys.byteorder == 'little':
+        counts.byteswap()
+    return counts
+
+
+def days(pieces, slots):
+    """
+    Takes (year, first day index, bytes) pieces, the bytes read for each
+    span, and returns a dict of date_string: [count per slot] for the days
+    with any count.
+    """
+
+    found = {}
+    for year, first, data in pieces:
+        counts = unpack(data)
+        # The zeros trimmed off the end may have been part of the last day
+        counts.extend([0] * (-len(counts) % slots))
+        for n in range(0, len(counts), slots):
+            day = counts[n:n + slots]
+            if any(day):
+                found[index_date(year, first + n // slots)] = list(day)
+    return found
+
+
+def increment(data, index, slot, slots, amount):
+    """
+    Adds `amount` to one count of a bytearray in place, growing it if needed.
+    Counts saturate at 0 and at 2**32 - 1, like BITFIELD with OVERFLOW SAT.
+    """
+
+    offset = (index * slots + slot) * WIDTH
+    if len(data) < offset + WIDTH:
+        data.extend(bytes(offset + WIDTH - len(data)))
+    value = COUNT.unpack_from(data, offset)[0] + amount
+    COUNT.pack_into(data, offset, min(max(value, 0), MAX_COUNT))
+
+
+def put(data, index, slot, slots, value):
+    """
+    Sets one count of a bytearray in place, like `increment` but replacing
+    the count instead of adding to it.
+    """
+
+    offset = (index * slots + slot) * WIDTH
+    if len(data) < offset + WIDTH:
+        data.extend(bytes(offset + WIDTH - len(data)))
+    COUNT.pack_into(data, offset, min(max(value, 0), MAX_COUNT))
+
+
+def clear_day(data, index, slots):
+    """
+    Sets every count of one day of a bytearray to zero, in place.
+    """
+
+    start, length = byte_range(index, index, slots)
+    data[start:start + length] = bytes(len(data[start:start + length]))
+
+
+def trim(data):
+    """
+    Drops the zero counts at the end of a packed string.
+    """
+
+    data = bytes(data).rstrip(b'\0')
+    return data + bytes(-len(data) % WIDTH)
+
+
+def pack_fields(fields, slots):
+    """
+    Packs a hash's daily fields, {YYYYMMDD[group]: count}, into a dict of
+    year: packed bytes. Rollup fields are ignored.
+    """
+
+    years = {}
+    for field, count in fields.items():
+        if len(field) != 8 + (slots > 1):
+            continue
+        data = years.setdefault(field[:4], bytearray())
+        slot = int(field[8:]) if slots > 1 else 0
+        increment(data, day_index(field[:8]), slot, slots, count)
+    return {year: trim(data) for year, data in years.items()}
+
+
+def add(data, other):
+    """
+    Adds two packed strings count by count.
+    """
+
+    total, other = unpack(data), unpack(other)
+    if len(total) < len(other):
+        total, other = other, total
+    for n, count in enumerate(other):
+        total[n] = min(total[n] + count, MAX_COUNT)
+    if sys.byteorder == 'little':
+        total.byteswap()
+    return trim(total.tobytes())
+
+
+def play_counts(pieces, date_strings):
+    """
+    Turns the pieces read for one file into (date_string, count) pairs, in
+    the shape of GetData's readers: every date in `date_strings`, or the
+    days with plays when it is None.
+    """
+
+    found = days(pieces, PLAY_SLOTS)
+    if date_strings is None:
+        return sorted((x, y[0]) for x, y in found.items())
+    return [(x, found[x][0] if x in found else 0) for x in date_strings]
+
+
+def image_counts(pieces, date_strings):
+    """
+    Same as `play_counts` for images: a dict of date_string: [count per
+    metrics group].
+    """
+
+    found = days(pieces, IMAGE_SLOTS)
+    if date_strings is not None:
+        for date_string in date_strings:
+            found.setdefault(date_string, [0, 0, 0, 0])
+        found = {x: found[x] for x in date_strings}
+    return found
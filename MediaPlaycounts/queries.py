@@ -0,0 +1,398 @@
+import arrow, calendar, hashlib, itertools
+from collections import OrderedDict
+
+try:
+    from .mediacounts import PLAYABLE_EXTENSIONS
+    from .packed import byte_range, packed_key, year_spans
+except ImportError:
+    from mediacounts import PLAYABLE_EXTENSIONS
+    from packed import byte_range, packed_key, year_spans
+
+# Pieces of the query API that do no I/O, shared by GetData and AsyncGetData.
+
+# Categories per IN (...) list, to keep queries well under max_allowed_packet
+IN_CHUNK = 1000
+
+# Files per Redis pipeline or SSDB batch when reading counts
+READ_CHUNK = 1000
+
+# First year with data; all-time totals are the sum of the yearly rollups
+FIRST_YEAR = 2015
+
+# Same match as mediacounts.PLAYABLE_REGEX, for MySQL's REGEXP
+PLAYABLE_SQL = r'\.(' + '|'.join(PLAYABLE_EXTENSIONS) + ')'
+
+METRIC_GROUPS = ['original', '0-399', '400-799', '800+']
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def batches(iterable, size):
+    """
+    Like `chunks` for any iterable, such as a SCAN.
+    """
+
+    iterable = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterable, size))
+        if len(batch) == 0:
+            break
+        yield batch
+
+
+def date_range(start_date=None, end_date=None, last=None):
+    """
+    Takes whatever date input the user gives and turns it into a range of
+    Arrow objects
+    """
+
+    if end_date is None:
+        end_date = arrow.utcnow().replace(days=-1)
+    else:
+        end_date = arrow.get(end_date, 'YYYYMMDD')
+
+    if start_date is not None:
+        start_date = arrow.get(start_date, 'YYYYMMDD')
+    elif last is not None:
+        amount = (last * -1) + 1
+        start_date = end_date.replace(days=amount)
+    else:
+        start_date = end_date
+
+    return arrow.Arrow.range('day', start_date, end_date)
+
+
+def range_dates(start_date=None, end_date=None, last=None):
+    """
+    Returns the YYYYMMDD strings for the requested range, or None when all the
+    parameters are None, meaning all-time.
+    """
+
+    if start_date is None and end_date is None and last is None:
+        return None
+
+    return [
+        date.format('YYYYMMDD')
+        for date in date_range(
+            start_date=start_date, end_date=end_date, last=last)
+    ]
+
+
+def range_fields(date_strings):
+    """
+    Covers a range of dates with as few hash fields as possible: YYYY for the
+    years it spans completely, YYYYMM for the remaining whole months, and
+    YYYYMMDD for the days at the edges. For all-time (None), every year since
+    FIRST_YEAR.
+    """
+
+    if date_strings is None:
+        return [
+            str(year) for year in range(FIRST_YEAR, arrow.utcnow().year + 1)
+        ]
+
+    years = {}
+    for date_string in sorted(set(date_strings)):
+        years.setdefault(date_string[:4], []).append(date_string)
+
+    fields = []
+    for year, days in sorted(years.items()):
+        if len(days) == (366 if calendar.isleap(int(year)) else 365):
+            fields.append(year)
+            continue
+
+        months = {}
+        for date_string in days:
+            months.setdefault(date_string[:6], []).append(date_string)
+        for month, month_days in sorted(months.items()):
+            if len(month_days) == calendar.monthrange(
+                    int(year), int(month[4:]))[1]:
+                fields.append(month)
+            else:
+                fields += month_days
+
+    return fields
+
+
+def rollup_fields(field):
+    """
+    Returns the month and year rollup fields for a daily field: YYYYMM and
+    YYYY, followed by the cohort digit for image fields.
+    """
+
+    return [field[:6] + field[8:], field[:4] + field[8:]]
+
+
+def month_days(date_string):
+    """
+    The YYYYMMDD strings of every day in the month of `date_string`.
+    """
+
+    days = calendar.monthrange(int(date_string[:4]), int(date_string[4:6]))[1]
+    return [date_string[:6] + '{0:02d}'.format(day)
+            for day in range(1, days + 1)]
+
+
+def year_months(date_string):
+    """
+    The YYYYMM strings of every month in the year of `date_string`.
+    """
+
+    return [date_string[:4] + '{0:02d}'.format(month)
+            for month in range(1, 13)]
+
+
+def packed_reads(key, date_strings, slots):
+    """
+    For the packed backend: the (year, first day index, packed key, offset,
+    length) to read for a range of dates (None for all-time) of a hash key.
+    """
+
+    reads = []
+    for year, first, last in year_spans(date_strings, FIRST_YEAR,
+                                        arrow.utcnow().year):
+        start, length = byte_range(first, last, slots)
+        reads.append((year, first, packed_key(key, year), start, length))
+    return reads
+
+
+def image_key(filename):
+    """
+    SSDB key for an image; SSDB is fussy about keys, so the filename is hashed.
+    """
+
+    return 'img:' + hashlib.sha224(filename.encode('utf-8')).hexdigest()
+
+
+def subcategories_query(count):
+    """
+    SQL for the subcategories of `count` categories at once.
+    """
+
+    return ("select page_title from categorylinks join page"
+            " on cl_from = page_id where cl_to in ({0})"
+            " and cl_type = 'subcat'").format(', '.join(['%s'] * count))
+
+
+def media_files_query(count, mode='playable'):
+    """
+    SQL for the playable or static files in `count` categories at once. Takes
+    the categories followed by PLAYABLE_SQL as parameters.
+    """
+
+    if mode == 'playable':
+        operator = 'regexp'
+    else:
+        operator = 'not regexp'
+
+    return ("select page_title from page join categorylinks on cl_from = "
+            "page_id where page_namespace=6 and cl_to in ({0}) "
+            "and page_title {1} %s").format(', '.join(['%s'] * count),
+                                            operator)
+
+
+def image_fields(fields):
+    """
+    SSDB image fields for the metric groups of each date or rollup field.
+    """
+
+    return tuple(field + str(group_num) for field in fields
+                 for group_num in range(len(METRIC_GROUPS)))
+
+
+def playcount_reply(result, date_strings):
+    """
+    Turns the reply to an HMGET over `date_strings`, or to an HGETALL when it
+    is None, into a list of (date_string, count) pairs. Rollups are skipped.
+    """
+
+    counts = []
+    if date_strings is None:
+        for date_string, count in result.items():
+            date_string = date_string.decode('utf-8')
+            if len(date_string) != 8:  # month or year rollup
+                continue
+            counts.append((date_string, int(count.decode('utf-8'))))
+    else:
+        for date_string, count in zip(date_strings, result):
+            if count is None:
+                count = 0
+            else:
+                count = int(count.decode('utf-8'))
+            counts.append((date_string, count))
+    return counts
+
+
+def image_reply(result, date_strings):
+    """
+    Turns the SSDB reply to a multi_hget over `image_fields(date_strings)`, or
+    to an hgetall when it is None, into a dict of date_string: [count per
+    metrics group]. Rollups are skipped.
+    """
+
+    dates = {}
+    if date_strings is not None:
+        for date_string in date_strings:
+            dates[date_string] = [0, 0, 0, 0]
+    for n in range(0, len(result), 2):
+        field = result[n].decode('utf-8')
+        if len(field) != 9:  # month or year rollup
+            continue
+        actual_date = field[:8]
+        if actual_date not in dates:
+            dates[actual_date] = [0, 0, 0, 0]
+        dates[actual_date][int(field[-1:])] = int(
+            result[n + 1].decode('utf-8'))
+    return dates
+
+
+def image_reply_total(result):
+    """
+    Sums a multi_hget reply over image fields into [count per metrics group].
+    """
+
+    total = [0, 0, 0, 0]
+    for n in range(0, len(result), 2):
+        total[int(result[n][-1:])] += int(result[n + 1])
+    return total
+
+
+def watched_entry(category, depth, mode):
+    return '{0}:{1}:{2}'.format(mode, depth, category.replace(' ', '_'))
+
+
+def playcount_total_result(filename, total):
+    return OrderedDict([('filename', filename), ('total', total)])
+
+
+def playcount_result(filename, counts):
+    data = [
+        OrderedDict([('date', date_string), ('count', count)])
+        for date_string, count in sorted(counts)
+    ]
+    total = 0
+    for date_string, count in counts:
+        total += count
+
+    return OrderedDict([('filename', filename), ('total', total), ('details',
+                                                                   data)])
+
+
+def image_total_result(filename, total):
+    return OrderedDict([('filename', filename), (METRIC_GROUPS[0], total[0]),
+                        (METRIC_GROUPS[1], total[1]),
+                        (METRIC_GROUPS[2], total[2]),
+                        (METRIC_GROUPS[3], total[3]), ('total', sum(total))])
+
+
+def image_result(filename, dates):
+    data = []
+    total = [0, 0, 0, 0]  # corresponding to each metrics group
+    for date_string in sorted(dates.keys()):
+        to_append = OrderedDict([('date', date_string)])
+        for group_num, group_name in enumerate(METRIC_GROUPS):
+            total[group_num] += dates[date_string][group_num]
+            to_append.update({group_name: dates[date_string][group_num]})
+        to_append.update({'total': sum(dates[date_string])})
+        data.append(to_append)
+
+    total_total = total[0] + total[1] + total[2] + total[3]
+
+    return OrderedDict([('filename', filename), (METRIC_GROUPS[0], total[0]),
+                        (METRIC_GROUPS[1], total[1]),
+                        (METRIC_GROUPS[2], total[2]),
+                        (METRIC_GROUPS[3], total[3]),
+                        ('total', total_total), ('details', data)])
+
+
+def youtube_member(timestamp, count):
+    """
+    Member of a ytts:<video id> sorted set. The timestamp is part of the
+    member so that equal counts on different days stay distinct.
+    """
+
+    return '{0}:{1}'.format(timestamp, count)
+
+
+def youtube_snapshot(member):
+    """
+    Turns a ytts: member or ytlatest value back into (timestamp, count).
+    """
+
+    timestamp, count = member.decode('utf-8').split(':')
+    return (timestamp, int(count))
+
+
+def youtube_score_range(date_strings):
+    """
+    Lowest and highest ytts: scores (YYYYMMDDHHmmss timestamps as numbers)
+    that fall within a range of dates.
+    """
+
+    return (int(min(date_strings) + '000000'),
+            int(max(date_strings) + '235959'))
+
+
+def legacy_youtube_snapshots(play_counts):
+    """
+    Snapshots from an old-style youtube:<video id> hash, as a list of
+    (timestamp, count) sorted by time.
+    """
+
+    return sorted((x.decode('utf-8'), int(y.decode('utf-8')))
+                  for x, y in play_counts.items())
+
+
+def youtube_result(filename, latest, snapshots, date_strings):
+    """
+    Builds the snapshot result for a file from its latest (timestamp, count)
+    and, for `date_strings` (None for the latest count only), the snapshots
+    taken within the range, sorted by time. Each date gets its earliest
+    snapshot; dates without one are left out.
+    """
+
+    ret = OrderedDict([('filename', filename), ('count', latest[1]),
+                       ('as_of', latest[0])])
+
+    if date_strings is None:
+        return ret
+
+    earliest = {}
+    for timestamp, count in snapshots:
+        earliest.setdefault(timestamp[:8], (timestamp, count))
+
+    details = []
+    for date_string in date_strings:
+        if date_string in earliest:
+            timestamp, count = earliest[date_string]
+            details.append({'count': count, 'as_of': timestamp})
+    ret.update({'details': details})
+    return ret
+
+
+def category_result(category, depth, data, total):
+    return OrderedDict([('category', category), ('depth', depth),
+                        ('total', total), ('details', data)])
+
+
+def top_result(metric, ranking, category=None, depth=None):
+    ret = OrderedDict([('metric', metric)])
+    if category is not None:
+        ret.update([('category', category), ('depth', depth)])
+    ret['details'] = [
+        OrderedDict([('rank', n + 1), ('filename', filename), ('count', count)])
+        for n, (filename, count) in enumerate(ranking)
+    ]
+    return ret
+
+
+def image_category_result(category, depth, data, total):
+    metric_groups = METRIC_GROUPS + ['total']
+    return OrderedDict(
+        [('category', category), ('depth', depth),
+         (metric_groups[0], total[0]), (metric_groups[1], total[1]),
+         (metric_groups[2], total[2]), (metric_groups[3], total[3]),
+         (metric_groups[4], total[4]), ('details', data)])
@@ -0,0 +1,297 @@
+import arrow, hashlib, http.server, inspect, json, threading
+import urllib.parse
+
+try:
+    from . import GetData
+    from .cache import LRUCache
+    from .queries import range_dates
+except ImportError:
+    import GetData
+    from cache import LRUCache
+    from queries import range_dates
+
+# HTTP service answering GetData queries, with a cache of the responses:
+#
+#     GET /category_playcount?category=Videos_of_cats&depth=2&last=30
+#
+# Each endpoint takes the keyword arguments of the GetData function of the
+# same name as query parameters, and returns its result as JSON.
+#
+# Requests are normalized before they are looked up: names get underscores,
+# missing arguments their defaults, and start_date/end_date/last become the
+# first and last day they cover, so equivalent requests share an entry.
+# Counts for a day never change once it is ingested, so responses for ranges
+# that ended at least SERVER_SETTLED_DAYS ago are kept for SERVER_PAST_TTL
+# seconds and marked immutable for HTTP caches; the rest, and YouTube
+# snapshots, for SERVER_TTL. Category results also depend on the category's
+# manifest, so they are kept no longer than MANIFEST_TTL. Cached responses
+# covering a day are dropped when LogProcessor stores or deletes it; see
+# `cache.record_changed_days`. Every response carries an ETag, and
+# requests with a matching If-None-Match get a 304.
+#
+# Run with `python server.py`, which listens on SERVER_HOST:SERVER_PORT.
+
+h = GetData.h
+
+ENDPOINTS = {
+    name: getattr(GetData, name)
+    for name in [
+        'file_playcount', 'category_playcount', 'youtube_snapshot_file',
+        'youtube_snapshot_category', 'image_single_viewcount',
+        'image_category_viewcount', 'top_files'
+    ]
+}
+
+# Arguments that are not strings
+INT_ARGS = {'depth', 'last', 'limit'}
+BOOL_ARGS = {'details', 'per_file'}
+BOOLS = {'1': True, 'true': True, 'yes': True,
+         '0': False, 'false': False, 'no': False}
+
+
+def request_args(endpoint, query):
+    """
+    Turns the query parameters of a request, as parsed by parse_qs, into the
+    normalized keyword arguments for the endpoint's GetData function. Raises
+    ValueError for anything it cannot take.
+    """
+
+    parameters = inspect.signature(ENDPOINTS[endpoint]).parameters
+    args = {}
+    for name, values in query.items():
+        if name not in parameters:
+            raise ValueError('Unknown parameter: ' + name)
+        value = values[-1]
+        if name in INT_ARGS:
+            value = int(value)
+        elif name in BOOL_ARGS:
+            if value.lower() not in BOOLS:
+                raise ValueError('Expected true or false for ' + name)
+            value = BOOLS[value.lower()]
+        elif name in ('filename', 'category'):
+            value = value.replace(' ', '_')
+        args[name] = value
+
+    for name, parameter in parameters.items():
+        if name not in args:
+            if parameter.default is inspect.Parameter.empty:
+                raise ValueError('Missing parameter: ' + name)
+            args[name] = parameter.default
+
+    date_strings = range_dates(args['start_date'], args['end_date'],
+                               args['last'])
+    args['last'] = None
+    if date_strings is None:
+        args['start_date'] = args['end_date'] = None
+    else:
+        args['start_date'] = min(date_strings)
+        args['end_date'] = max(date_strings)
+
+    return args
+
+
+def cache_key(endpoint, args):
+    # Starts with the first and last day, which `ResponseCache.changed`
+    # matches on
+    return (args['start_date'], args['end_date'], endpoint,
+            json.dumps(sorted(args.items())))
+
+
+def cache_policy(endpoint, args):
+    """
+    Returns how many seconds a response may be cached for and whether it is
+    immutable.
+    """
+
+    settled = arrow.utcnow().replace(
+        days=-h.settings['server_settled_days']).format('YYYYMMDD')
+    if endpoint.startswith('youtube') or args['end_date'] is None \
+    or args['end_date'] > settled:
+        return (h.settings['server_ttl'], False)
+    if args.get('category') is not None:
+        return (min(h.settings['server_past_ttl'],
+                    h.settings['manifest_ttl']), False)
+    return (h.settings['server_past_ttl'], True)
+
+
+class ResponseCache:
+    """
+    LRUCache of responses, each a (body, ETag, Cache-Control header) tuple,
+    that drops the ones covering days reported by `GetData.changed_days`.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.responses = LRUCache(max_entries)
+        self.generation = None
+
+    def get(self, key):
+        return self.responses.get(key)
+
+    def set(self, key, response, ttl, generation):
+        """
+        Stores a response computed when the changes were up to `generation`,
+        unless days changed while it was being computed.
+        """
+
+        if generation == self.generation:
+            self.responses.set(key, response, ttl)
+
+    def changed(self):
+        """
+        Drops the responses covering any day changed since the last call.
+        The first call only records where the changes are up to.
+        """
+
+        since = self.generation if self.generation is not None else 0
+        generation, days = GetData.changed_days(since)
+        if self.generation is not None:
+            if days is None:
+                self.responses.delete()
+            elif len(days) > 0:
+                self.responses.delete(lambda key: _covers(key, days))
+        self.generation = generation
+
+    def watch(self, interval):
+        """
+        Calls `changed` every `interval` seconds from a daemon thread. Returns
+        an Event that stops the thread when set.
+        """
+
+        stop = threading.Event()
+
+        def loop():
+            while not stop.is_set():
+                try:
+                    self.changed()
+                except Exception as e:
+                    h.error_log('Failed to check for changed days - ' +
+                                str(e))
+                stop.wait(interval)
+
+        threading.Thread(target=loop, daemon=True).start()
+        return stop
+
+
+def _covers(key, days):
+    first, last = key[0], key[1]
+    return first is None or any(first <= x <= last for x in days)
+
+
+def _etag_matches(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    tags = [x.strip() for x in if_none_match.split(',')]
+    return etag in tags or 'W/' + etag in tags
+
+
+def respond(cache, path, if_none_match=None):
+    """
+    Answers a GET for `path`, query string included. Returns the status,
+    the headers and the body.
+    """
+
+    url = urllib.parse.urlsplit(path)
+    endpoint = url.path.strip('/')
+
+    if endpoint == 'metrics' and h.metrics.enabled:
+        return (200, {'Content-Type': 'text/plain; version=0.0.4'},
+                h.metrics.prometheus().encode('utf-8'))
+
+    if endpoint not in ENDPOINTS:
+        return _error(404, 'Unknown endpoint: ' + endpoint)
+
+    try:
+        args = request_args(
+            endpoint, urllib.parse.parse_qs(url.query,
+                                            keep_blank_values=True))
+    except Exception as e:
+        return _error(400, str(e))
+
+    key = cache_key(endpoint, args)
+    generation = cache.generation
+    response = cache.get(key)
+    h.metrics.count('server_cache_total',
+                    result='miss' if response is None else 'hit')
+    if response is None:
+        try:
+            result = ENDPOINTS[endpoint](**args)
+        except ValueError as e:
+            return _error(400, str(e))
+        except Exception as e:
+            h.error_log('Failed to answer ' + path + ' - ' + str(e))
+            return _error(500, 'Internal error')
+
+        body = json.dumps(result).encode('utf-8')
+        ttl, immutable = cache_policy(endpoint, args)
+        control = 'public, max-age={0}'.format(ttl)
+        if immutable:
+            control += ', immutable'
+        response = (body, '"' + hashlib.sha1(body).hexdigest() + '"',
+                    control)
+        cache.set(key, response, ttl, generation)
+
+    body, etag, control = response
+    headers = {'ETag': etag, 'Cache-Control': control}
+    if _etag_matches(if_none_match, etag):
+        return (304, headers, b'')
+    headers['Content-Type'] = 'application/json; charset=utf-8'
+    return (200, headers, body)
+
+
+def _error(status, message):
+    return (status, {'Content-Type': 'application/json; charset=utf-8',
+                     'Cache-Control': 'no-store'},
+            json.dumps({'error': message}).encode('utf-8'))
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    cache = None
+
+    def do_GET(self):
+        status, headers, body = respond(self.cache, self.path,
+                                        self.headers.get('If-None-Match'))
+        h.metrics.count('server_requests_total', status=status)
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Requests are counted in the metrics rather than logged
+        pass
+
+
+def serve(host=None, port=None):
+    """
+    Runs the service until interrupted, listening on `host`:`port`
+    (SERVER_HOST and SERVER_PORT by default).
+    """
+
+    if host is None:
+        host = h.settings['server_host']
+    if port is None:
+        port = h.settings['server_port']
+
+    cache = ResponseCache(h.settings['server_cache_size'])
+    cache.watch(h.settings['server_poll_interval'])
+    if h.metrics.enabled:
+        GetData.export_metrics()
+
+    handler = type('Handler', (Handler, ), {'cache': cache})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    h.success_log('Serving on {0}:{1}'.format(host, port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,1007 @@
+import arrow, collections, contextlib, os, sqlite3, threading
+
+try:
+    from .columnar import ColumnarStore
+    from .metrics import registry
+    from .packed import (IMAGE_SLOTS, MAX_COUNT, PLAY_SLOTS, clear_day,
+                         day_index, hash_key, image_counts, increment,
+                         packed_key, play_counts, put, trim)
+    from .queries import (
+        METRIC_GROUPS, READ_CHUNK, batches, chunks, image_fields, image_key,
+        image_reply, image_reply_total, month_days, packed_reads,
+        playcount_reply, range_fields, rollup_fields, year_months)
+except ImportError:
+    from columnar import ColumnarStore
+    from metrics import registry
+    from packed import (IMAGE_SLOTS, MAX_COUNT, PLAY_SLOTS, clear_day,
+                        day_index, hash_key, image_counts, increment,
+                        packed_key, play_counts, put, trim)
+    from queries import (
+        METRIC_GROUPS, READ_CHUNK, batches, chunks, image_fields, image_key,
+        image_reply, image_reply_total, month_days, packed_reads,
+        playcount_reply, range_fields, rollup_fields, year_months)
+
+# Where the daily counts live. STORAGE_BACKEND picks one of:
+#
+#   redis      plays in Redis hashes, image loads in SSDB hashes (default)
+#   packed     per-year arrays in Redis and SSDB; see the packed module
+#   columnar   one file per day in COLUMNAR_DIR; see the columnar module
+#   sqlite     a single SQLite file at SQLITE_PATH, needing no server
+#
+# LogProcessor writes through `write` and GetData reads through the other
+# methods, so neither needs to know which backend is in use.
+
+# Keys per SQLite statement, well under the default limit of 999 variables
+SQL_CHUNK = 500
+
+# Redis sorted set of the days that have date indexes, scored by the day as a
+# number
+INDEXED_DAYS = 'idxdays'
+
+# Redis key set once the rollups cover every day stored. Until then, totals
+# are summed from the daily fields: data stored before rollups were kept has
+# none until `LogProcessor.py rollup` has been run.
+ROLLUPS_BUILT = 'rollups:built'
+
+
+class Storage:
+    """
+    Interface of the storage backends. Counts are addressed the way the
+    hashes store them: plays by mpc:<filename> key and YYYYMMDD field, image
+    loads by img:<sha224> key and YYYYMMDD<group> field.
+    """
+
+    # Whether month and year rollup fields are kept
+    rollups = False
+
+    # Whether several processes may write different days at the same time,
+    # as backfill workers do
+    parallel_writes = False
+
+    def rollups_built(self):
+        """
+        Whether the rollups cover every day stored, so that totals can be read
+        from them rather than summed from the daily fields.
+        """
+
+        return False
+
+    def mark_rollups_built(self):
+        pass
+
+    def write(self, pending, replace=False):
+        """
+        Adds a batch of increments. `pending` maps 'redis' (plays) and 'ssdb'
+        (image loads) to dicts of (key, field): amount, the shape of
+        `BatchWriter.pending`, rollup fields included.
+
+        With `replace`, the daily fields in `pending` are set to the amounts
+        instead, so writing the same batch twice changes nothing. `pending`
+        then holds no rollup fields; see `publish_day`.
+        """
+
+        raise NotImplementedError
+
+    def publish_day(self, date_string, batch_size):
+        """
+        Called once every batch of a day has been written with `replace`:
+        brings the month and year rollups up to date with the day's fields.
+        Running it again gives the same result.
+        """
+
+        pass
+
+    def playcounts(self, filenames, date_strings):
+        """
+        Returns a dict mapping each filename to a list of (date_string, count)
+        pairs: every date in `date_strings`, or only the dates with plays if
+        it is None (all-time).
+        """
+
+        raise NotImplementedError
+
+    def playcount_totals(self, filenames, date_strings):
+        """
+        Returns a dict of filename to total plays over `date_strings` (None
+        for all-time).
+        """
+
+        return {
+            filename: sum(count for date_string, count in counts)
+            for filename, counts in self.playcounts(filenames,
+                                                    date_strings).items()
+        }
+
+    def image_counts(self, filenames, date_strings):
+        """
+        Returns a dict mapping each filename to a dict of date_string: [count
+        per metrics group], with every date in `date_strings`, or only the
+        dates with loads if it is None (all-time).
+        """
+
+        raise NotImplementedError
+
+    def image_totals(self, filenames, date_strings):
+        """
+        Returns a dict of filename to [count per metrics group] over
+        `date_strings` (None for all-time).
+        """
+
+        totals = {}
+        for filename, dates in self.image_counts(filenames,
+                                                 date_strings).items():
+            totals[filename] = [
+                sum(counts[group_num] for counts in dates.values())
+                for group_num in range(len(METRIC_GROUPS))
+            ]
+        return totals
+
+    def delete_date(self, date_string, batch_size):
+        """
+        Deletes every count for one day, taking it off the rollups.
+        """
+
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class HashStorage(Storage):
+    """
+    One Redis hash per played file and one SSDB hash per image, with a field
+    per day. Every key written is also recorded in a per-date index, the Redis
+    set mpcidx:YYYYMMDD and the SSDB hash imgidx:YYYYMMDD, so that
+    `publish_day` and `delete_date` know which keys to visit. The indexes of
+    days more than INDEX_DAYS old are dropped once those days are published;
+    `delete_date` finds their keys with a SCAN instead.
+
+    Redis is read with one pipeline of HMGETs (or HGETALLs for all-time) per
+    READ_CHUNK files, SSDB with one batch of multi_hgets (or hgetalls). Unless
+    ROLLUPS is off or they have not been built yet, totals are read from the
+    month and year rollups, so the number of fields per file stays small
+    however long the range is.
+    """
+
+    parallel_writes = True
+
+    def __init__(self, helper):
+        self.h = helper
+        self.rollups = helper.settings['rollups']
+        self.index_days = helper.settings['index_days']
+
+    def write(self, pending, replace=False):
+        touched = {'redis': collections.defaultdict(set),
+                   'ssdb': collections.defaultdict(set)}
+        for engine, fields in pending.items():
+            for key, field in fields:
+                if len(field) >= 8:  # not a rollup
+                    touched[engine][field[:8]].add(key)
+
+        if len(pending['redis']) > 0:
+            pipe = self.h.redis.pipeline(transaction=False)
+            self._redis_writes(pipe, pending['redis'], replace)
+            for date_string, keys in touched['redis'].items():
+                pipe.sadd('mpcidx:' + date_string, *keys)
+            pipe.execute()
+
+        if len(pending['ssdb']) > 0:
+            commands = self._ssdb_writes(pending['ssdb'], replace)
+            for date_string, keys in touched['ssdb'].items():
+                index = ['imgidx:' + date_string]
+                for key in keys:
+                    index += [key, 1]
+                commands.append(('multi_hset', ) + tuple(index))
+            self.h.ssdb_batch(commands)
+
+    def _redis_writes(self, pipe, increments, replace):
+        for (key, field), payload in increments.items():
+            if replace:
+                pipe.hset(key, field, payload)
+            else:
+                pipe.hincrby(key, field, amount=payload)
+
+    def _ssdb_writes(self, increments, replace):
+        if not replace:
+            return [('hincr', key, field, payload)
+                    for (key, field), payload in increments.items()]
+
+        fields = {}
+        for (key, field), payload in increments.items():
+            fields.setdefault(key, []).extend([field, payload])
+        return [('multi_hset', key) + tuple(values)
+                for key, values in fields.items()]
+
+    def publish_day(self, date_string, batch_size):
+        """
+        Sets the month rollup of every key in the day's date index to the sum
+        of its daily fields, and the year rollup to the sum of its month
+        rollups. Then drops the date indexes that are past INDEX_DAYS.
+        """
+
+        if self.rollups:
+            self._publish_rollups(date_string, batch_size)
+        else:
+            # Days stored from now on have no rollups
+            self.h.redis.delete(ROLLUPS_BUILT)
+        self.trim_indexes([date_string])
+
+    def rollups_built(self):
+        return self.rollups and self.h.redis.exists(ROLLUPS_BUILT) > 0
+
+    def mark_rollups_built(self):
+        self.h.redis.set(ROLLUPS_BUILT, arrow.utcnow().isoformat())
+
+    def _publish_rollups(self, date_string, batch_size):
+        month = date_string[:6]
+        days = month_days(date_string)
+        months = [x for x in year_months(date_string) if x != month]
+
+        for keys in batches(self.redis_date_keys(date_string, batch_size),
+                            batch_size):
+            pipe = self.h.redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.hmget(key, days + months)
+            values = pipe.execute()
+
+            pipe = self.h.redis.pipeline(transaction=False)
+            for key, found in zip(keys, values):
+                found = [int(x) if x is not None else 0 for x in found]
+                month_total = sum(found[:len(days)])
+                pipe.hset(key, mapping={
+                    month: month_total,
+                    month[:4]: month_total + sum(found[len(days):])
+                })
+            pipe.execute()
+
+        fields = image_fields(days) + image_fields(months)
+        for keys in batches(self.ssdb_date_keys(date_string, batch_size),
+                            batch_size):
+            values = self.h.ssdb_batch([('multi_hget', key) + fields
+                                        for key in keys])
+
+            commands = []
+            for key, found in zip(keys, values):
+                found = {
+                    found[n].decode('utf-8'): int(found[n + 1])
+                    for n in range(0, len(found), 2)
+                }
+                command = ['multi_hset', key]
+                for group_num in range(len(METRIC_GROUPS)):
+                    group = str(group_num)
+                    month_total = sum(found.get(x + group, 0) for x in days)
+                    year_total = month_total + sum(
+                        found.get(x + group, 0) for x in months)
+                    command += [month + group, month_total,
+                                month[:4] + group, year_total]
+                commands.append(tuple(command))
+            self.h.ssdb_batch(commands)
+
+    def playcounts(self, filenames, date_strings):
+        counts = {}
+
+        for chunk in chunks(filenames, READ_CHUNK):
+            pipe = self.h.redis.pipeline(transaction=False)
+            for filename in chunk:
+                if date_strings is None:
+                    pipe.hgetall('mpc:' + filename)
+                else:
+                    pipe.hmget('mpc:' + filename, date_strings)
+
+            for filename, result in zip(chunk, pipe.execute()):
+                counts[filename] = playcount_reply(result, date_strings)
+
+        return counts
+
+    def playcount_totals(self, filenames, date_strings):
+        if not self.rollups_built():
+            return super().playcount_totals(filenames, date_strings)
+
+        fields = range_fields(date_strings)
+        totals = {}
+        for chunk in chunks(filenames, READ_CHUNK):
+            pipe = self.h.redis.pipeline(transaction=False)
+            for filename in chunk:
+                pipe.hmget('mpc:' + filename, fields)
+            for filename, result in zip(chunk, pipe.execute()):
+                totals[filename] = sum(int(x) for x in result if x is not None)
+
+        return totals
+
+    def image_counts(self, filenames, date_strings):
+        counts = {}
+
+        fields = None
+        if date_strings is not None:
+            fields = image_fields(date_strings)
+
+        for chunk in chunks(filenames, READ_CHUNK):
+            keys = [image_key(filename) for filename in chunk]
+            if fields is None:
+                results = self.h.ssdb_batch([('hgetall', key) for key in keys])
+            else:
+                results = self.h.ssdb_batch([('multi_hget', key) + fields
+                                             for key in keys])
+
+            for filename, result in zip(chunk, results):
+                counts[filename] = image_reply(result, date_strings)
+
+        return counts
+
+    def image_totals(self, filenames, date_strings):
+        if not self.rollups_built():
+            return super().image_totals(filenames, date_strings)
+
+        fields = image_fields(range_fields(date_strings))
+        totals = {}
+        for chunk in chunks(filenames, READ_CHUNK):
+            keys = [image_key(filename) for filename in chunk]
+            results = self.h.ssdb_batch([('multi_hget', key) + fields
+                                         for key in keys])
+            for filename, result in zip(chunk, results):
+                totals[filename] = image_reply_total(result)
+
+        return totals
+
+    def _redis_fallback_keys(self, date_string, batch_size):
+        for key in self.h.redis.scan_iter(match='mpc:*', count=batch_size):
+            yield key
+
+    def _ssdb_fallback_keys(self, date_string, batch_size):
+        for key in self.ssdb_hash_names(batch_size):
+            yield key
+
+    def redis_date_keys(self, date_string, batch_size):
+        """
+        Yields the Redis keys that may hold a field for `date_string`: the
+        members of its date index if there is one, otherwise every mpc: key,
+        found with a non-blocking SCAN.
+        """
+
+        index = 'mpcidx:' + date_string
+        if self.h.redis.exists(index):
+            for key in self.h.redis.sscan_iter(index, count=batch_size):
+                yield key
+        else:
+            for key in self._redis_fallback_keys(date_string, batch_size):
+                yield key
+
+    def ssdb_date_keys(self, date_string, batch_size):
+        """
+        Same as `redis_date_keys` for SSDB: walks the imgidx: hash for the
+        date if there is one, otherwise every img: hash name.
+        """
+
+        index = 'imgidx:' + date_string
+        if self.h.ssdb.hsize(index) > 0:
+            start = ''
+            while True:
+                page = self.h.ssdb.hscan(index, start, '', batch_size)
+                if len(page) == 0:
+                    break
+                for key in page[0::2]:
+                    yield key
+                start = page[-2]
+        else:
+            for key in self._ssdb_fallback_keys(date_string, batch_size):
+                yield key
+
+    def trim_indexes(self, date_strings=(), scan=False):
+        """
+        Records that the days in `date_strings` have date indexes, then drops
+        the indexes of every recorded day more than INDEX_DAYS old. With
+        `scan`, the indexes already in Redis and SSDB are found and recorded
+        first, for data stored before indexes were trimmed.
+        """
+
+        date_strings = list(date_strings)
+        if scan:
+            for key in self.h.redis.scan_iter(match='mpcidx:*', count=1000):
+                date_strings.append(_key_name(key)[len('mpcidx:'):])
+            for key in self.ssdb_hash_names(1000, prefix='imgidx:'):
+                date_strings.append(_key_name(key)[len('imgidx:'):])
+        if len(date_strings) > 0:
+            self.h.redis.zadd(INDEXED_DAYS,
+                              {x: int(x) for x in date_strings})
+
+        cutoff = arrow.utcnow().replace(
+            days=-self.index_days).format('YYYYMMDD')
+        expired = [
+            _key_name(x) for x in self.h.redis.zrangebyscore(
+                INDEXED_DAYS, '-inf', '(' + cutoff)
+        ]
+        for date_string in expired:
+            self._drop_indexes(date_string)
+
+    def _drop_indexes(self, date_string):
+        # UNLINK frees a large set without blocking Redis
+        self.h.redis.unlink('mpcidx:' + date_string)
+        self.h.ssdb.hclear('imgidx:' + date_string)
+        self.h.redis.zrem(INDEXED_DAYS, date_string)
+
+    def ssdb_hash_names(self, batch_size, prefix='img:'):
+        """
+        Yields the name of every img: hash in SSDB, or of every hash starting
+        with `prefix`, `batch_size` at a time.
+        """
+
+        start = prefix
+        while True:
+            page = self.h.ssdb.hlist(start, prefix + '~', batch_size)
+            if len(page) == 0:
+                break
+            for key in page:
+                yield key
+            start = page[-1]
+
+    def delete_date(self, date_string, batch_size):
+        rollups = rollup_fields(date_string)
+
+        deleted = 0
+        for keys in batches(self.redis_date_keys(date_string, batch_size),
+                            batch_size):
+            pipe = self.h.redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.hmget(key, [date_string] + rollups)
+            values = pipe.execute()
+
+            pipe = self.h.redis.pipeline(transaction=False)
+            for key, (day, month, year) in zip(keys, values):
+                if day is None:
+                    continue
+                pipe.hdel(key, date_string)
+                for field, current in zip(rollups, (month, year)):
+                    if current is not None:
+                        pipe.hincrby(key, field, amount=-int(day))
+            pipe.execute()
+
+            deleted += len(keys)
+            print('Redis: visited {0} keys for {1}'.format(
+                deleted, date_string))
+
+        day_fields = [date_string + str(cohort) for cohort in range(4)]
+        day_rollups = {field: rollup_fields(field) for field in day_fields}
+        fields = tuple(day_fields) + tuple(
+            rollup for field in day_fields for rollup in day_rollups[field])
+
+        deleted = 0
+        for keys in batches(self.ssdb_date_keys(date_string, batch_size),
+                            batch_size):
+            values = self.h.ssdb_batch([('multi_hget', key) + fields
+                                        for key in keys])
+
+            commands = []
+            for key, found in zip(keys, values):
+                found = {
+                    found[n].decode('utf-8'): int(found[n + 1])
+                    for n in range(0, len(found), 2)
+                }
+                for field in day_fields:
+                    if field not in found:
+                        continue
+                    for rollup in day_rollups[field]:
+                        if rollup in found:
+                            commands.append(
+                                ('hincr', key, rollup, -found[field]))
+                commands.append(('multi_hdel', key) + tuple(day_fields))
+            self.h.ssdb_batch(commands)
+
+            deleted += len(keys)
+            print('SSDB: visited {0} keys for {1}'.format(
+                deleted, date_string))
+        self._drop_indexes(date_string)
+
+
+def _key_name(key):
+    return key.decode('utf-8') if isinstance(key, bytes) else key
+
+
+class PackedStorage(HashStorage):
+    """
+    The per-year arrays described in the packed module, in Redis and SSDB.
+    Ranges are sliced out with GETRANGE and SSDB substr, one read per file
+    and year of the range. No rollups are kept: totals are summed from the
+    arrays. The date indexes still list the hash keys. SSDB arrays are read
+    and written back, so only one process may write at a time.
+    """
+
+    rollups = False
+    parallel_writes = False
+
+    def __init__(self, helper):
+        self.h = helper
+        self.index_days = helper.settings['index_days']
+
+    def _redis_writes(self, pipe, increments, replace):
+        for (key, field), payload in increments.items():
+            # Changes the count in place, creating the key or growing it as
+            # needed
+            offset = '#' + str(day_index(field))
+            if replace:
+                pipe.bitfield(packed_key(key, field[:4])).set(
+                    'u32', offset, min(payload, MAX_COUNT)).execute()
+            else:
+                pipe.bitfield(packed_key(key, field[:4])).overflow(
+                    'SAT').incrby('u32', offset, payload).execute()
+
+    def _ssdb_writes(self, increments, replace):
+        """
+        SSDB has no BITFIELD, so packed image arrays are updated by reading
+        them, adding the increments here and writing them back. That is only
+        safe because the batches of all days are written by a single writer,
+        one after the other.
+        """
+
+        updated = {}
+        for (key, field), payload in increments.items():
+            updated.setdefault(packed_key(key, field[:4]), []).append(
+                (day_index(field[:8]), int(field[8:]), payload))
+
+        keys = sorted(updated)
+        current = {}
+        for chunk in chunks(keys, READ_CHUNK):
+            reply = self.h.ssdb_batch([('multi_get', ) + tuple(chunk)])[0]
+            reply = reply or []
+            for n in range(0, len(reply), 2):
+                current[reply[n].decode('utf-8')] = reply[n + 1]
+
+        change = put if replace else increment
+        commands = []
+        for chunk in chunks(keys, READ_CHUNK):
+            command = ['multi_set']
+            for key in chunk:
+                data = bytearray(current.get(key, b''))
+                for index, slot, payload in updated[key]:
+                    change(data, index, slot, IMAGE_SLOTS, payload)
+                command += [key, trim(data)]
+            commands.append(tuple(command))
+        return commands
+
+    def playcounts(self, filenames, date_strings):
+        counts = {}
+        for chunk in chunks(filenames, READ_CHUNK):
+            reads = [packed_reads('mpc:' + x, date_strings, PLAY_SLOTS)
+                     for x in chunk]
+            pipe = self.h.redis.pipeline(transaction=False)
+            for file_reads in reads:
+                for year, first, key, start, length in file_reads:
+                    pipe.getrange(key, start, start + length - 1)
+            replies = iter(pipe.execute())
+
+            for filename, file_reads in zip(chunk, reads):
+                pieces = [(year, first, next(replies))
+                          for year, first, key, start, length in file_reads]
+                counts[filename] = play_counts(pieces, date_strings)
+
+        return counts
+
+    def image_counts(self, filenames, date_strings):
+        counts = {}
+        for chunk in chunks(filenames, READ_CHUNK):
+            reads = [packed_reads(image_key(x), date_strings, IMAGE_SLOTS)
+                     for x in chunk]
+            replies = iter(self.h.ssdb_batch([
+                ('substr', key, start, length) for file_reads in reads
+                for year, first, key, start, length in file_reads
+            ]))
+
+            for filename, file_reads in zip(chunk, reads):
+                pieces = [(year, first, next(replies) or b'')
+                          for year, first, key, start, length in file_reads]
+                counts[filename] = image_counts(pieces, date_strings)
+
+        return counts
+
+    def _redis_fallback_keys(self, date_string, batch_size):
+        for key in self.h.redis.scan_iter(
+                match='mpcy:*:' + date_string[:4], count=batch_size):
+            yield hash_key(key.decode('utf-8'))[0]
+
+    def _ssdb_fallback_keys(self, date_string, batch_size):
+        for key in self.ssdb_packed_names(date_string[:4], batch_size):
+            yield key
+
+    def ssdb_packed_names(self, year, batch_size):
+        """
+        Yields the img: key of every image with a packed imgy: array for
+        `year`.
+        """
+
+        start = 'imgy:'
+        while True:
+            page = self.h.ssdb.keys(start, 'imgy:~', batch_size)
+            if page is None or len(page) == 0:
+                break
+            for key in page:
+                key, key_year = hash_key(key.decode('utf-8'))
+                if key_year == year:
+                    yield key
+            start = page[-1]
+
+    def delete_date(self, date_string, batch_size):
+        """
+        Zeroes one day in the packed arrays of every key in the date indexes.
+        """
+
+        year = date_string[:4]
+        index = day_index(date_string)
+
+        deleted = 0
+        for keys in batches(self.redis_date_keys(date_string, batch_size),
+                            batch_size):
+            pipe = self.h.redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.bitfield(packed_key(_key_name(key), year)).set(
+                    'u32', '#' + str(index), 0).execute()
+            pipe.execute()
+
+            deleted += len(keys)
+            print('Redis: visited {0} keys for {1}'.format(
+                deleted, date_string))
+
+        deleted = 0
+        for keys in batches(self.ssdb_date_keys(date_string, batch_size),
+                            batch_size):
+            keys = [packed_key(_key_name(key), year) for key in keys]
+            reply = self.h.ssdb_batch([('multi_get', ) + tuple(keys)])[0] or []
+
+            commands = []
+            for n in range(0, len(reply), 2):
+                data = bytearray(reply[n + 1])
+                clear_day(data, index, IMAGE_SLOTS)
+                data = trim(data)
+                if len(data) > 0:
+                    commands.append(('set', reply[n], data))
+                else:
+                    commands.append(('del', reply[n]))
+            if len(commands) > 0:
+                self.h.ssdb_batch(commands)
+
+            deleted += len(keys)
+            print('SSDB: visited {0} keys for {1}'.format(
+                deleted, date_string))
+        self._drop_indexes(date_string)
+
+
+class ColumnarStorage(Storage):
+    """
+    Day files in COLUMNAR_DIR, each scanned once for all of the files asked
+    about. Days are written whole by LogProcessor with `columnar.write_day`
+    rather than in batches.
+    """
+
+    parallel_writes = True
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.columns = ColumnarStore(directory)
+
+    def write(self, pending, replace=False):
+        raise RuntimeError(
+            'The columnar backend is written a day at a time, not in batches')
+
+    def playcounts(self, filenames, date_strings):
+        return self.columns.playcounts(filenames, date_strings)
+
+    def image_counts(self, filenames, date_strings):
+        return self.columns.image_counts(filenames, date_strings)
+
+    def delete_date(self, date_string, batch_size):
+        self.columns.forget(date_string)
+        os.remove(os.path.join(self.directory, date_string + '.mpc'))
+
+    def close(self):
+        self.columns.close()
+
+
+def _day_pattern(rollup, cohort):
+    """
+    LIKE pattern for the daily fields summed into a rollup field: YYYYMM__
+    for a month, YYYY____ for a year, followed by the image cohort if any.
+    """
+
+    period = rollup[:len(rollup) - len(cohort)]
+    return period + '_' * (8 - len(period)) + cohort
+
+
+class SQLiteStorage(Storage):
+    """
+    A single SQLite file, for backfilling and analysing years of data on one
+    machine without Redis or SSDB. The plays and images tables mirror the
+    hashes row for row: one (key, field, count) row per hash field, rollups
+    included, so results match the redis backend exactly.
+
+    The database runs in WAL mode, so readers carry on while a batch is
+    written, and each `write` is a single transaction. The connection is
+    shared between threads behind a lock; a forked process opens its own.
+    Writers in other processes wait up to BUSY_TIMEOUT seconds for their
+    turn. The meta table records whether the rollups are built: a database
+    created with ROLLUPS on has them from the start.
+    """
+
+    TABLES = {'redis': 'plays', 'ssdb': 'images'}
+    BUSY_TIMEOUT = 300
+
+    parallel_writes = True
+
+    def __init__(self, path, rollups=True):
+        self.path = path
+        self.rollups = rollups
+        self.lock = threading.Lock()
+        self._connect()
+        created = self.db.execute(
+            "select count(*) from sqlite_master where name = 'plays'"
+        ).fetchone()[0] == 0
+        for table in self.TABLES.values():
+            self.db.execute(
+                'create table if not exists {0} (key text not null, '
+                'field text not null, count integer not null, '
+                'primary key (key, field)) without rowid'.format(table))
+        self.db.execute('create table if not exists meta (name text primary '
+                        'key, value text not null)')
+        if created and rollups:
+            self.mark_rollups_built()
+
+    def _connect(self):
+        self.pid = os.getpid()
+        self._db = sqlite3.connect(self.path, timeout=self.BUSY_TIMEOUT,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('pragma journal_mode=wal')
+        # Safe with WAL: a crash can lose the last transactions, never
+        # corrupt the file
+        self._db.execute('pragma synchronous=normal')
+
+    @property
+    def db(self):
+        if self.pid != os.getpid():
+            # Forked: the connection belongs to the parent process
+            self._connect()
+        return self._db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self.lock, registry.timer('sqlite_transaction_seconds'):
+            self.db.execute('begin immediate')
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute('rollback')
+                raise
+            self.db.execute('commit')
+
+    def _select(self, table, keys, where, params):
+        """
+        Runs `select key, field, count` over `keys`, SQL_CHUNK at a time,
+        with the extra `where` condition.
+        """
+
+        rows = []
+        for chunk in chunks(keys, SQL_CHUNK):
+            query = ('select key, field, count from {0} where key in ({1}) '
+                     'and {2}').format(table, ', '.join(['?'] * len(chunk)),
+                                       where)
+            with self.lock, registry.timer('sqlite_select_seconds'):
+                rows += self.db.execute(query, list(chunk) + params).fetchall()
+        return rows
+
+    def _days(self, table, keys, date_strings, length):
+        """
+        Returns a dict of key to {field: count} for the daily fields, those
+        `length` characters long, of `date_strings` (None for all-time).
+        """
+
+        if date_strings is None:
+            low, high = '', '~'
+        else:
+            low, high = min(date_strings), max(date_strings) + '~'
+
+        wanted = None
+        if date_strings is not None:
+            wanted = set(date_strings)
+
+        found = {}
+        for key, field, count in self._select(
+                table, keys, 'field between ? and ? and length(field) = ?',
+            [low, high, length]):
+            if wanted is None or field[:8] in wanted:
+                found.setdefault(key, {})[field] = count
+        return found
+
+    def _fields(self, table, keys, fields):
+        found = {}
+        for chunk in chunks(fields, SQL_CHUNK):
+            where = 'field in ({0})'.format(', '.join(['?'] * len(chunk)))
+            for key, field, count in self._select(table, keys, where,
+                                                  list(chunk)):
+                found.setdefault(key, {})[field] = count
+        return found
+
+    def write(self, pending, replace=False):
+        """
+        With `replace`, the rollups of the fields written are recomputed from
+        the daily rows in the same transaction, so `publish_day` has nothing
+        left to do.
+        """
+
+        if replace:
+            update = 'excluded.count'
+        else:
+            update = 'count + excluded.count'
+
+        with self._transaction() as db:
+            for engine, table in self.TABLES.items():
+                db.executemany(
+                    'insert into {0} values (?, ?, ?) on conflict (key, '
+                    'field) do update set count = {1}'.format(table, update),
+                    ((key, field, payload)
+                     for (key, field), payload in pending[engine].items()))
+
+                if replace and self.rollups:
+                    rollups = set(
+                        (key, rollup, field[8:])
+                        for key, field in pending[engine]
+                        for rollup in rollup_fields(field))
+                    db.executemany(
+                        'insert into {0} (key, field, count) select key, ?, '
+                        'sum(count) from {0} where key = ? and field like ? '
+                        'and length(field) = ? group by key on conflict '
+                        '(key, field) do update set count = excluded.count'.
+                        format(table),
+                        ((rollup, key, _day_pattern(rollup, cohort),
+                          8 + len(cohort)) for key, rollup, cohort in rollups))
+
+    def playcounts(self, filenames, date_strings):
+        keys = ['mpc:' + filename for filename in filenames]
+        found = self._days('plays', keys, date_strings, 8)
+
+        counts = {}
+        for filename, key in zip(filenames, keys):
+            days = found.get(key, {})
+            if date_strings is None:
+                counts[filename] = sorted(days.items())
+            else:
+                counts[filename] = [(x, days.get(x, 0)) for x in date_strings]
+        return counts
+
+    def playcount_totals(self, filenames, date_strings):
+        if not self.rollups_built():
+            return super().playcount_totals(filenames, date_strings)
+
+        keys = ['mpc:' + filename for filename in filenames]
+        found = self._fields('plays', keys, range_fields(date_strings))
+        return {
+            filename: sum(found.get(key, {}).values())
+            for filename, key in zip(filenames, keys)
+        }
+
+    def image_counts(self, filenames, date_strings):
+        keys = [image_key(filename) for filename in filenames]
+        found = self._days('images', keys, date_strings, 9)
+
+        counts = {}
+        for filename, key in zip(filenames, keys):
+            dates = {}
+            if date_strings is not None:
+                for date_string in date_strings:
+                    dates[date_string] = [0, 0, 0, 0]
+            for field, count in found.get(key, {}).items():
+                dates.setdefault(field[:8], [0, 0, 0, 0])[int(field[8:])] = \
+                    count
+            counts[filename] = dates
+        return counts
+
+    def image_totals(self, filenames, date_strings):
+        if not self.rollups_built():
+            return super().image_totals(filenames, date_strings)
+
+        keys = [image_key(filename) for filename in filenames]
+        found = self._fields('images', keys,
+                             image_fields(range_fields(date_strings)))
+
+        totals = {}
+        for filename, key in zip(filenames, keys):
+            total = [0, 0, 0, 0]
+            for field, count in found.get(key, {}).items():
+                total[int(field[-1:])] += count
+            totals[filename] = total
+        return totals
+
+    def delete_date(self, date_string, batch_size):
+        """
+        Deletes the day's rows, taking them off the rollups first. There is
+        no index on the field, so this scans the tables once each.
+        """
+
+        day_fields = {
+            'plays': [date_string],
+            'images': [date_string + str(cohort) for cohort in range(4)]
+        }
+
+        with self._transaction() as db:
+            for table, fields in day_fields.items():
+                where = 'field in ({0})'.format(', '.join(['?'] * len(fields)))
+                if self.rollups:
+                    rows = db.execute(
+                        'select key, field, count from {0} where {1}'.format(
+                            table, where), fields).fetchall()
+                    db.executemany(
+                        'update {0} set count = count - ? where key = ? and '
+                        'field = ?'.format(table),
+                        ((count, key, rollup) for key, field, count in rows
+                         for rollup in rollup_fields(field)))
+                db.execute('delete from {0} where {1}'.format(table, where),
+                           fields)
+
+    def publish_day(self, date_string, batch_size):
+        if not self.rollups:
+            # Days stored from now on have no rollups
+            with self._transaction() as db:
+                db.execute("delete from meta where name = 'rollups_built'")
+
+    def rollups_built(self):
+        if not self.rollups:
+            return False
+        with self.lock:
+            return self.db.execute(
+                "select count(*) from meta where name = 'rollups_built'"
+            ).fetchone()[0] > 0
+
+    def mark_rollups_built(self):
+        with self._transaction() as db:
+            db.execute(
+                "insert or replace into meta values ('rollups_built', ?)",
+                [arrow.utcnow().isoformat()])
+
+    def rebuild_rollups(self):
+        """
+        Recomputes every month and year rollup from the daily rows, in one
+        transaction.
+        """
+
+        with self._transaction() as db:
+            for table, length in [('plays', 8), ('images', 9)]:
+                cohort = '' if length == 8 else ' || substr(field, 9)'
+                db.execute('delete from {0} where length(field) < {1}'.format(
+                    table, length))
+                for period in (6, 4):
+                    db.execute(
+                        'insert into {0} select key, substr(field, 1, {2}){3}, '
+                        'sum(count) from {0} where length(field) = {1} group '
+                        'by key, substr(field, 1, {2}){3}'.format(
+                            table, length, period, cohort))
+            db.execute(
+                "insert or replace into meta values ('rollups_built', ?)",
+                [arrow.utcnow().isoformat()])
+
+    def close(self):
+        with self.lock:
+            self._db.close()
+
+
+def open_local_storage(settings):
+    """
+    Opens the storage for STORAGE_BACKEND if it needs no Redis or SSDB
+    connection, otherwise returns None.
+    """
+
+    if settings['storage_backend'] == 'columnar':
+        return ColumnarStorage(settings['columnar_dir'])
+    if settings['storage_backend'] == 'sqlite':
+        return SQLiteStorage(settings['sqlite_path'],
+                             rollups=settings['rollups'])
+    return None
+
+
+def open_storage(helper):
+    """
+    Opens the storage for STORAGE_BACKEND, using the Redis and SSDB clients
+    of `helper` where needed.
+    """
+
+    storage = open_local_storage(helper.settings)
+    if storage is not None:
+        return storage
+    if helper.settings['storage_backend'] == 'packed':
+        return PackedStorage(helper)
+    return HashStorage(helper)
@@ -0,0 +1,201 @@
+import arrow, calendar, collections, datetime, heapq, operator
+
+try:
+    from .queries import FIRST_YEAR, METRIC_GROUPS, month_days
+except ImportError:
+    from queries import FIRST_YEAR, METRIC_GROUPS, month_days
+
+# Leaderboards of the most played and most viewed files, kept in Redis
+# whatever the STORAGE_BACKEND, like the watched categories:
+#
+#   top:<metric>:<YYYYMMDD>     sorted set of the TOP_K files of a day
+#   top:<metric>:<YYYY>W<ww>    the same for an ISO week, merged from its days
+#   top:<metric>:<YYYYMM>       the same for a month, merged from its days
+#
+# Members are filenames and scores are counts. The metrics are 'plays' for
+# playable files, 'images' for all loads of a static file and each of the
+# METRIC_GROUPS for loads of one size.
+#
+# LogProcessor writes a day's board while the day is ingested and merges the
+# week and month boards once it is published. A merged board sums the day
+# boards, so a file's count there is exact if it made the top of every day
+# and an undercount otherwise; boards are trimmed back to TOP_K after every
+# write. TOP_K of 0 turns the boards off; it is the default with the sqlite
+# and columnar backends, which otherwise run without Redis.
+TOP_METRICS = ['plays', 'images'] + METRIC_GROUPS
+
+
+def board_key(metric, period):
+    return 'top:{0}:{1}'.format(metric, period)
+
+
+def _date(date_string):
+    return datetime.date(
+        int(date_string[:4]), int(date_string[4:6]), int(date_string[6:8]))
+
+
+def week_period(date_string):
+    """
+    The ISO week of a day, as YYYYWww.
+    """
+
+    year, week, weekday = _date(date_string).isocalendar()
+    return '{0}W{1:02d}'.format(year, week)
+
+
+def week_days(date_string):
+    """
+    The YYYYMMDD strings of the ISO week of `date_string`, Monday first.
+    """
+
+    date = _date(date_string)
+    monday = date - datetime.timedelta(days=date.weekday())
+    return [(monday + datetime.timedelta(days=n)).strftime('%Y%m%d')
+            for n in range(7)]
+
+
+def board_periods(date_strings):
+    """
+    Covers a range of dates with as few boards as possible: the months it
+    spans completely, then the whole ISO weeks among the remaining days, then
+    single days. For all-time (None), every month since FIRST_YEAR.
+    """
+
+    if date_strings is None:
+        now = arrow.utcnow()
+        return [
+            '{0}{1:02d}'.format(year, month)
+            for year in range(FIRST_YEAR, now.year + 1)
+            for month in range(1, 13 if year < now.year else now.month + 1)
+        ]
+
+    periods = []
+    remaining = set(date_strings)
+
+    months = collections.defaultdict(set)
+    for date_string in remaining:
+        months[date_string[:6]].add(date_string)
+    for month, days in sorted(months.items()):
+        if len(days) == calendar.monthrange(int(month[:4]),
+                                            int(month[4:]))[1]:
+            periods.append(month)
+            remaining -= days
+
+    weeks = collections.defaultdict(set)
+    for date_string in remaining:
+        weeks[week_period(date_string)].add(date_string)
+    for week, days in sorted(weeks.items()):
+        if len(days) == 7:
+            periods.append(week)
+            remaining -= days
+
+    return periods + sorted(remaining)
+
+
+class DayTop:
+    """
+    Keeps the `k` files with the highest counts of each metric while a day's
+    rows stream past. Up to 2k candidates are kept per metric; past that they
+    are cut back to the top k, and rows below the lowest count kept are
+    skipped from then on. Exact where each file has one row. Mediacounts
+    can split a file over differently escaped names, such as A%20B and A+B;
+    their rows are summed while the file is a candidate, but a row skipped
+    below the lowest count is lost, so such a file can be undercounted or
+    left off the board.
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.candidates = {metric: {} for metric in TOP_METRICS}
+        self.floors = {metric: 0 for metric in TOP_METRICS}
+
+    def add(self, metric, filename, count):
+        if count <= self.floors[metric]:
+            return
+        candidates = self.candidates[metric]
+        candidates[filename] = candidates.get(filename, 0) + count
+        if len(candidates) >= 2 * self.k:
+            kept = self.board(metric)
+            self.candidates[metric] = dict(kept)
+            self.floors[metric] = kept[-1][1]
+
+    def add_block(self, playables, statics):
+        """
+        Adds the (playables, statics) lists `parse_batch` returns for a block.
+        """
+
+        for filename, originals, transcodes in playables:
+            self.add('plays', filename, originals + transcodes)
+        for row in statics:
+            self.add('images', row[0], row[1] + row[2] + row[3] + row[4])
+            for group_num, group_name in enumerate(METRIC_GROUPS):
+                self.add(group_name, row[0], row[group_num + 1])
+
+    def board(self, metric):
+        return heapq.nlargest(self.k, self.candidates[metric].items(),
+                              key=operator.itemgetter(1))
+
+    def boards(self):
+        return {metric: self.board(metric) for metric in TOP_METRICS}
+
+
+def write_day_boards(pipe, date_string, boards, k):
+    """
+    Queues the writes of a day's boards, as returned by `DayTop.boards`, on a
+    Redis pipeline. Counts are set rather than added, so boards written again
+    for the same rows are unchanged.
+    """
+
+    for metric, board in boards.items():
+        if len(board) > 0:
+            key = board_key(metric, date_string)
+            pipe.zadd(key, dict(board))
+            pipe.zremrangebyrank(key, 0, -(k + 1))
+
+
+def merge_boards(pipe, date_string, k):
+    """
+    Queues the rebuild of the week and month boards of a day from their day
+    boards on a Redis pipeline.
+    """
+
+    merges = [(week_period(date_string), week_days(date_string)),
+              (date_string[:6], month_days(date_string))]
+    for metric in TOP_METRICS:
+        for period, days in merges:
+            key = board_key(metric, period)
+            pipe.zunionstore(key, [board_key(metric, x) for x in days])
+            pipe.zremrangebyrank(key, 0, -(k + 1))
+
+
+def delete_day_boards(pipe, date_string, k):
+    """
+    Queues the deletion of a day's boards on a Redis pipeline, and the
+    rebuild of its week and month boards without it.
+    """
+
+    pipe.delete(*[board_key(x, date_string) for x in TOP_METRICS])
+    merge_boards(pipe, date_string, k)
+
+
+def rank(totals, n):
+    """
+    The top `n` of a dict of filename to count, as (filename, count) pairs
+    with ties broken by filename. Files with no count are left out.
+    """
+
+    return sorted(((x, y) for x, y in totals.items() if y > 0),
+                  key=lambda x: (-x[1], x[0]))[:n]
+
+
+def ranked(boards, n):
+    """
+    Sums the (member, score) lists read from several boards and returns their
+    top `n`, as `rank` does.
+    """
+
+    totals = collections.Counter()
+    for board in boards:
+        for member, score in board:
+            totals[member.decode('utf-8')] += int(score)
+    return rank(totals, n)
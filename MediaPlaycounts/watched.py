@@ -0,0 +1,204 @@
+import time
+
+try:
+    from .queries import (METRIC_GROUPS, READ_CHUNK, chunks, image_fields,
+                          watched_entry)
+except ImportError:
+    from queries import (METRIC_GROUPS, READ_CHUNK, chunks, image_fields,
+                         watched_entry)
+
+# Watched categories keep a compact series of daily totals, so that total-only
+# requests cost O(days) rather than O(files x days):
+#
+#   watched                              set of <mode>:<depth>:<category>
+#   cattotal:<mode>:<depth>:<category>   hash of YYYYMMDD (playable) or
+#                                        YYYYMMDD<group> (static) to a total
+#   catmembers:<mode>:<depth>:<category> set of the files the totals cover
+#
+# GetData reads the series and starts and stops watching; LogProcessor adds
+# each day it stores and drops each day it deletes.
+
+
+class WatchedCategories:
+    """
+    The series of the watched categories, kept in Redis whatever the
+    STORAGE_BACKEND and computed from the counts in `storage`. Manifests come
+    from `manifests`, a ManifestCache. When days are added, a category's
+    membership is brought up to date at most once every `ttl` seconds
+    (MANIFEST_TTL by default), so a long backfill does not resolve every
+    manifest again for each day.
+    """
+
+    def __init__(self, helper, storage, manifests, ttl=None):
+        if ttl is None:
+            ttl = helper.settings['manifest_ttl']
+        self.h = helper
+        self.storage = storage
+        self.manifests = manifests
+        self.ttl = ttl
+        self.synced = {}  # entry: (time of the last update, manifest)
+
+    def day_totals(self, manifest, mode, date_strings):
+        """
+        Returns the series fields and values for the given days of a manifest.
+        """
+
+        fields = {}
+        if mode == 'playable':
+            for date_string in date_strings:
+                fields[date_string] = 0
+            for counts in self.storage.playcounts(manifest,
+                                                  date_strings).values():
+                for date_string, count in counts:
+                    fields[date_string] += count
+        else:
+            for date_string in date_strings:
+                for group_num in range(len(METRIC_GROUPS)):
+                    fields[date_string + str(group_num)] = 0
+            for dates in self.storage.image_counts(manifest,
+                                                   date_strings).values():
+                for date_string, counts in dates.items():
+                    for group_num, count in enumerate(counts):
+                        fields[date_string + str(group_num)] += count
+        return fields
+
+    def total(self, category, depth, mode, date_strings):
+        """
+        Returns the total (playable) or list of group totals (static) for a
+        watched category over `date_strings`, or None if the category is not
+        watched or the series does not cover every date.
+        """
+
+        if date_strings is None:
+            return None
+
+        entry = watched_entry(category, depth, mode)
+        if not self.h.redis.sismember('watched', entry):
+            return None
+
+        if mode == 'playable':
+            values = self.h.redis.hmget('cattotal:' + entry, date_strings)
+            if None in values:
+                return None
+            return sum(int(x) for x in values)
+
+        fields = image_fields(date_strings)
+        values = self.h.redis.hmget('cattotal:' + entry, fields)
+        if None in values:
+            return None
+        total = [0, 0, 0, 0]
+        for field, value in zip(fields, values):
+            total[int(field[-1:])] += int(value)
+        return total
+
+    def watch(self, category, depth, mode, date_strings=None):
+        """
+        Starts keeping daily totals for a category, computing them for
+        `date_strings` straight away if given.
+        """
+
+        entry = watched_entry(category, depth, mode)
+        manifest = self.manifests.refresh(category, depth, mode)
+
+        pipe = self.h.redis.pipeline()
+        pipe.delete('catmembers:' + entry, 'cattotal:' + entry)
+        for chunk in chunks(manifest, READ_CHUNK):
+            pipe.sadd('catmembers:' + entry, *chunk)
+        pipe.sadd('watched', entry)
+        pipe.execute()
+        self.synced[entry] = (time.monotonic(), manifest)
+
+        if date_strings is not None:
+            self.h.redis.hset('cattotal:' + entry,
+                              mapping=self.day_totals(manifest, mode,
+                                                      date_strings))
+
+    def unwatch(self, category, depth, mode):
+        entry = watched_entry(category, depth, mode)
+        self.h.redis.srem('watched', entry)
+        self.h.redis.delete('cattotal:' + entry, 'catmembers:' + entry)
+        self.synced.pop(entry, None)
+
+    def _update_members(self, category, depth, mode, entry):
+        """
+        Brings a watched category's membership up to date. Files that joined
+        or left since the last update have their counts added to or taken off
+        the days already in the series; days they had no counts on are not
+        touched. Returns the current manifest.
+        """
+
+        manifest = self.manifests.refresh(category, depth, mode)
+        members = set(x.decode('utf-8')
+                      for x in self.h.redis.sscan_iter('catmembers:' + entry,
+                                                       count=READ_CHUNK))
+        added = sorted(set(manifest) - members)
+        removed = sorted(members - set(manifest))
+        if len(added) == 0 and len(removed) == 0:
+            return manifest
+
+        days = sorted(set(x.decode('utf-8')[:8]
+                          for x in self.h.redis.hkeys('cattotal:' + entry)))
+        pipe = self.h.redis.pipeline()
+        if len(days) > 0:
+            for files, sign in [(added, 1), (removed, -1)]:
+                for field, count in self.day_totals(files, mode,
+                                                    days).items():
+                    if count != 0:
+                        pipe.hincrby('cattotal:' + entry, field,
+                                     sign * count)
+        for chunk in chunks(added, READ_CHUNK):
+            pipe.sadd('catmembers:' + entry, *chunk)
+        for chunk in chunks(removed, READ_CHUNK):
+            pipe.srem('catmembers:' + entry, *chunk)
+        pipe.execute()
+
+        self.h.success_log(
+            'Updated membership of {0}: {1} added, {2} removed'.format(
+                entry, len(added), len(removed)))
+        return manifest
+
+    def _manifest(self, entry):
+        """
+        The manifest the series of `entry` covers, updating its membership
+        first if that was last done more than `ttl` seconds ago.
+        """
+
+        now = time.monotonic()
+        if entry in self.synced and now - self.synced[entry][0] < self.ttl:
+            return self.synced[entry][1]
+
+        mode, depth, category = entry.split(':', 2)
+        manifest = self._update_members(category, int(depth), mode, entry)
+        self.synced[entry] = (now, manifest)
+        return manifest
+
+    def add_days(self, date_strings):
+        """
+        Adds days that were just stored to the series of every watched
+        category.
+        """
+
+        for entry in sorted(x.decode('utf-8')
+                            for x in self.h.redis.smembers('watched')):
+            manifest = self._manifest(entry)
+            if len(date_strings) > 0:
+                self.h.redis.hset('cattotal:' + entry,
+                                  mapping=self.day_totals(
+                                      manifest, entry.split(':', 1)[0],
+                                      date_strings))
+
+    def drop_days(self, date_strings):
+        """
+        Removes days from every watched category's series, e.g. after they
+        were deleted from the store. Requests covering them fall back to the
+        per-file path until the days are ingested again.
+        """
+
+        pipe = self.h.redis.pipeline(transaction=False)
+        for entry in self.h.redis.smembers('watched'):
+            entry = entry.decode('utf-8')
+            fields = list(date_strings)
+            if entry.startswith('static:'):
+                fields = image_fields(date_strings)
+            pipe.hdel('cattotal:' + entry, *fields)
+        pipe.execute()
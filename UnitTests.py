@@ -1,9 +0,0 @@
-import unittest
-import arrow
-import csv
-import pymysql
-import random
-from . import MediaPlaycounts
-
-# TODO: Rewrite unit tests
-# :(
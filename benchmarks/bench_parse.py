@@ -0,0 +1,130 @@
+"""
+Micro-benchmark for the mediacounts row parser.
+
+Generates a synthetic block of mediacounts rows, checks that `parse` and
+`parse_batch` return exactly what the original per-row parser returned, and
+times all three.
+
+    python benchmarks/bench_parse.py [rows] [repeats]
+"""
+
+import os, random, re, sys, timeit, urllib.parse
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                    'MediaPlaycounts'))
+
+from mediacounts import parse, parse_batch
+
+
+def reference_parse(row):
+    """
+    The parser as it was before the fast path, kept verbatim as the baseline.
+    """
+
+    video_regex = re.compile('.*\.(mid|ogg|ogv|wav|webm|flac|oga)')
+
+    columns = row.split('\t')
+    if len(columns) < 2:  # Not a real row
+        return
+    base_name = columns[0]
+
+    for column_num, column in enumerate(columns):
+        if column == '-':
+            columns[column_num] = 0
+        elif column_num > 0:  # column 0 is the name row
+            columns[column_num] = int(column)
+
+    original = columns[3]
+    playable_transcoded = columns[4] + columns[16]
+    thumbnails = {
+        '0-399': columns[8] + columns[9],
+        '400-799': columns[10] + columns[11],
+        '800': columns[12] + columns[13]
+    }
+
+    if columns[3] + columns[4] + columns[7] + columns[16] > 0:
+        # First we must determine if this is a media file
+        components = base_name.split('/')
+        # /wikipedia/commons/x/xx/FILENAME
+        if len(components) == 6:
+            if components[1] == 'wikipedia' and components[2] == 'commons':
+                if len(components[3]) == 1 and len(components[4]) == 2:
+                    filename = urllib.parse.unquote_plus(components[5])
+                    if re.match(video_regex, filename) is not None:
+                        return (filename, original, playable_transcoded,
+                                'playable')
+                    else:
+                        return (filename, original, thumbnails, 'static')
+
+
+def synthetic_rows(count, seed=0):
+    """
+    Roughly the mix of a real dump: mostly non-Commons and thumbnail paths,
+    some Commons originals, a few of them playable.
+    """
+
+    rng = random.Random(seed)
+    prefixes = [
+        '/wikipedia/en/a/ab/', '/wikipedia/commons/thumb/a/ab/',
+        '/wikipedia/commons/a/ab/', '/wikipedia/commons/transcoded/a/ab/',
+        '/wikipedia/de/c/cd/'
+    ]
+    extensions = ['jpg', 'png', 'svg', 'ogg', 'webm', 'ogv', 'flac', 'tif']
+    rows = []
+
+    for n in range(count):
+        name = rng.choice(prefixes) + 'File_%E2%80%93_{0}.{1}'.format(
+            n, rng.choice(extensions))
+        columns = [name]
+        for column in range(1, 25):
+            # The reference parser cannot read '-' in the last column
+            if rng.random() < 0.3 and column < 24:
+                columns.append('-')
+            else:
+                columns.append(str(rng.randint(0, 20)))
+        rows.append('\t'.join(columns) + '\n')
+
+    return rows
+
+
+def as_batch(results):
+    playables = []
+    statics = []
+    for result in results:
+        if result is None:
+            continue
+        filename, original, transcodes, filetype = result
+        if filetype == 'playable':
+            playables.append((filename, original, transcodes))
+        else:
+            statics.append((filename, original, transcodes['0-399'],
+                            transcodes['400-799'], transcodes['800']))
+    return playables, statics
+
+
+def main(count=200000, repeats=3):
+    rows = synthetic_rows(count)
+
+    expected = [reference_parse(row) for row in rows]
+    assert [parse(row) for row in rows] == expected, 'parse() differs'
+    assert parse_batch(rows) == as_batch(expected), 'parse_batch() differs'
+    print('Outputs identical on {0} rows ({1} media rows)'.format(
+        count, len([x for x in expected if x is not None])))
+
+    timings = [
+        ('reference parse', lambda: [reference_parse(row) for row in rows]),
+        ('parse', lambda: [parse(row) for row in rows]),
+        ('parse_batch', lambda: parse_batch(rows)),
+    ]
+    baseline = None
+    for name, func in timings:
+        seconds = min(timeit.repeat(func, number=1, repeat=repeats))
+        if baseline is None:
+            baseline = seconds
+        print('{0:<16} {1:>12,.0f} rows/s  {2:5.1f}x'.format(
+            name, count / seconds, baseline / seconds))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,377 @@
+"""
+Benchmark suite for the ingest and query hot paths.
+
+Generates mediacounts dumps and a category tree, ingests the dumps with
+LogProcessor and times the GetData entry points against them, then reports
+ingest rows/s, p50/p99 latency per entry point and peak memory. Everything
+runs locally: counts go to the sqlite (or columnar) storage backend in a
+temporary directory, an in-memory SQLite database stands in for the Commons
+replica, and fakeredis, which is required, for Redis. The configured servers
+are never touched.
+
+    python benchmarks/bench_suite.py --rows 200000 --output before.json
+    python benchmarks/bench_suite.py --rows 200000 --compare before.json
+
+Run with --help for the size of the data and the other options.
+"""
+
+import argparse, bz2, datetime, json, os, random, re, resource, sqlite3
+import subprocess, sys, tempfile, time, types
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'MediaPlaycounts'))
+
+PLAYABLE = ['ogg', 'webm', 'ogv', 'oga', 'flac', 'wav', 'mid']
+STATIC = ['jpg', 'png', 'svg', 'tif', 'gif', 'pdf']
+OTHER_WIKIS = ['en', 'de', 'fr', 'ja', 'es']
+
+
+class Commons:
+    """
+    Stand-in for the Commons replica: an in-memory SQLite database with the
+    page and categorylinks columns GetData queries. MySQL's %s placeholders
+    and REGEXP are mapped onto SQLite's.
+    """
+
+    def __init__(self):
+        self.db = sqlite3.connect(':memory:', check_same_thread=False)
+        self.db.create_function(
+            'regexp', 2, lambda pattern, value: re.search(
+                pattern, value.decode('utf-8')) is not None)
+        self.db.execute('create table page (page_id integer primary key, '
+                        'page_namespace integer, page_title blob)')
+        self.db.execute('create table categorylinks (cl_from integer, '
+                        'cl_to text, cl_type text)')
+        self.db.execute('create index cl_to on categorylinks (cl_to)')
+        self.pages = 0
+
+    def add(self, title, namespace, categories, link_type):
+        self.pages += 1
+        self.db.execute('insert into page values (?, ?, ?)',
+                        (self.pages, namespace, title.encode('utf-8')))
+        self.db.executemany('insert into categorylinks values (?, ?, ?)',
+                            [(self.pages, x, link_type) for x in categories])
+
+    def query(self, query, params):
+        return self.db.execute(query.replace('%s', '?'), params).fetchall()
+
+    def query_iter(self, query, params, fetch_size=10000):
+        for row in self.query(query, params):
+            yield row
+
+
+def category_tree(commons, fanout, depth):
+    """
+    Adds a tree of categories under Bench, `fanout` children per category
+    and `depth` levels deep. Returns the names of all its categories.
+    """
+
+    categories = ['Bench']
+    level = ['Bench']
+    for n in range(depth):
+        children = []
+        for parent in level:
+            for child in range(fanout):
+                name = '{0}_{1}'.format(parent, child)
+                commons.add(name, 14, [parent], 'subcat')
+                children.append(name)
+        categories += children
+        level = children
+    return categories
+
+
+def media_files(count, playable, rng):
+    return [
+        'Bench_file_{0}.{1}'.format(
+            n, rng.choice(PLAYABLE if rng.random() < playable else STATIC))
+        for n in range(count)
+    ]
+
+
+def dump_rows(files, rows, commons_share, rng):
+    """
+    Rows of one day's dump: a Commons original row for each of `files`, the
+    rest of `rows` other wikis and thumbnails, sorted by path like the real
+    dumps. Counts are skewed, as most files get few requests.
+    """
+
+    lines = []
+    for filename in files:
+        lines.append(_row('/wikipedia/commons/a/ab/' + filename, rng))
+    for n in range(rows - len(files)):
+        if rng.random() < commons_share:
+            path = '/wikipedia/commons/thumb/a/ab/Thumb_{0}.jpg'.format(n)
+        else:
+            path = '/wikipedia/{0}/a/ab/Other_{1}.jpg'.format(
+                rng.choice(OTHER_WIKIS), n)
+        lines.append(_row(path, rng))
+    lines.sort()
+    return lines
+
+
+def _row(path, rng):
+    columns = [path]
+    for column in range(1, 25):
+        if rng.random() < 0.3:
+            columns.append('-')
+        else:
+            columns.append(str(int(rng.paretovariate(1.5)) - 1))
+    return '\t'.join(columns) + '\n'
+
+
+def write_dump(directory, date, lines):
+    filename = 'mediacounts.{0}.v00.tsv.bz2'.format(
+        date.format('YYYY-MM-DD'))
+    with bz2.open(os.path.join(directory, filename), 'wt') as f:
+        f.writelines(lines)
+
+
+def bench_config(directory, backend):
+    """
+    Settings for the run, installed as the config module before anything
+    imports helper: all paths in `directory`, no real servers.
+    """
+
+    config = types.ModuleType('config')
+    config.__dict__.update(
+        REDIS_HOST='localhost', REDIS_PORT=6379, SSDB_HOST='localhost',
+        SSDB_PORT=8888, COMMONS_HOST='localhost', COMMONS_PORT=3306,
+        COMMONS_DB='commonswiki', SQL_USER='', SQL_PASS='', GOOGLE_API='',
+        SUCCESS_LOG=os.path.join(directory, 'success.log'),
+        ERROR_LOG=os.path.join(directory, 'error.log'),
+        FAILED_DAYS=os.path.join(directory, 'failed_days.txt'),
+        CHECKPOINT_FILE=os.path.join(directory, 'checkpoints.json'),
+        STORAGE_BACKEND=backend,
+        SQLITE_PATH=os.path.join(directory, 'counts.db'),
+        COLUMNAR_DIR=directory)
+    return config
+
+
+def peak_memory_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak / 1024
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def latencies(func, repeats):
+    """
+    Calls `func` once to warm up (manifests are cached after the first
+    call), then `repeats` times. Returns the timings in milliseconds.
+    """
+
+    func()
+    timings = []
+    for n in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=ROOT).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def run(args, directory):
+    rng = random.Random(args.seed)
+    sys.modules['config'] = bench_config(directory, args.backend)
+
+    import arrow, GetData, LogProcessor
+
+    commons = Commons()
+    redis = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+    for h in (GetData.h, LogProcessor.h):
+        h.query_commons = commons.query
+        h.query_commons_iter = commons.query_iter
+        h.redis = redis
+
+    categories = category_tree(commons, args.fanout, args.depth)
+    files = media_files(args.files, args.playable, rng)
+    for filename in files:
+        commons.add(filename, 6, rng.sample(categories, 2), 'file')
+    playable = [x for x in files if x.rsplit('.', 1)[1] in PLAYABLE]
+    static = [x for x in files if x.rsplit('.', 1)[1] not in PLAYABLE]
+
+    first = arrow.get('20200101', 'YYYYMMDD')
+    dates = [first.replace(days=n) for n in range(args.days)]
+    for date in dates:
+        write_dump(directory, date,
+                   dump_rows(files, args.rows, args.commons, rng))
+
+    results = {}
+
+    start = time.perf_counter()
+    LogProcessor.run(dates, batch_size=args.batch_size, source=directory)
+    seconds = time.perf_counter() - start
+    results['ingest'] = {
+        'rows': args.rows * args.days,
+        'seconds': seconds,
+        'rows_per_sec': args.rows * args.days / seconds,
+        'peak_memory_mb': peak_memory_mb()
+    }
+
+    if args.backend != 'columnar':
+        date = first.replace(days=args.days).format('YYYYMMDD')
+        start = time.perf_counter()
+        for filename in playable[:args.store_calls]:
+            LogProcessor.store('redis', 'mpc:', filename, date, 1)
+        seconds = time.perf_counter() - start
+        results['store'] = {
+            'calls': min(args.store_calls, len(playable)),
+            'calls_per_sec': min(args.store_calls, len(playable)) / seconds
+        }
+
+    end = dates[-1].format('YYYYMMDD')
+    begin = first.format('YYYYMMDD')
+    cases = [
+        ('file_playcount',
+         lambda: GetData.file_playcount(rng.choice(playable),
+                                        start_date=begin, end_date=end)),
+        ('file_playcount totals',
+         lambda: GetData.file_playcount(rng.choice(playable), details=False)),
+        ('image_single_viewcount',
+         lambda: GetData.image_single_viewcount(rng.choice(static),
+                                                start_date=begin,
+                                                end_date=end)),
+        ('category_playcount',
+         lambda: GetData.category_playcount('Bench', depth=args.depth,
+                                            start_date=begin, end_date=end)),
+        ('category_playcount totals',
+         lambda: GetData.category_playcount('Bench', depth=args.depth,
+                                            start_date=begin, end_date=end,
+                                            details=False)),
+        ('image_category_viewcount',
+         lambda: GetData.image_category_viewcount(
+             'Bench', depth=args.depth, start_date=begin, end_date=end)),
+        # Looks at the watched categories in Redis first
+        ('category_playcount total only',
+         lambda: GetData.category_playcount(
+             'Bench', depth=args.depth, start_date=begin, end_date=end,
+             details=False, per_file=False)),
+    ]
+
+    results['queries'] = {}
+    for name, func in cases:
+        timings = latencies(func, args.repeats)
+        results['queries'][name] = {
+            'p50_ms': percentile(timings, 0.5),
+            'p99_ms': percentile(timings, 0.99),
+            'mean_ms': sum(timings) / len(timings)
+        }
+    results['peak_memory_mb'] = peak_memory_mb()
+    return results
+
+
+def report(results, previous=None):
+    """
+    Prints the results, with the change from `previous` results if given.
+    """
+
+    def change(path, value, higher_is_better):
+        old = previous
+        for key in path:
+            old = (old or {}).get(key)
+        if not old:
+            return ''
+        ratio = value / old
+        if not higher_is_better:
+            ratio = 1 / ratio if ratio else 0
+        return '  {0:5.2f}x {1}'.format(
+            ratio, 'better' if ratio >= 1 else 'worse')
+
+    ingest = results['ingest']
+    print('ingest     {0:>12,.0f} rows/s{1}'.format(
+        ingest['rows_per_sec'],
+        change(['ingest', 'rows_per_sec'], ingest['rows_per_sec'], True)))
+    if 'store' in results:
+        print('store      {0:>12,.0f} calls/s{1}'.format(
+            results['store']['calls_per_sec'],
+            change(['store', 'calls_per_sec'],
+                   results['store']['calls_per_sec'], True)))
+    for name, timings in results['queries'].items():
+        print('{0:<30} p50 {1:8.2f} ms  p99 {2:8.2f} ms{3}'.format(
+            name, timings['p50_ms'], timings['p99_ms'],
+            change(['queries', name, 'p50_ms'], timings['p50_ms'], False)))
+    print('peak memory {0:.1f} MB{1}'.format(
+        results['peak_memory_mb'],
+        change(['peak_memory_mb'], results['peak_memory_mb'], False)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='rows per daily dump')
+    parser.add_argument('--days', type=int, default=3)
+    parser.add_argument('--files', type=int, default=5000,
+                        help='Commons media files, each in every dump')
+    parser.add_argument('--commons', type=float, default=0.5,
+                        help='share of the other rows that are Commons '
+                        'thumbnails rather than other wikis')
+    parser.add_argument('--playable', type=float, default=0.2,
+                        help='share of the media files that are playable')
+    parser.add_argument('--fanout', type=int, default=4,
+                        help='subcategories per category')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='levels of subcategories')
+    parser.add_argument('--backend', choices=['sqlite', 'columnar'],
+                        default='sqlite')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--store-calls', type=int, default=1000)
+    parser.add_argument('--repeats', type=int, default=50,
+                        help='timed calls per entry point')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--compare',
+                        help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    if fakeredis is None:
+        # Without it, the watched categories and leaderboards would go to
+        # whatever Redis listens on localhost
+        sys.exit('The benchmark needs fakeredis to stand in for Redis: '
+                 'pip install fakeredis')
+
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            results = run(args, directory)
+        finally:
+            # The logs are buffered; write them out, even after a failure,
+            # before the directory goes
+            if 'LogProcessor' in sys.modules:
+                sys.modules['LogProcessor'].h.flush_logs()
+
+    previous = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+    report(results, previous)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'commit': commit(),
+                'time': datetime.datetime.utcnow().isoformat() + 'Z',
+                'python': sys.version.split()[0],
+                'parameters': vars(args),
+                'results': results
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+import atexit, os, re, shutil, sys, tempfile, types
+import pytest
+
+# The modules are imported the way the scripts run them, from inside the
+# MediaPlaycounts directory, with a config module of test settings installed
+# before anything imports helper. Logs and checkpoints go to a temporary
+# directory; no real server is ever touched.
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'MediaPlaycounts'))
+
+DIRECTORY = tempfile.mkdtemp(prefix='mediaplaycounts-tests-')
+# Registered before helper's own atexit flush of the logs, so it runs after
+atexit.register(shutil.rmtree, DIRECTORY, True)
+
+config = types.ModuleType('config')
+config.__dict__.update(
+    REDIS_HOST='localhost', REDIS_PORT=6379, SSDB_HOST='localhost',
+    SSDB_PORT=8888, COMMONS_HOST='localhost', COMMONS_PORT=3306,
+    COMMONS_DB='commonswiki', SQL_USER='', SQL_PASS='', GOOGLE_API='',
+    SUCCESS_LOG=os.path.join(DIRECTORY, 'success.log'),
+    ERROR_LOG=os.path.join(DIRECTORY, 'error.log'),
+    FAILED_DAYS=os.path.join(DIRECTORY, 'failed_days.txt'),
+    CHECKPOINT_FILE=os.path.join(DIRECTORY, 'checkpoints.json'),
+    STORAGE_BACKEND='redis', TOP_K=5)
+sys.modules['config'] = config
+
+
+def _bytes(value):
+    return value if isinstance(value, bytes) else str(value).encode('utf-8')
+
+
+class FakeSSDB:
+    """
+    In-memory stand-in for the SSDB hash commands the storage backends send,
+    replying as pyssdb decodes them: flat [key, value, ...] lists of bytes for
+    the multi-value commands, ints for sizes.
+    """
+
+    def __init__(self):
+        self.hashes = {}
+
+    def batch(self, commands):
+        return [getattr(self, x[0])(*x[1:]) for x in commands]
+
+    def _hash(self, name):
+        return self.hashes.setdefault(_bytes(name), {})
+
+    def _pairs(self, items):
+        reply = []
+        for key, value in items:
+            reply += [key, value]
+        return reply
+
+    def hincr(self, name, key, amount):
+        fields = self._hash(name)
+        fields[_bytes(key)] = _bytes(
+            int(fields.get(_bytes(key), b'0')) + int(amount))
+        return int(fields[_bytes(key)])
+
+    def multi_hset(self, name, *pairs):
+        fields = self._hash(name)
+        for n in range(0, len(pairs), 2):
+            fields[_bytes(pairs[n])] = _bytes(pairs[n + 1])
+        return len(pairs) // 2
+
+    def multi_hget(self, name, *keys):
+        fields = self._hash(name)
+        return self._pairs((_bytes(x), fields[_bytes(x)]) for x in keys
+                           if _bytes(x) in fields)
+
+    def multi_hdel(self, name, *keys):
+        fields = self._hash(name)
+        for key in keys:
+            fields.pop(_bytes(key), None)
+        return len(keys)
+
+    def hgetall(self, name):
+        return self._pairs(sorted(self._hash(name).items()))
+
+    def hsize(self, name):
+        return len(self._hash(name))
+
+    def hclear(self, name):
+        return len(self.hashes.pop(_bytes(name), {}))
+
+    def hscan(self, name, start, end, limit):
+        start, end = _bytes(start), _bytes(end) or b'\xff'
+        return self._pairs(
+            sorted(x for x in self._hash(name).items()
+                   if start < x[0] <= end)[:limit])
+
+    def hlist(self, start, end, limit):
+        start, end = _bytes(start), _bytes(end) or b'\xff'
+        return sorted(x for x, fields in self.hashes.items()
+                      if start < x <= end and len(fields) > 0)[:limit]
+
+
+class FakeCommons:
+    """
+    Stand-in for the Commons replica, answering the category queries of the
+    queries module from `subcategories`, {category: [subcategory, ...]}, and
+    `files`, {category: [filename, ...]}. Every query is kept in `queries`.
+    """
+
+    def __init__(self, subcategories, files):
+        self.subcategories = subcategories
+        self.files = files
+        self.queries = []
+
+    def query(self, query, params):
+        self.queries.append((query, params))
+        if "cl_type = 'subcat'" in query:
+            return [(x.encode('utf-8'), ) for category in params
+                    for x in self.subcategories.get(category, [])]
+
+        playable = 'not regexp' not in query
+        return [(x.encode('utf-8'), ) for category in params[:-1]
+                for x in self.files.get(category, [])
+                if bool(re.search(params[-1], x)) == playable]
+
+    async def fetch(self, query, params):
+        return self.query(query, params)
+
+    async def close(self):
+        pass
+
+
+class AsyncFakeSSDB:
+    """
+    FakeSSDB behind the interface of AsyncGetData's SSDB client.
+    """
+
+    def __init__(self, ssdb):
+        self.ssdb = ssdb
+
+    async def batch(self, commands):
+        return self.ssdb.batch(commands)
+
+    async def close(self):
+        pass
+
+
+@pytest.fixture
+def servers(monkeypatch):
+    """
+    Points the helpers of LogProcessor and GetData at one fakeredis server
+    and one FakeSSDB. Returns (redis client, FakeSSDB).
+    """
+
+    fakeredis = pytest.importorskip('fakeredis')
+    import GetData, LogProcessor
+
+    redis = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+    ssdb = FakeSSDB()
+    for h in (LogProcessor.h, GetData.h):
+        monkeypatch.setattr(h, 'redis', redis)
+        monkeypatch.setattr(h, '_ssdb', ssdb)
+        monkeypatch.setattr(h, 'ssdb_batch', ssdb.batch)
+    return redis, ssdb
+
+
+@pytest.fixture(params=['redis', 'sqlite'])
+def backend(request, servers, tmp_path, monkeypatch):
+    """
+    LogProcessor and GetData writing to and reading from one storage backend:
+    Redis and SSDB hashes, or a SQLite file.
+    """
+
+    import GetData, LogProcessor, storage
+
+    if request.param == 'sqlite':
+        store = storage.SQLiteStorage(str(tmp_path / 'counts.db'))
+    else:
+        store = storage.HashStorage(LogProcessor.h)
+        store.mark_rollups_built()
+    monkeypatch.setattr(LogProcessor, 'storage', store)
+    monkeypatch.setattr(GetData, 'storage', store)
+    yield store
+    if request.param == 'sqlite':
+        store.close()
+
+
+@pytest.fixture
+def no_redis(monkeypatch):
+    """
+    Points the helpers of LogProcessor and GetData at a port nothing listens
+    on, so that every Redis command fails as it would with no Redis running.
+    """
+
+    import redis, socket, GetData, LogProcessor
+    from redis.backoff import NoBackoff
+    from redis.retry import Retry
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    client = redis.Redis(host='127.0.0.1', port=port,
+                         retry=Retry(NoBackoff(), 0))
+    for h in (LogProcessor.h, GetData.h):
+        monkeypatch.setattr(h, 'redis', client)
+    return client
+
+
+@pytest.fixture
+def sqlite(tmp_path, monkeypatch):
+    """
+    LogProcessor and GetData on a SQLite file, with no other servers set up.
+    """
+
+    import GetData, LogProcessor, storage
+
+    store = storage.SQLiteStorage(str(tmp_path / 'counts.db'))
+    monkeypatch.setattr(LogProcessor, 'storage', store)
+    monkeypatch.setattr(GetData, 'storage', store)
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def checkpoints():
+    """
+    Removes the CHECKPOINT_FILE after the test, so that days stored by one
+    test are not skipped by the next.
+    """
+
+    import LogProcessor
+
+    path = LogProcessor.h.settings['checkpoint_file']
+    yield path
+    if os.path.exists(path):
+        os.remove(path)
+
+
+@pytest.fixture
+def commons(monkeypatch):
+    """
+    GetData walking the categories of a FakeCommons, which the test fills in,
+    with an empty manifest cache.
+    """
+
+    import GetData
+    from cache import LRUCache
+
+    commons = FakeCommons({}, {})
+    monkeypatch.setattr(GetData.h, 'query_commons', commons.query)
+    monkeypatch.setattr(GetData.h, 'query_commons_iter', commons.query)
+    monkeypatch.setattr(GetData.manifests, 'local', LRUCache())
+    return commons
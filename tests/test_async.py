@@ -0,0 +1,71 @@
+import asyncio
+import pytest
+
+import GetData, LogProcessor
+from AsyncGetData import AsyncGetData
+from conftest import AsyncFakeSSDB
+
+CALLS = [
+    ('file_playcount', ('A.webm', ), {}),
+    ('file_playcount', ('A.webm', ), {'start_date': '20200301',
+                                      'end_date': '20200302'}),
+    ('file_playcount', ('B.ogg', ), {'start_date': '20200301',
+                                     'end_date': '20200331',
+                                     'details': False}),
+    ('file_playcount', ('Missing.webm', ), {'details': False}),
+    ('category_playcount', ('Cats', ), {'start_date': '20200301',
+                                        'end_date': '20200302'}),
+    ('category_playcount', ('Cats', ), {'depth': 1, 'details': False}),
+    ('category_playcount', ('Cats', ), {'start_date': '20200201',
+                                        'end_date': '20200331',
+                                        'details': False,
+                                        'per_file': False}),
+]
+
+
+def _ingest(store):
+    writer = LogProcessor.BatchWriter(batch_size=3, replace=True)
+    for date_string, counts in (('20200301', {'A.webm': 2, 'B.ogg': 1}),
+                                ('20200302', {'A.webm': 5, 'D.webm': 4})):
+        for filename, count in counts.items():
+            writer.add('redis', 'mpc:', filename, date_string, count)
+    writer.flush()
+    store.publish_day('20200301', 100)
+    store.publish_day('20200302', 100)
+
+
+async def _async_results(data):
+    try:
+        return [await getattr(data, name)(*args, **kwargs)
+                for name, args, kwargs in CALLS]
+    finally:
+        await data.close()
+
+
+def test_async_matches_getdata(backend, servers, commons):
+    fakeredis = pytest.importorskip('fakeredis')
+    redis, ssdb = servers
+    # A cycle back to the top, and a file in two categories
+    commons.subcategories.update({'Cats': ['Kittens', 'Lions'],
+                                  'Kittens': ['Cats'],
+                                  'Lions': ['Lion_cubs']})
+    commons.files.update({'Cats': ['A.webm', 'C.jpg'],
+                          'Kittens': ['B.ogg', 'A.webm'],
+                          'Lion_cubs': ['D.webm']})
+    _ingest(backend)
+
+    settings = dict(GetData.h.settings)
+    if hasattr(backend, 'path'):
+        settings.update(storage_backend='sqlite', sqlite_path=backend.path)
+    data = AsyncGetData(
+        redis=fakeredis.aioredis.FakeRedis(
+            server=redis.connection_pool.connection_kwargs['server']),
+        ssdb=AsyncFakeSSDB(ssdb),
+        commons=commons,
+        settings=settings)
+
+    expected = [getattr(GetData, name)(*args, **kwargs)
+                for name, args, kwargs in CALLS]
+    assert asyncio.run(_async_results(data)) == expected
+    assert expected[4]['total'] == 12
+    assert expected[5]['total'] == 8
@@ -0,0 +1,86 @@
+import pytest
+
+import cache
+
+
+class Builds:
+    """
+    Manifest builder recording what it was asked to build.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, category, depth, mode='playable'):
+        self.calls.append((category, depth, mode))
+        return ['{0}_{1}_{2}.webm'.format(category, depth, len(self.calls))]
+
+
+@pytest.fixture(params=['local', 'redis'])
+def manifests(request, servers):
+    redis, ssdb = servers
+    return cache.ManifestCache(
+        Builds(), redis=redis if request.param == 'redis' else None, ttl=60)
+
+
+def test_cached_until_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    manifests = cache.ManifestCache(Builds(), ttl=60, max_entries=2)
+
+    first = manifests.get('Cats', 1)
+    now[0] += 59
+    assert manifests.get('Cats', 1) == first
+    now[0] += 1
+    assert manifests.get('Cats', 1) != first
+    assert len(manifests.build.calls) == 2
+
+    # Least recently used entries go first
+    manifests.get('Dogs', 1)
+    manifests.get('Cats', 1)
+    manifests.get('Birds', 1)
+    manifests.get('Cats', 1)
+    manifests.get('Dogs', 1)
+    assert [x[0] for x in manifests.build.calls[2:]] == [
+        'Dogs', 'Birds', 'Dogs']
+
+
+def test_redis_ttl(servers):
+    redis, ssdb = servers
+    manifests = cache.ManifestCache(Builds(), redis=redis, ttl=60)
+    manifest = manifests.get('Cats', 1)
+    assert 0 < redis.ttl(cache.manifest_key('Cats', 1, 'playable')) <= 60
+
+    # Expired, as far as Redis is concerned
+    redis.delete(cache.manifest_key('Cats', 1, 'playable'))
+    assert manifests.get('Cats', 1) != manifest
+
+
+def test_no_ttl():
+    manifests = cache.ManifestCache(Builds(), ttl=0)
+    manifests.get('Cats', 1)
+    manifests.get('Cats', 1)
+    assert len(manifests.build.calls) == 2
+
+
+def test_invalidate(manifests):
+    entries = [('Cats', 1, 'playable'), ('Cats', 2, 'playable'),
+               ('Cats', 1, 'static'), ('Big cats', 1, 'playable'),
+               ('Cats*', 1, 'playable'), ('Dogs', 1, 'playable')]
+
+    def rebuilt(*args, **kwargs):
+        for entry in entries:
+            manifests.get(*entry)
+        manifests.build.calls = []
+        manifests.invalidate(*args, **kwargs)
+        for entry in entries:
+            manifests.get(*entry)
+        return manifests.build.calls
+
+    assert rebuilt('Cats') == entries[:3]
+    assert rebuilt('Cats', depth=1) == [entries[0], entries[2]]
+    assert rebuilt(mode='static') == [entries[2]]
+    # Glob characters in names match only themselves
+    assert rebuilt('Cats*') == [entries[4]]
+    assert rebuilt('Big cats', 1, 'playable') == [entries[3]]
+    assert rebuilt() == entries
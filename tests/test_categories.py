@@ -0,0 +1,50 @@
+import types
+
+import categories
+from conftest import FakeCommons
+
+
+def _helper(commons):
+    return types.SimpleNamespace(query_commons=commons.query,
+                                 query_commons_iter=commons.query)
+
+
+def _queried(commons):
+    # The categories asked for in subcategory queries, in order
+    return [x for query, params in commons.queries
+            if "'subcat'" in query for x in params]
+
+
+def test_diamond():
+    commons = FakeCommons({'Top_cat': ['B', 'C'], 'B': ['D'], 'C': ['D'],
+                           'D': ['E']},
+                          {'B': ['One.webm', 'Two.jpg'], 'D': ['One.webm'],
+                           'E': ['Three.ogg']})
+    helper = _helper(commons)
+
+    assert categories.find_subcategories(helper, 'Top cat') == [
+        'B', 'C', 'D', 'E']
+    # One query per level, and the shared subcategory is walked once
+    assert _queried(commons) == ['Top_cat', 'B', 'C', 'D', 'E']
+    assert len(commons.queries) == 4
+
+    assert categories.find_subcategories(helper, 'Top cat', depth=2) == [
+        'B', 'C', 'D']
+    assert categories.find_subcategories(helper, 'Top cat', depth=0) == [
+        'Top cat']
+    assert categories.category_files(helper, 'Top cat', 9) == [
+        'One.webm', 'Three.ogg']
+    assert categories.category_files(helper, 'Top cat', 9,
+                                     mode='static') == ['Two.jpg']
+
+
+def test_cycle(monkeypatch):
+    # Queries of two categories at a time
+    monkeypatch.setattr(categories, 'IN_CHUNK', 2)
+    commons = FakeCommons({'A': ['B', 'C', 'D'], 'B': ['A'], 'C': ['E'],
+                           'E': ['C', 'A']}, {})
+
+    assert categories.find_subcategories(_helper(commons), 'A') == [
+        'B', 'C', 'D', 'E']
+    assert sorted(_queried(commons)) == ['A', 'B', 'C', 'D', 'E']
+    assert [len(params) for query, params in commons.queries] == [1, 2, 1, 1]
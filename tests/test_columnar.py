@@ -0,0 +1,22 @@
+import columnar
+
+
+def test_columnar_round_trip(tmp_path):
+    rows = {'A.webm': [1, 2, 0, 0, 0], 'B é.jpg': [3, 0, 4, 5, 6]}
+    columnar.write_day(str(tmp_path), '20200101', rows)
+    columnar.write_day(str(tmp_path), '20200102', {'A.webm': [0, 7, 0, 0, 0]})
+
+    store = columnar.ColumnarStore(str(tmp_path), max_open=1)
+    assert store.dates() == ['20200101', '20200102']
+    assert store.playcounts(['A.webm', 'C.webm'], None) == {
+        'A.webm': [('20200101', 3), ('20200102', 7)], 'C.webm': []}
+    assert store.playcounts(['A.webm'], ['20200102', '20200103']) == {
+        'A.webm': [('20200102', 7), ('20200103', 0)]}
+    assert store.image_counts(['B é.jpg'], ['20200101', '20200102']) == {
+        'B é.jpg': {'20200101': [3, 4, 5, 6], '20200102': [0, 0, 0, 0]}}
+
+    # Only one day stays mapped; the other was closed on the way out
+    assert list(store.open_days) == ['20200102']
+    store.forget('20200102')
+    assert len(store.open_days) == 0
+    store.close()
@@ -0,0 +1,67 @@
+import bz2, threading
+import arrow, pytest
+
+import LogProcessor
+
+DATE = arrow.get('20200301', 'YYYYMMDD')
+
+
+def _dump(tmp_path, data):
+    path = tmp_path / LogProcessor._dump_filename(DATE)
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_multiple_streams(tmp_path, monkeypatch):
+    # Small chunks, so that streams and lines end partway through them
+    monkeypatch.setattr(LogProcessor, 'CHUNK_SIZE', 7)
+    lines = ['File_{0}.webm\t{0}\n'.format(n) for n in range(100)]
+    text = ''.join(lines)
+    # The second stream starts in the middle of a line
+    data = bz2.compress(text[:500].encode('utf-8')) + \
+        bz2.compress(text[500:].encode('utf-8'))
+
+    assert list(LogProcessor.download(DATE, source=_dump(tmp_path, data))) \
+        == lines
+
+
+def test_truncated_stream(tmp_path):
+    first = bz2.compress(b'A.webm\t1\n')
+    second = bz2.compress(b'B.webm\t2\n')
+
+    path = _dump(tmp_path, first + second[:-4])
+    with pytest.raises(RuntimeError, match='Truncated dump: ' + path):
+        list(LogProcessor.download(DATE, source=path))
+    # Ending between streams is a complete file
+    assert list(LogProcessor.download(
+        DATE, source=_dump(tmp_path, first))) == ['A.webm\t1\n']
+
+
+def test_prefetch_stops_on_close():
+    closed = threading.Event()
+
+    def chunks():
+        try:
+            n = 0
+            while True:
+                n += 1
+                yield str(n).encode('utf-8')
+        finally:
+            closed.set()
+
+    prefetched = LogProcessor._prefetch(chunks(), depth=2)
+    assert next(prefetched) == b'1'
+    prefetched.close()
+    # The thread notices within its put timeout and closes the source
+    assert closed.wait(5)
+
+
+def test_prefetch_raises_errors():
+    def chunks():
+        yield b'1'
+        raise IOError('connection reset')
+
+    prefetched = LogProcessor._prefetch(chunks())
+    assert next(prefetched) == b'1'
+    with pytest.raises(IOError, match='connection reset'):
+        next(prefetched)
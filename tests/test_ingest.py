@@ -0,0 +1,195 @@
+import bz2, os
+import arrow, pytest
+
+import GetData, helper, LogProcessor, storage
+from queries import month_days
+
+
+def _totals(store, filename, date_strings):
+    return store.playcount_totals([filename], date_strings)[filename]
+
+
+def test_increments_add_up(backend):
+    writer = LogProcessor.BatchWriter(batch_size=2)
+    writer.add('redis', 'mpc:', 'A.webm', '20200101', 2)
+    writer.add('redis', 'mpc:', 'A.webm', '20200101', 3)
+    writer.add('redis', 'mpc:', 'A.webm', '20200102', 4)
+    writer.add('redis', 'mpc:', 'B.webm', '20200101', 1)
+    writer.flush()
+    LogProcessor.store('redis', 'mpc:', 'A.webm', '20200101', 10)
+
+    assert backend.playcounts(['A.webm'], ['20200101', '20200102']) == {
+        'A.webm': [('20200101', 15), ('20200102', 4)]}
+    # Read from the month and year rollups the increments kept up to date
+    assert _totals(backend, 'A.webm', month_days('20200101')) == 19
+    assert _totals(backend, 'A.webm', None) == 19
+
+
+def _row(filename, original=0, transcoded=0, thumbnails=0):
+    columns = ['/wikipedia/commons/a/ab/' + filename] + ['-'] * 24
+    columns[3] = str(original)
+    columns[4] = str(transcoded)
+    columns[8] = str(thumbnails)
+    return '\t'.join(columns) + '\n'
+
+
+def _write_dump(directory, date_string, lines):
+    date = arrow.get(date_string, 'YYYYMMDD')
+    with bz2.open(str(directory / LogProcessor._dump_filename(date)),
+                  'wt') as f:
+        f.writelines(lines)
+    return date
+
+
+def _errors():
+    LogProcessor.h.flush_logs()
+    if not os.path.exists(LogProcessor.h.settings['error_log']):
+        return ''
+    with open(LogProcessor.h.settings['error_log']) as f:
+        return f.read()
+
+
+def test_top_k_default(monkeypatch):
+    monkeypatch.delattr(helper.config, 'TOP_K')
+    assert helper.load_settings()['top_k'] == 1000
+    monkeypatch.setattr(helper.config, 'STORAGE_BACKEND', 'sqlite')
+    assert helper.load_settings()['top_k'] == 0
+
+
+def test_boards_are_best_effort(sqlite, no_redis, checkpoints, tmp_path):
+    # Leaderboards asked for, but there is no Redis to keep them in
+    assert LogProcessor.h.settings['top_k'] > 0
+    date = _write_dump(tmp_path, '20200301', [_row('A.webm', original=5)])
+    LogProcessor.run([date], source=str(tmp_path))
+
+    assert sqlite.playcounts(['A.webm'], ['20200301']) == {
+        'A.webm': [('20200301', 5)]}
+    assert 'Failed to write the leaderboards of 20200301' in _errors()
+
+
+def test_delete_without_redis(sqlite, no_redis, checkpoints, tmp_path):
+    date = _write_dump(tmp_path, '20200301', [_row('A.webm', original=5)])
+    LogProcessor.run([date], source=str(tmp_path))
+
+    LogProcessor.delete_date(date)
+    assert sqlite.playcounts(['A.webm'], ['20200301']) == {
+        'A.webm': [('20200301', 0)]}
+    assert 'Failed to update watched categories for 20200301' in _errors()
+
+    # The day is no longer listed as done, so it is ingested again
+    _write_dump(tmp_path, '20200301', [_row('A.webm', original=7)])
+    LogProcessor.run([date], source=str(tmp_path))
+    assert sqlite.playcounts(['A.webm'], ['20200301']) == {
+        'A.webm': [('20200301', 7)]}
+
+
+def test_sqlite_needs_no_servers(sqlite, no_redis, checkpoints, tmp_path,
+                                 monkeypatch):
+    monkeypatch.setitem(LogProcessor.h.settings, 'top_k', 0)
+    dates = [
+        _write_dump(tmp_path, '20200301',
+                    [_row('Cat_video.webm', original=2, transcoded=1),
+                     _row('Cat.jpg', original=1, thumbnails=6)]),
+        _write_dump(tmp_path, '20200302',
+                    [_row('Cat_video.webm', original=4)])
+    ]
+    LogProcessor.run(dates, source=str(tmp_path))
+
+    result = GetData.file_playcount('Cat video.webm', start_date='20200301',
+                                    end_date='20200302')
+    assert result['total'] == 7
+    assert [x['count'] for x in result['details']] == [3, 4]
+    assert GetData.file_playcount('Cat_video.webm', start_date='20200301',
+                                  end_date='20200331',
+                                  details=False)['total'] == 7
+    assert GetData.image_single_viewcount('Cat.jpg', start_date='20200301',
+                                          end_date='20200301')['total'] == 7
+
+
+def test_replace_overwrites(backend):
+    LogProcessor.store('redis', 'mpc:', 'A.webm', '20200101', 10)
+
+    for amount in (5, 3):
+        writer = LogProcessor.BatchWriter(batch_size=1, replace=True)
+        writer.add('redis', 'mpc:', 'A.webm', '20200101', amount)
+        writer.add('redis', 'mpc:', 'A.webm', '20200102', 1)
+        writer.flush()
+    backend.publish_day('20200101', 100)
+    backend.publish_day('20200102', 100)
+
+    assert backend.playcounts(['A.webm'], ['20200101', '20200102']) == {
+        'A.webm': [('20200101', 3), ('20200102', 1)]}
+    assert _totals(backend, 'A.webm', month_days('20200101')) == 4
+
+
+@pytest.mark.parametrize('sort_run', [LogProcessor.SORT_RUN, 7])
+def test_run_sums_whole_day(backend, checkpoints, tmp_path, monkeypatch,
+                            sort_run):
+    # A small SORT_RUN spills the day to several runs, so the differently
+    # escaped names for the same file end up in different ones
+    monkeypatch.setattr(LogProcessor, 'SORT_RUN', sort_run)
+    lines = [_row('A%20B.webm', original=5)]
+    lines += [_row('Filler_{0}.webm'.format(n), original=1)
+              for n in range(50)]
+    lines += [_row('A+B.webm', original=2, transcoded=3),
+              _row('C.jpg', original=1, thumbnails=4)]
+    date = _write_dump(tmp_path, '20200301', lines)
+
+    for attempt in range(2):
+        LogProcessor.run([date], batch_size=10, source=str(tmp_path))
+        os.remove(checkpoints)
+
+    assert backend.playcounts(['A B.webm'], ['20200301']) == {
+        'A B.webm': [('20200301', 10)]}
+    assert _totals(backend, 'A B.webm', month_days('20200301')) == 10
+    assert backend.image_counts(['C.jpg'], ['20200301']) == {
+        'C.jpg': {'20200301': [1, 4, 0, 0]}}
+    assert backend.playcounts(['Filler_49.webm'], ['20200301']) == {
+        'Filler_49.webm': [('20200301', 1)]}
+
+
+def test_merged_fields(tmp_path, monkeypatch):
+    monkeypatch.setattr(LogProcessor, 'SORT_RUN', 2)
+    date = _write_dump(tmp_path, '20200301', [
+        _row('B.webm', original=1), _row('A.webm', original=2),
+        _row('C.webm', original=3), _row('A.webm', original=4)])
+    runs = LogProcessor._sort_day(date, str(tmp_path), None, str(tmp_path))
+
+    assert len(runs) == 2
+    assert list(LogProcessor._merged_fields(runs)) == [
+        ('redis', 'mpc:A.webm', '20200301', 6),
+        ('redis', 'mpc:B.webm', '20200301', 1),
+        ('redis', 'mpc:C.webm', '20200301', 3)]
+
+
+def test_backfill_retries_missing_days(backend, checkpoints, tmp_path,
+                                       monkeypatch):
+    # Workers write their own days to SQLite. fakeredis lives in this
+    # process, so there they leave their days on disk for it to write, as
+    # for backends that cannot take writes from several processes.
+    if not isinstance(backend, storage.SQLiteStorage):
+        monkeypatch.setattr(backend, 'parallel_writes', False)
+    monkeypatch.setitem(LogProcessor.h.settings, 'mediacounts_source',
+                        str(tmp_path))
+    missing = arrow.get('20200302', 'YYYYMMDD')
+    dates = [
+        _write_dump(tmp_path, '20200301', [_row('A.webm', original=1)]),
+        missing,
+        _write_dump(tmp_path, '20200303', [_row('A.webm', original=3)])
+    ]
+    before = _errors().count('Backfill failed for 20200302')
+
+    assert LogProcessor.backfill(dates, workers=2, retries=1) == [missing]
+    assert _errors().count('Backfill failed for 20200302') == before + 2
+    with open(LogProcessor.h.settings['failed_days']) as f:
+        assert f.read() == '20200302\n'
+    assert backend.playcounts(['A.webm'], month_days('20200301')[:3]) == {
+        'A.webm': [('20200301', 1), ('20200302', 0), ('20200303', 3)]}
+
+    # The days stored are skipped when the failed ones are retried
+    _write_dump(tmp_path, '20200302', [_row('A.webm', original=2)])
+    _write_dump(tmp_path, '20200303', [_row('A.webm', original=30)])
+    LogProcessor.process_args(['retry'])
+    with open(LogProcessor.h.settings['failed_days']) as f:
+        assert f.read() == ''
+    assert _totals(backend, 'A.webm', month_days('20200301')) == 6
@@ -0,0 +1,117 @@
+import asyncio, inspect, json, os
+
+import metrics, server
+
+
+def _metrics():
+    registry = metrics.Metrics()
+    registry.configure(enabled=True)
+    return registry
+
+
+def test_prometheus_format():
+    registry = _metrics()
+    registry.count('ingest_lines_total', 10)
+    registry.count('ingest_days_total', result='failed')
+    registry.count('ingest_days_total', 2, result='stored')
+    for seconds in (0.002, 0.5, 100):
+        registry.observe('ingest_stage_seconds', seconds, stage='parse')
+    registry.observe('getdata_request_seconds', 0.02, function='a"b\\c')
+
+    lines = registry.prometheus().split('\n')
+    assert lines[:5] == [
+        '# TYPE mediaplaycounts_ingest_days_total counter',
+        'mediaplaycounts_ingest_days_total{result="failed"} 1',
+        'mediaplaycounts_ingest_days_total{result="stored"} 2',
+        '# TYPE mediaplaycounts_ingest_lines_total counter',
+        'mediaplaycounts_ingest_lines_total 10',
+    ]
+    assert lines[5] == \
+        '# TYPE mediaplaycounts_getdata_request_seconds histogram'
+    # Label values are escaped
+    assert lines[6] == ('mediaplaycounts_getdata_request_seconds_bucket'
+                        '{function="a\\"b\\\\c",le="0.001"} 0')
+
+    parse = [x for x in lines if 'stage="parse"' in x]
+    # Buckets are cumulative and end with +Inf
+    assert parse[0] == ('mediaplaycounts_ingest_stage_seconds_bucket'
+                        '{stage="parse",le="0.001"} 0')
+    assert parse[1].endswith('le="0.005"} 1')
+    assert parse[5].endswith('le="0.5"} 2')
+    assert parse[10].endswith('le="300"} 3')
+    assert parse[11].endswith('le="+Inf"} 3')
+    assert parse[12] == \
+        'mediaplaycounts_ingest_stage_seconds_sum{stage="parse"} 100.502'
+    assert parse[13] == \
+        'mediaplaycounts_ingest_stage_seconds_count{stage="parse"} 3'
+    assert lines[-1] == ''
+
+
+def test_export(tmp_path):
+    registry = _metrics()
+    registry.count('ingest_lines_total', 10)
+    registry.configure(enabled=True, directory=str(tmp_path))
+    registry.export('logprocessor')
+    registry.configure(enabled=True, directory=str(tmp_path), format='json')
+    registry.export('logprocessor')
+
+    assert sorted(os.listdir(str(tmp_path))) == [
+        'mediaplaycounts_logprocessor.json',
+        'mediaplaycounts_logprocessor.prom']
+    with open(str(tmp_path / 'mediaplaycounts_logprocessor.json')) as f:
+        assert json.load(f)['counters'] == [{
+            'name': 'mediaplaycounts_ingest_lines_total', 'labels': {},
+            'value': 10}]
+
+
+def test_drain_and_merge():
+    worker = _metrics()
+    worker.count('ingest_lines_total', 3)
+    worker.observe('ingest_stage_seconds', 0.2, stage='write')
+    parent = _metrics()
+    parent.count('ingest_lines_total', 1)
+
+    parent.merge(worker.drain())
+    assert worker.prometheus() == '\n'
+    assert 'mediaplaycounts_ingest_lines_total 4' in parent.prometheus()
+    assert parent.sums('ingest_stage_seconds') == {(('stage', 'write'), ): 0.2}
+
+
+def test_timed_keeps_signatures(monkeypatch):
+    registry = _metrics()
+    for name, endpoint in server.ENDPOINTS.items():
+        # As GetData's endpoints are with METRICS on
+        timed = registry.timed('getdata_request_seconds', function=name)(
+            inspect.unwrap(endpoint))
+        assert timed is not inspect.unwrap(endpoint)
+        assert inspect.signature(timed) == inspect.signature(endpoint)
+        assert timed.__name__ == name
+
+        query = {'start_date': ['20200101'], 'end_date': ['20200105']}
+        for parameter in inspect.signature(endpoint).parameters.values():
+            if parameter.default is inspect.Parameter.empty:
+                query[parameter.name] = ['X']
+        expected = server.request_args(name, query)
+        monkeypatch.setitem(server.ENDPOINTS, name, timed)
+        assert server.request_args(name, query) == expected
+
+
+def test_timed_records():
+    registry = _metrics()
+
+    @registry.timed('getdata_request_seconds', function='plain')
+    def plain(a, b=2):
+        return a + b
+
+    @registry.timed('getdata_request_seconds', function='coroutine')
+    async def coroutine(a, b=2):
+        return a * b
+
+    assert plain(1) == 3
+    assert inspect.iscoroutinefunction(coroutine)
+    assert asyncio.run(coroutine(3)) == 6
+    assert sorted(registry.sums('getdata_request_seconds')) == [
+        (('function', 'coroutine'), ), (('function', 'plain'), )]
+
+    disabled = metrics.Metrics()
+    assert disabled.timed('getdata_request_seconds')(plain) is plain
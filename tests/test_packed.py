@@ -0,0 +1,75 @@
+import packed
+from queries import packed_reads
+
+
+def _read(stored, key, date_strings, slots):
+    # What the packed backend reads back: the byte range of each year
+    pieces = []
+    for year, first, name, start, length in packed_reads(key, date_strings,
+                                                         slots):
+        pieces.append((year, first,
+                       stored.get(name, b'')[start:start + length]))
+    return pieces
+
+
+def test_play_round_trip():
+    fields = {'20200101': 3, '20200229': 7, '20201231': 1, '20210315': 2,
+              '202003': 99, '2020': 99}  # rollups are not packed
+    stored = {
+        packed.packed_key('mpc:A.webm', year): data
+        for year, data in packed.pack_fields(fields, packed.PLAY_SLOTS).items()
+    }
+    assert sorted(stored) == ['mpcy:A.webm:2020', 'mpcy:A.webm:2021']
+
+    date_strings = ['20200228', '20200229', '20200301']
+    assert packed.play_counts(
+        _read(stored, 'mpc:A.webm', date_strings, packed.PLAY_SLOTS),
+        date_strings) == [('20200228', 0), ('20200229', 7), ('20200301', 0)]
+    assert packed.play_counts(
+        _read(stored, 'mpc:A.webm', None, packed.PLAY_SLOTS), None) == [
+            ('20200101', 3), ('20200229', 7), ('20201231', 1),
+            ('20210315', 2)]
+
+
+def test_image_round_trip():
+    fields = {'202001010': 5, '202001013': 2, '202001022': 4}
+    data = packed.pack_fields(fields, packed.IMAGE_SLOTS)['2020']
+    stored = {'imgy:abc:2020': data}
+
+    date_strings = ['20200101', '20200102', '20200103']
+    assert packed.image_counts(
+        _read(stored, 'img:abc', date_strings, packed.IMAGE_SLOTS),
+        date_strings) == {'20200101': [5, 0, 0, 2],
+                          '20200102': [0, 0, 4, 0],
+                          '20200103': [0, 0, 0, 0]}
+    # The trailing zero of the last day is trimmed off, and read back as zero
+    assert len(data) == 7 * packed.WIDTH
+    assert packed.image_counts([('2020', 1, data[16:])], None) == {
+        '20200102': [0, 0, 4, 0]}
+
+
+def test_keys():
+    assert packed.packed_key('img:abc', '2020') == 'imgy:abc:2020'
+    assert packed.hash_key('mpcy:A:B.webm:2020') == ('mpc:A:B.webm', '2020')
+    assert packed.day_index('20201231') == 365
+    assert packed.index_date('2021', 0) == '20210101'
+
+
+def test_increment_saturates():
+    data = bytearray()
+    packed.increment(data, 2, 0, 1, 5)
+    packed.increment(data, 2, 0, 1, -9)
+    assert list(packed.unpack(data)) == [0, 0, 0]
+    packed.put(data, 1, 0, 1, packed.MAX_COUNT)
+    packed.increment(data, 1, 0, 1, 1)
+    assert packed.unpack(data)[1] == packed.MAX_COUNT
+
+
+def test_add_and_trim():
+    first = packed.pack_fields({'20200101': 1, '20200105': 2}, 1)['2020']
+    second = packed.pack_fields({'20200102': 3}, 1)['2020']
+    assert list(packed.unpack(packed.add(first, second))) == [1, 3, 0, 0, 2]
+
+    data = bytearray(first)
+    packed.clear_day(data, 4, 1)
+    assert packed.trim(data) == packed.pack_fields({'20200101': 1}, 1)['2020']
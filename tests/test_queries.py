@@ -0,0 +1,44 @@
+import arrow
+
+from queries import (FIRST_YEAR, month_days, range_dates, range_fields,
+                     rollup_fields)
+
+
+def test_range_fields_days():
+    assert range_fields(['20200102', '20200101']) == ['20200101', '20200102']
+
+
+def test_range_fields_months_and_edges():
+    date_strings = range_dates('20200130', '20200302')
+    assert range_fields(date_strings) == [
+        '20200130', '20200131', '202002', '20200301', '20200302']
+
+
+def test_range_fields_leap_february():
+    assert range_fields(month_days('20200201')) == ['202002']
+    assert range_fields(month_days('20200201')[:-1]) == \
+        month_days('20200201')[:-1]
+
+
+def test_range_fields_years():
+    date_strings = range_dates('20191231', '20210101')
+    assert range_fields(date_strings) == ['20191231', '2020', '20210101']
+
+
+def test_range_fields_all_time():
+    fields = range_fields(None)
+    assert fields[0] == str(FIRST_YEAR)
+    assert fields[-1] == str(arrow.utcnow().year)
+
+
+def test_range_fields_cover_each_day_once():
+    date_strings = range_dates('20190315', '20210620')
+    covered = []
+    for field in range_fields(date_strings):
+        covered += [x for x in date_strings if x.startswith(field)]
+    assert covered == date_strings
+
+
+def test_rollup_fields():
+    assert rollup_fields('20200215') == ['202002', '2020']
+    assert rollup_fields('202002153') == ['2020023', '20203']
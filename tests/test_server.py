@@ -0,0 +1,119 @@
+import functools
+import arrow, pytest
+
+import server
+
+
+def _days_ago(days):
+    return arrow.utcnow().replace(days=-days).format('YYYYMMDD')
+
+
+def test_request_args_normalized():
+    args = server.request_args('category_playcount', {
+        'category': ['Videos of cats'],
+        'depth': ['2'],
+        'start_date': ['20200101'],
+        'end_date': ['20200105'],
+        'details': ['False']
+    })
+    assert args == {'category': 'Videos_of_cats', 'depth': 2,
+                    'start_date': '20200101', 'end_date': '20200105',
+                    'last': None, 'details': False, 'per_file': True}
+
+
+def test_request_args_last():
+    args = server.request_args('file_playcount',
+                               {'filename': ['A.webm'], 'last': ['3']})
+    assert (args['start_date'], args['end_date'], args['last']) == (
+        _days_ago(3), _days_ago(1), None)
+
+
+def test_request_args_all_time():
+    args = server.request_args('file_playcount', {'filename': ['A.webm']})
+    assert args['start_date'] is None and args['end_date'] is None
+
+
+@pytest.mark.parametrize('query', [
+    {},
+    {'filename': ['A.webm'], 'colour': ['red']},
+    {'filename': ['A.webm'], 'details': ['maybe']},
+    {'filename': ['A.webm'], 'last': ['many']},
+])
+def test_request_args_rejected(query):
+    with pytest.raises(ValueError):
+        server.request_args('file_playcount', query)
+
+
+def test_cache_policy():
+    settings = server.h.settings
+    past = server.request_args('file_playcount', {
+        'filename': ['A.webm'], 'start_date': ['20200101'],
+        'end_date': ['20200131']})
+    assert server.cache_policy('file_playcount', past) == (
+        settings['server_past_ttl'], True)
+
+    recent = server.request_args('file_playcount', {
+        'filename': ['A.webm'], 'last': ['7']})
+    assert server.cache_policy('file_playcount', recent) == (
+        settings['server_ttl'], False)
+
+    category = server.request_args('category_playcount', {
+        'category': ['Cats'], 'start_date': ['20200101'],
+        'end_date': ['20200131']})
+    assert server.cache_policy('category_playcount', category) == (
+        min(settings['server_past_ttl'], settings['manifest_ttl']), False)
+
+    all_time = server.request_args('file_playcount', {'filename': ['A.webm']})
+    assert server.cache_policy('file_playcount', all_time) == (
+        settings['server_ttl'], False)
+
+
+@pytest.fixture
+def endpoint(monkeypatch):
+    """
+    Replaces file_playcount with a stub that records its calls, keeping the
+    signature the request arguments are read from.
+    """
+
+    calls = []
+    real = server.ENDPOINTS['file_playcount']
+
+    @functools.wraps(real)
+    def stub(**args):
+        calls.append(args)
+        return {'name': args['filename'], 'total': 3}
+
+    monkeypatch.setitem(server.ENDPOINTS, 'file_playcount', stub)
+    return calls
+
+
+def test_respond_etag(endpoint):
+    cache = server.ResponseCache()
+    path = '/file_playcount?filename=A+B.webm&start_date=20200101' \
+        '&end_date=20200102'
+
+    status, headers, body = server.respond(cache, path)
+    assert status == 200
+    assert body == b'{"name": "A_B.webm", "total": 3}'
+    assert headers['Cache-Control'].endswith(', immutable')
+    etag = headers['ETag']
+
+    # The same request spelled differently is answered from the cache
+    status, headers, body = server.respond(
+        cache, '/file_playcount?end_date=20200102&filename=A_B.webm'
+        '&start_date=20200101', if_none_match='"other", ' + etag)
+    assert (status, headers['ETag'], body) == (304, etag, b'')
+    assert len(endpoint) == 1
+
+    status, headers, body = server.respond(cache, path,
+                                           if_none_match='"other"')
+    assert status == 200
+
+
+def test_respond_errors(endpoint):
+    cache = server.ResponseCache()
+    assert server.respond(cache, '/nothing')[0] == 404
+    status, headers, body = server.respond(cache, '/file_playcount?last=x')
+    assert status == 400
+    assert headers['Cache-Control'] == 'no-store'
+    assert len(endpoint) == 0
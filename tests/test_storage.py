@@ -0,0 +1,85 @@
+import arrow
+
+import LogProcessor, storage
+from queries import month_days, range_dates
+
+
+def _totals(store, filename, date_strings):
+    return store.playcount_totals([filename], date_strings)[filename]
+
+
+def test_publish_day_rollups(servers):
+    redis, ssdb = servers
+    store = storage.HashStorage(LogProcessor.h)
+    fields = {
+        'redis': {('mpc:A.webm', '20200131'): 2,
+                  ('mpc:A.webm', '20200201'): 3,
+                  ('mpc:A.webm', '20200202'): 4},
+        'ssdb': {('img:abc', '202002010'): 5,
+                 ('img:abc', '202002022'): 6}
+    }
+    store.write(fields, replace=True)
+    assert redis.hget('mpc:A.webm', '202002') is None
+
+    for date_string in ('20200131', '20200201', '20200202'):
+        store.publish_day(date_string, 1)
+    assert redis.hmget('mpc:A.webm', ['202001', '202002', '2020']) == [
+        b'2', b'7', b'9']
+    assert ssdb.multi_hget('img:abc', '2020020', '2020022', '20200',
+                           '20202') == [b'2020020', b'5', b'2020022', b'6',
+                                        b'20200', b'5', b'20202', b'6']
+
+    # Publishing again recomputes rather than adds
+    store.publish_day('20200202', 1)
+    assert redis.hget('mpc:A.webm', '2020') == b'9'
+
+
+def test_totals_wait_for_rollups(servers):
+    store = storage.HashStorage(LogProcessor.h)
+    store.write({'redis': {('mpc:A.webm', '20200201'): 3,
+                           ('mpc:A.webm', '202002'): 1},
+                 'ssdb': {}})
+    # The rollup is stale until the rollups are built; the days are summed
+    assert not store.rollups_built()
+    assert _totals(store, 'A.webm', month_days('20200201')) == 3
+
+    store.mark_rollups_built()
+    assert _totals(store, 'A.webm', month_days('20200201')) == 1
+
+
+def test_backends_agree(servers, tmp_path, monkeypatch):
+    hashes = storage.HashStorage(LogProcessor.h)
+    hashes.mark_rollups_built()
+    sqlite = storage.SQLiteStorage(str(tmp_path / 'counts.db'))
+
+    for store in (hashes, sqlite):
+        monkeypatch.setattr(LogProcessor, 'storage', store)
+        writer = LogProcessor.BatchWriter(batch_size=7)
+        for n, date in enumerate(arrow.Arrow.range(
+                'day', arrow.get('20191225', 'YYYYMMDD'),
+                arrow.get('20200210', 'YYYYMMDD'))):
+            date_string = date.format('YYYYMMDD')
+            writer.add('redis', 'mpc:', 'A.webm', date_string, n % 5)
+            if n % 3 == 0:
+                writer.add('redis', 'mpc:', 'B.ogg', date_string, n)
+            writer.add('ssdb', 'img:', 'C.jpg', date_string + str(n % 4), n)
+        writer.flush()
+
+    playable = ['A.webm', 'B.ogg', 'Missing.webm']
+    static = ['C.jpg', 'Missing.jpg']
+    for date_strings in (None, range_dates('20191201', '20200228'),
+                         range_dates('20200101', '20200131'), ['20200105']):
+        assert hashes.playcounts(playable, date_strings) == \
+            sqlite.playcounts(playable, date_strings)
+        assert hashes.playcount_totals(playable, date_strings) == \
+            sqlite.playcount_totals(playable, date_strings)
+        assert hashes.image_counts(static, date_strings) == \
+            sqlite.image_counts(static, date_strings)
+        assert hashes.image_totals(static, date_strings) == \
+            sqlite.image_totals(static, date_strings)
+
+    for store in (hashes, sqlite):
+        store.delete_date('20200105', 100)
+    assert hashes.playcount_totals(playable, None) == \
+        sqlite.playcount_totals(playable, None)
+    sqlite.close()
@@ -0,0 +1,82 @@
+import random
+
+import top
+
+
+def test_day_top_matches_exact_ranking():
+    rng = random.Random(0)
+    counts = {'File_{0}.webm'.format(n): int(rng.paretovariate(1.2))
+              for n in range(500)}
+    day = top.DayTop(5)
+    for filename, count in counts.items():
+        day.add('plays', filename, count)
+
+    board = day.board('plays')
+    assert [x[1] for x in board] == \
+        sorted(counts.values(), reverse=True)[:5]
+    assert all(counts[x] == y for x, y in board)
+    # Candidates are cut back as they go, never past 2k
+    assert len(day.candidates['plays']) < 10
+
+
+def test_day_top_blocks():
+    day = top.DayTop(2)
+    day.add_block([('A.webm', 1, 2), ('B.webm', 5, 0)],
+                  [('C.jpg', 1, 2, 3, 4), ('D.jpg', 0, 0, 0, 1)])
+    boards = day.boards()
+    assert boards['plays'] == [('B.webm', 5), ('A.webm', 3)]
+    assert boards['images'] == [('C.jpg', 10), ('D.jpg', 1)]
+    assert boards['800+'] == [('C.jpg', 4), ('D.jpg', 1)]
+    assert boards['original'] == [('C.jpg', 1)]
+
+
+def test_merge_boards(servers):
+    redis, ssdb = servers
+    pipe = redis.pipeline()
+    top.write_day_boards(pipe, '20200302', {
+        'plays': [('A.webm', 5), ('B.webm', 4), ('C.webm', 1)]}, 3)
+    top.write_day_boards(pipe, '20200303', {
+        'plays': [('B.webm', 3), ('D.webm', 2)]}, 3)
+    top.write_day_boards(pipe, '20200310', {'plays': [('C.webm', 9)]}, 3)
+    top.merge_boards(pipe, '20200303', 2)
+    pipe.execute()
+
+    week = redis.zrevrange(top.board_key('plays', '2020W10'), 0, -1,
+                           withscores=True)
+    month = redis.zrevrange(top.board_key('plays', '202003'), 0, -1,
+                            withscores=True)
+    assert top.ranked([week], 10) == [('B.webm', 7), ('A.webm', 5)]
+    assert top.ranked([month], 10) == [('C.webm', 10), ('B.webm', 7)]
+
+    # Without the day, the boards are rebuilt from the days left
+    pipe = redis.pipeline()
+    top.delete_day_boards(pipe, '20200303', 2)
+    pipe.execute()
+    week = redis.zrevrange(top.board_key('plays', '2020W10'), 0, -1,
+                           withscores=True)
+    assert top.ranked([week], 10) == [('A.webm', 5), ('B.webm', 4)]
+
+
+def test_board_periods():
+    date_strings = ['201912{0:02d}'.format(x) for x in range(23, 32)] + \
+        ['202001{0:02d}'.format(x) for x in range(1, 32)] + ['20200201']
+    assert top.board_periods(date_strings) == [
+        '202001', '2019W52', '20191230', '20191231', '20200201']
+    assert top.week_days('20200101')[0] == '20191230'
+
+
+def test_day_top_split_rows():
+    day = top.DayTop(1)
+    day.add('plays', 'A B.webm', 3)
+    day.add('plays', 'C.webm', 4)
+    day.add('plays', 'D.webm', 5)
+    # Cut back to D.webm; the second row of A B.webm, escaped differently in
+    # the dump, is now below the lowest count and is skipped
+    day.add('plays', 'A B.webm', 4)
+    assert day.board('plays') == [('D.webm', 5)]
+
+    # Rows of a file that stays a candidate are summed
+    day = top.DayTop(2)
+    day.add('plays', 'A B.webm', 3)
+    day.add('plays', 'A B.webm', 4)
+    assert day.board('plays') == [('A B.webm', 7)]
@@ -0,0 +1,196 @@
+import http.server, json, threading, time
+from urllib.parse import parse_qs, urlparse
+import pytest
+
+import GetData, YouTubeProcessor
+
+
+class YouTubeAPI(http.server.BaseHTTPRequestHandler):
+    """
+    Local stand-in for the videos endpoint. Replies with the (status, reasons)
+    pairs queued in `errors` first, then with a view count for every ID,
+    its length. The IDs of every request are kept in `requests`.
+    """
+
+    errors = []
+    requests = []
+
+    def do_GET(self):
+        ids = parse_qs(urlparse(self.path).query)['id'][0].split(',')
+        self.requests.append(ids)
+        if len(self.errors) > 0:
+            status, reasons = self.errors.pop(0)
+            body = {'error': {'errors': [{'reason': x} for x in reasons]}}
+        else:
+            status = 200
+            body = {'items': [{'id': x, 'statistics': {'viewCount': len(x)}}
+                              for x in ids]}
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def youtube(servers, monkeypatch):
+    """
+    YouTubeProcessor on fakeredis, calling a local YouTubeAPI with no pauses
+    between retries. Returns the fakeredis client.
+    """
+
+    redis, ssdb = servers
+    YouTubeAPI.errors, YouTubeAPI.requests = [], []
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), YouTubeAPI)
+    threading.Thread(target=server.serve_forever, args=(0.05, ),
+                     daemon=True).start()
+
+    settings = YouTubeProcessor.h.settings
+    monkeypatch.setattr(YouTubeProcessor.h, 'redis', redis)
+    monkeypatch.setitem(settings, 'youtube_api_url',
+                        'http://127.0.0.1:{0}/'.format(server.server_port))
+    monkeypatch.setitem(settings, 'youtube_backoff', 0)
+    monkeypatch.setitem(settings, 'youtube_retries', 2)
+    monkeypatch.setitem(settings, 'youtube_quota', 100)
+    yield redis
+    server.shutdown()
+    server.server_close()
+
+
+def test_site_is_lazy(youtube):
+    # Importing reads no pywikibot configuration, nor do cached lookups
+    assert YouTubeProcessor.site is None
+    youtube.set('com2yt:A.webm', 'abc')
+    youtube.zadd('com2ytmissing', {'B.webm': time.time()})
+    assert YouTubeProcessor.resolve_video_ids(['A.webm', 'B.webm']) == {
+        'A.webm': 'abc'}
+    assert YouTubeProcessor.site is None
+
+
+def test_batches_of_50(youtube):
+    video_ids = ['v{0:03d}'.format(n) for n in range(120)]
+    assert YouTubeProcessor.fetch_statistics(video_ids + video_ids[:10],
+                                             workers=2) == (120, 0)
+
+    assert sorted(len(x) for x in YouTubeAPI.requests) == [20, 50, 50]
+    assert sorted(sum(YouTubeAPI.requests, [])) == video_ids
+    assert YouTubeProcessor.quota_used() == 3
+    member = youtube.hget('ytlatest', 'v007')
+    assert youtube.zrange('ytts:v007', 0, -1) == [member]
+    assert member.endswith(b':4')
+
+
+def test_quota_shared_in_redis(youtube, monkeypatch):
+    monkeypatch.setitem(YouTubeProcessor.h.settings, 'youtube_quota', 2)
+    # Units spent by an earlier run the same day count against the budget
+    youtube.set(YouTubeProcessor._quota_key(), 1)
+
+    assert YouTubeProcessor._get_youtube_data(['a']) is not None
+    with pytest.raises(RuntimeError, match='quota of 2 units'):
+        YouTubeProcessor._get_youtube_data(['b'])
+    assert YouTubeProcessor.quota_used() == 2
+    assert len(YouTubeAPI.requests) == 1
+    assert youtube.ttl(YouTubeProcessor._quota_key()) > 0
+
+
+def test_retries_with_backoff(youtube, monkeypatch):
+    pauses = []
+    monkeypatch.setattr(YouTubeProcessor.time, 'sleep', pauses.append)
+    monkeypatch.setitem(YouTubeProcessor.h.settings, 'youtube_backoff', 1)
+    YouTubeAPI.errors += [(503, ['backendError']),
+                          (403, ['rateLimitExceeded'])]
+
+    counts, timestamp = YouTubeProcessor._get_youtube_data(['abc'])
+    assert counts == {'abc': 3}
+    assert len(YouTubeAPI.requests) == 3
+    assert YouTubeProcessor.quota_used() == 3
+    # Exponential, with up to one backoff of jitter
+    assert 1 <= pauses[0] <= 2 and 2 <= pauses[1] <= 3
+
+
+def test_gives_up(youtube):
+    # Not worth a retry
+    YouTubeAPI.errors.append((400, ['badRequest']))
+    assert YouTubeProcessor._get_youtube_data(['abc']) is None
+    assert len(YouTubeAPI.requests) == 1
+
+    # Retried until YOUTUBE_RETRIES run out
+    YouTubeAPI.errors += [(500, [])] * 3
+    assert YouTubeProcessor.fetch_statistics(['abc']) == (0, 1)
+    assert len(YouTubeAPI.requests) == 4
+
+    YouTubeAPI.errors.append((403, ['quotaExceeded']))
+    with pytest.raises(RuntimeError, match='quota exceeded'):
+        YouTubeProcessor._get_youtube_data(['abc'])
+
+
+@pytest.mark.parametrize('text, video_id', [
+    ('{{From YouTube|abc}}', 'abc'),
+    ('{{From YouTube|title=Cats|abc|def}}', 'abc'),
+    ('{{from_youtube |1= abc |title=Cats}}', 'abc'),
+    ('{{Template:From YouTube|title=Cats|id=abc}}', 'abc'),
+    ('{{Information}} {{From YouTube|title={{lang|en|Cats}}|abc}}', 'abc'),
+    ('{{From YouTube|title=[[Cats|cats]]|id=abc}}', 'abc'),
+    ('{{From YouTube|{{x|y}}|z}}', None),
+    ('{{From YouTube|id={{x|1=abc}}}}', None),
+    ('{{From YouTube|title=Cats}}', None),
+    ('{{From YouTube| |abc}}', None),
+    ('{{From YouTube|abc', None),
+    ('{{From YouTubers|abc}}', None),
+])
+def test_parse_video_id(text, video_id):
+    assert YouTubeProcessor.parse_video_id(text) == video_id
+
+
+def _snapshots(redis, video_id):
+    return [x.decode('utf-8') for x in redis.zrange('ytts:' + video_id, 0,
+                                                   -1)]
+
+
+def test_snapshot_layout(youtube):
+    YouTubeProcessor._store_in_redis({'v1': '10', 'v2': '5'},
+                                     '20200301120000')
+    # Taken again at the same time, a snapshot replaces the first
+    YouTubeProcessor._store_in_redis({'v1': '11'}, '20200301120000')
+    YouTubeProcessor._store_in_redis({'v1': '12'}, '20200302120000')
+
+    assert _snapshots(youtube, 'v1') == ['20200301120000:11',
+                                         '20200302120000:12']
+    assert youtube.zscore('ytts:v1', '20200302120000:12') == 20200302120000
+    assert youtube.hgetall('ytlatest') == {b'v1': b'20200302120000:12',
+                                           b'v2': b'20200301120000:5'}
+
+
+def test_migrate(youtube):
+    YouTubeProcessor._store_in_redis({'v1': '7', 'v2': '5'}, '20200301120000')
+    youtube.hset('youtube:v1', mapping={'20200201000000': '3',
+                                        '20200401000000': '20'})
+    youtube.hset('youtube:v2', mapping={'20200101000000': '1'})
+    youtube.hset('youtube:v3', mapping={'20200101000000': '2'})
+    youtube.set('com2yt:A.webm', 'v3')
+    before = GetData.youtube_snapshot_file('A.webm', '20200101', '20200131')
+    assert before['count'] == 2
+
+    YouTubeProcessor.migrate(batch_size=2)
+    assert youtube.keys('youtube:*') == []
+    assert _snapshots(youtube, 'v1') == ['20200201000000:3',
+                                         '20200301120000:7',
+                                         '20200401000000:20']
+    # The latest snapshot wins, wherever it was kept
+    assert youtube.hgetall('ytlatest') == {b'v1': b'20200401000000:20',
+                                           b'v2': b'20200301120000:5',
+                                           b'v3': b'20200101000000:2'}
+    assert GetData.youtube_snapshot_file('A.webm', '20200101',
+                                         '20200131') == before
+
+    # Run again after an interruption that left a hash behind
+    youtube.hset('youtube:v1', mapping={'20200201000000': '3'})
+    YouTubeProcessor.migrate()
+    assert len(_snapshots(youtube, 'v1')) == 3
+    assert youtube.hget('ytlatest', 'v1') == b'20200401000000:20'
+    YouTubeProcessor.migrate()
+    assert youtube.keys('youtube:*') == []